@@ -76,6 +76,7 @@ class zulip::app_frontend_base {
   $queues_multiprocess = Boolean(zulipconf('application_server', 'queue_workers_multiprocess', $queues_multiprocess_default))
   $queues = [
     'deferred_work',
+    'deferred_work_long',
     'digest_emails',
     'email_mirror',
     'embed_links',
@@ -83,6 +84,7 @@ class zulip::app_frontend_base {
     'error_reports',
     'invites',
     'email_senders',
+    'message_sent',
     'missedmessage_emails',
     'missedmessage_mobile_notifications',
     'outgoing_webhooks',
@@ -90,6 +92,16 @@ class zulip::app_frontend_base {
     'user_activity_interval',
     'user_presence',
   ]
+  # In the multiprocess mode, these low-volume queues share a single
+  # multithreaded process, rather than each using the memory of a full
+  # process; keep the default in sync with scripts/lib/queue_workers.py.
+  $queues_shared_setting = split(zulipconf('application_server', 'queue_workers_shared', 'email_mirror,embedded_bots,error_reports,invites'), ',')
+  $queues_shared = $queues.filter |$queue| { $queue in $queues_shared_setting }
+  $queues_dedicated = $queues - $queues_shared
+  # Whether, in the multiprocess mode, the queue worker processes are
+  # forked from a single launcher process which has already loaded
+  # the app, rather than each being started by supervisor.
+  $queues_prefork = Boolean(zulipconf('application_server', 'queue_workers_prefork', false))
   if $queues_multiprocess {
     $uwsgi_default_processes = 6
   } else {
@@ -10,6 +10,7 @@ ZULIP_PATH = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__f
 
 normal_queues = [
     "deferred_work",
+    "deferred_work_long",
     "digest_emails",
     "email_mirror",
     "embed_links",
@@ -17,6 +18,7 @@ normal_queues = [
     "error_reports",
     "invites",
     "email_senders",
+    "message_sent",
     "missedmessage_emails",
     "missedmessage_mobile_notifications",
     "outgoing_webhooks",
@@ -39,12 +41,14 @@ states = {
 
 MAX_SECONDS_TO_CLEAR: DefaultDict[str, int] = defaultdict(
     lambda: 30,
+    deferred_work_long=4 * 3600,
     digest_emails=1200,
     missedmessage_mobile_notifications=120,
     embed_links=60,
 )
 CRITICAL_SECONDS_TO_CLEAR: DefaultDict[str, int] = defaultdict(
     lambda: 60,
+    deferred_work_long=8 * 3600,
     missedmessage_mobile_notifications=180,
     digest_emails=1800,
     embed_links=90,
@@ -1,4 +1,5 @@
 #!/usr/bin/env python3
+import argparse
 import os
 import sys
 
@@ -13,8 +14,43 @@ os.environ["DJANGO_SETTINGS_MODULE"] = "zproject.settings"
 import django
 
 django.setup()
+from scripts.lib.zulip_tools import get_config, get_config_file
 from zerver.worker.queue_processors import get_active_worker_queues
 
+# Low-volume queues which, in the multiprocess mode, share a single
+# multithreaded worker process, rather than each using the memory of
+# a full process.  Keep this in sync with the default for
+# queue_workers_shared in puppet/zulip/manifests/app_frontend_base.pp.
+DEFAULT_SHARED_QUEUES = "email_mirror,embedded_bots,error_reports,invites"
+
 if __name__ == "__main__":
-    for worker in sorted(get_active_worker_queues()):
+    parser = argparse.ArgumentParser(description="List the queues that need queue workers.")
+    group = parser.add_mutually_exclusive_group()
+    group.add_argument(
+        "--shared",
+        action="store_true",
+        help="Only list the queues which share a multithreaded worker process",
+    )
+    group.add_argument(
+        "--dedicated",
+        action="store_true",
+        help="Only list the queues which have their own worker process",
+    )
+    args = parser.parse_args()
+
+    queues = sorted(get_active_worker_queues())
+    if args.shared or args.dedicated:
+        shared_queues = {
+            queue_name.strip()
+            for queue_name in get_config(
+                get_config_file(),
+                "application_server",
+                "queue_workers_shared",
+                DEFAULT_SHARED_QUEUES,
+            ).split(",")
+        }
+        queues = [
+            queue_name for queue_name in queues if (queue_name in shared_queues) == args.shared
+        ]
+    for worker in queues:
         print(worker)
@@ -5,7 +5,7 @@ import json
 import os
 import subprocess
 import sys
-from typing import Any, Dict
+from typing import Any, Dict, List, Union
 
 BASE_DIR = os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
 sys.path.append(BASE_DIR)
@@ -24,12 +24,29 @@ def write_realm_nginx_config_line(f: Any, host: str, port: str) -> None:
     )
 
 
+def write_queue_id_nginx_config_line(f: Any, port: int) -> None:
+    f.write(
+        f"""if ($arg_queue_id ~ "^{port}:") {{
+    set $tornado_server http://tornado{port};
+}}\n"""
+    )
+
+
 # Basic system to do Tornado sharding.  Writes two output .tmp files that need
 # to be renamed to the following files to finalize the changes:
 # * /etc/zulip/nginx_sharding.conf; nginx needs to be reloaded after changing.
 # * /etc/zulip/sharding.json; supervisor Django process needs to be reloaded
 # after changing.  TODO: We can probably make this live-reload by statting the file.
 #
+# A realm listed under several ports has its users spread across those
+# Tornado processes by a consistent hash of their user IDs (see
+# zerver/tornado/sharding.py); its entry in sharding.json is the list
+# of ports.  Since nginx cannot tell which user a request is for, it
+# instead routes requests for those realms' event queues using the
+# port at the start of the queue ID.  DELETE requests have the queue
+# ID in their body, which nginx cannot route on; Tornado passes those
+# along to the right process.
+#
 # TODO: Restructure this to automatically generate a sharding layout.
 def write_updated_configs() -> None:
     config_file = get_config_file()
@@ -50,7 +67,7 @@ def write_updated_configs() -> None:
             return
 
         nginx_sharding_conf_f.write("set $tornado_server http://tornado9800;\n")
-        shard_map: Dict[str, int] = {}
+        shard_map: Dict[str, Union[int, List[int]]] = {}
         external_host = subprocess.check_output(
             [os.path.join(BASE_DIR, "scripts/get-django-setting"), "EXTERNAL_HOST"],
             universal_newlines=True,
@@ -64,11 +81,21 @@ def write_updated_configs() -> None:
                         host = shard
                     else:
                         host = f"{shard}.{external_host}"
-                    assert host not in shard_map, f"host {host} duplicated"
-                    shard_map[host] = int(port)
-                    write_realm_nginx_config_line(nginx_sharding_conf_f, host, port)
+                    if host not in shard_map:
+                        shard_map[host] = int(port)
+                        write_realm_nginx_config_line(nginx_sharding_conf_f, host, port)
+                        continue
+                    host_ports = shard_map[host]
+                    if isinstance(host_ports, int):
+                        host_ports = shard_map[host] = [host_ports]
+                    assert int(port) not in host_ports, f"host {host} duplicated"
+                    host_ports.append(int(port))
             nginx_sharding_conf_f.write("\n")
 
+        if any(isinstance(host_ports, list) for host_ports in shard_map.values()):
+            for tornado_port in ports:
+                write_queue_id_nginx_config_line(nginx_sharding_conf_f, tornado_port)
+
         sharding_json_f.write(json.dumps(shard_map) + "\n")
 
 
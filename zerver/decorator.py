@@ -879,12 +879,13 @@ def statsd_increment(counter: str, val: int = 1) -> Callable[[FuncT], FuncT]:
     return wrapper
 
 
-def rate_limit_user(request: HttpRequest, user: UserProfile, domain: str) -> None:
+def rate_limit_user(request: HttpRequest, user: UserProfile, domain: str, weight: int = 1) -> None:
     """Returns whether or not a user was rate limited. Will raise a RateLimited exception
     if the user has been rate limited, otherwise returns and modifies request to contain
-    the rate limit information"""
+    the rate limit information.  A weight greater than 1 counts the request as that
+    many requests."""
 
-    RateLimitedUser(user, domain=domain).rate_limit_request(request)
+    RateLimitedUser(user, domain=domain).rate_limit_request(request, weight)
 
 
 @cache_with_key(lambda: "tor_ip_addresses:", timeout=60 * 60)
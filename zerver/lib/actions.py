@@ -1,5 +1,6 @@
 import datetime
 import hashlib
+import io
 import itertools
 import logging
 import os
@@ -70,6 +71,7 @@ from zerver.lib.cache import (
     cache_with_key,
     delete_user_profile_caches,
     display_recipient_cache_key,
+    flush_stream_recipients,
     flush_user_profile,
     get_stream_cache_key,
     to_dict_cache_key_id,
@@ -96,6 +98,13 @@ from zerver.lib.exceptions import (
 )
 from zerver.lib.export import get_realm_exports_serialized
 from zerver.lib.external_accounts import DEFAULT_EXTERNAL_ACCOUNTS
+from zerver.lib.fanout_on_read import (
+    mark_all_fanout_messages_as_read,
+    mark_fanout_messages_as_read,
+    mark_fanout_stream_as_read,
+    materialize_fanout_stream,
+    materialize_fanout_user_messages,
+)
 from zerver.lib.hotspots import get_next_hotspots
 from zerver.lib.i18n import get_language_name
 from zerver.lib.markdown import MessageRenderingResult, topic_links
@@ -113,8 +122,9 @@ from zerver.lib.message import (
     wildcard_mention_allowed,
 )
 from zerver.lib.notification_data import UserMessageNotificationsData, get_user_group_mentions_data
+from zerver.lib.presence import realm_has_batched_presence_clients
 from zerver.lib.pysa import mark_sanitized
-from zerver.lib.queue import queue_json_publish
+from zerver.lib.queue import batched_queue_publish, queue_json_publish, queue_json_publish_many
 from zerver.lib.realm_icon import realm_icon_url
 from zerver.lib.realm_logo import get_realm_logo_data
 from zerver.lib.retention import move_messages_to_archive
@@ -134,10 +144,10 @@ from zerver.lib.stream_subscription import (
     bulk_get_subscriber_peer_info,
     get_active_subscriptions_for_stream_id,
     get_bulk_stream_subscriber_info,
+    get_stream_recipient_snapshot,
     get_stream_subscriptions_for_user,
     get_stream_subscriptions_for_users,
     get_subscribed_stream_ids_for_user,
-    get_subscriptions_for_send_message,
     get_user_ids_for_streams,
     num_subscribers_for_stream_id,
     subscriber_ids_with_stream_history_access,
@@ -166,6 +176,7 @@ from zerver.lib.topic import (
     TOPIC_NAME,
     filter_by_exact_message_topic,
     filter_by_topic_name_via_message,
+    messages_for_topic,
     save_message_for_edit_use_case,
     update_edit_history,
     update_messages_for_topic_edit,
@@ -256,7 +267,7 @@ from zerver.models import (
     realm_filters_for_realm,
     validate_attachment_request,
 )
-from zerver.tornado.django_api import send_event
+from zerver.tornado.django_api import send_ephemeral_event, send_event
 
 if settings.BILLING_ENABLED:
     from corporate.lib.stripe import (
@@ -1342,6 +1353,7 @@ def do_deactivate_stream(
     get_active_subscriptions_for_stream_id(stream.id, include_deactivated_users=True).update(
         active=False
     )
+    flush_stream_recipients([stream.recipient_id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -1549,6 +1561,7 @@ def get_recipient_info(
     stream_email_user_ids: Set[int] = set()
     wildcard_mention_user_ids: Set[int] = set()
     muted_sender_user_ids: Set[int] = get_muting_users(sender_id)
+    subscriber_rows: List[Dict[str, Any]] = []
 
     if recipient.type == Recipient.PERSONAL:
         # The sender and recipient may be the same id, so
@@ -1563,57 +1576,36 @@ def get_recipient_info(
         assert stream_topic is not None
         user_ids_muting_topic = stream_topic.user_ids_muting_topic()
 
-        subscription_rows = (
-            get_subscriptions_for_send_message(
-                realm_id=realm_id,
-                stream_id=stream_topic.stream_id,
-                possible_wildcard_mention=possible_wildcard_mention,
-                possibly_mentioned_user_ids=possibly_mentioned_user_ids,
-            )
-            .annotate(
-                user_profile_email_notifications=F(
-                    "user_profile__enable_stream_email_notifications"
-                ),
-                user_profile_push_notifications=F("user_profile__enable_stream_push_notifications"),
-                user_profile_wildcard_mentions_notify=F("user_profile__wildcard_mentions_notify"),
-            )
-            .values(
-                "user_profile_id",
-                "push_notifications",
-                "email_notifications",
-                "wildcard_mentions_notify",
-                "user_profile_email_notifications",
-                "user_profile_push_notifications",
-                "user_profile_wildcard_mentions_notify",
-                "is_muted",
-            )
-            .order_by("user_profile_id")
+        # The subscribers and their settings rarely change between
+        # messages sent to a stream, so rather than querying them for
+        # every message, we use a cached snapshot of them.
+        snapshot = get_stream_recipient_snapshot(realm_id=realm_id, recipient_id=recipient.id)
+        subscriber_rows = snapshot.get_rows_for_send_message(
+            possible_wildcard_mention=possible_wildcard_mention,
+            possibly_mentioned_user_ids=possibly_mentioned_user_ids,
         )
 
-        message_to_user_ids = [row["user_profile_id"] for row in subscription_rows]
+        message_to_user_ids = [row["id"] for row in subscriber_rows]
 
         def should_send(setting: str, row: Dict[str, Any]) -> bool:
-            # This implements the structure that the UserProfile stream notification settings
-            # are defaults, which can be overridden by the stream-level settings (if those
-            # values are not null).
+            # The snapshot has already resolved the stream-level
+            # settings against the UserProfile defaults.
             if row["is_muted"]:
                 return False
-            if row["user_profile_id"] in user_ids_muting_topic:
+            if row["id"] in user_ids_muting_topic:
                 return False
-            if row[setting] is not None:
-                return row[setting]
-            return row["user_profile_" + setting]
+            return row[setting]
 
         stream_push_user_ids = {
-            row["user_profile_id"]
-            for row in subscription_rows
+            row["id"]
+            for row in subscriber_rows
             # Note: muting a stream overrides stream_push_notify
             if should_send("push_notifications", row)
         }
 
         stream_email_user_ids = {
-            row["user_profile_id"]
-            for row in subscription_rows
+            row["id"]
+            for row in subscriber_rows
             # Note: muting a stream overrides stream_email_notify
             if should_send("email_notifications", row)
         }
@@ -1630,9 +1622,7 @@ def get_recipient_info(
             # treated as a mention (and follow the user's mention
             # notification preferences) or a normal message.
             wildcard_mention_user_ids = {
-                row["user_profile_id"]
-                for row in subscription_rows
-                if should_send("wildcard_mentions_notify", row)
+                row["id"] for row in subscriber_rows if should_send("wildcard_mentions_notify", row)
             }
 
     elif recipient.type == Recipient.HUDDLE:
@@ -1652,6 +1642,27 @@ def get_recipient_info(
     # for our data structures not related to bots
     user_ids |= possibly_mentioned_user_ids
 
+    # TODO: We should always have at least one user_id as a recipient
+    #       of any message we send.  Right now the exception to this
+    #       rule is `notify_new_user`, which, at least in a possibly
+    #       contrived test scenario, can attempt to send messages
+    #       to an inactive bot.  When we plug that hole, we can
+    #       `assert(rows)` after fetching them.
+    #
+    # UPDATE: It's February 2020 (and a couple years after the above
+    #         comment was written).  We have simplified notify_new_user
+    #         so that it should be a little easier to reason about.
+    #         There is currently some cleanup to how we handle cross
+    #         realm bots that is still under development.  Once that
+    #         effort is complete, we should be able to address this
+    #         to-do.
+
+    # For stream messages, the snapshot already has the UserProfile
+    # fields we need for the subscribers, so we only need to query
+    # possibly-mentioned users who aren't subscribed.
+    rows = list(subscriber_rows)
+    user_ids -= {row["id"] for row in subscriber_rows}
+
     if user_ids:
         query = UserProfile.objects.filter(is_active=True).values(
             "id",
@@ -1670,23 +1681,7 @@ def get_recipient_info(
             user_ids=sorted(user_ids),
             field="id",
         )
-        rows = list(query)
-    else:
-        # TODO: We should always have at least one user_id as a recipient
-        #       of any message we send.  Right now the exception to this
-        #       rule is `notify_new_user`, which, at least in a possibly
-        #       contrived test scenario, can attempt to send messages
-        #       to an inactive bot.  When we plug that hole, we can avoid
-        #       this `else` clause and just `assert(user_ids)`.
-        #
-        # UPDATE: It's February 2020 (and a couple years after the above
-        #         comment was written).  We have simplified notify_new_user
-        #         so that it should be a little easier to reason about.
-        #         There is currently some cleanup to how we handle cross
-        #         realm bots that is still under development.  Once that
-        #         effort is complete, we should be able to address this
-        #         to-do.
-        rows = []
+        rows += list(query)
 
     def get_ids_for(f: Callable[[Dict[str, Any]], bool]) -> Set[int]:
         """Only includes users on the explicit message to line"""
@@ -2000,11 +1995,21 @@ def do_send_messages(
             mark_as_read_for_users = send_request.muted_sender_user_ids
             mark_as_read_for_users.update(mark_as_read)
 
+            # In fanout-on-read streams, every subscriber is treated like
+            # a long_term_idle user: only those needing nonzero flags or
+            # notifications get a UserMessage row, and the rest derive
+            # the message's read state from their subscription's read
+            # watermark; see zerver/lib/fanout_on_read.py.
+            if send_request.stream is not None and send_request.stream.fanout_on_read:
+                long_term_idle_user_ids = send_request.um_eligible_user_ids
+            else:
+                long_term_idle_user_ids = send_request.long_term_idle_user_ids
+
             user_messages = create_user_messages(
                 message=send_request.message,
                 rendering_result=send_request.rendering_result,
                 um_eligible_user_ids=send_request.um_eligible_user_ids,
-                long_term_idle_user_ids=send_request.long_term_idle_user_ids,
+                long_term_idle_user_ids=long_term_idle_user_ids,
                 stream_push_user_ids=send_request.stream_push_user_ids,
                 stream_email_user_ids=send_request.stream_email_user_ids,
                 mentioned_user_ids=mentioned_user_ids,
@@ -2016,14 +2021,6 @@ def do_send_messages(
 
             ums.extend(user_messages)
 
-            send_request.message.service_queue_events = get_service_bot_events(
-                sender=send_request.message.sender,
-                service_bot_tuples=send_request.service_bot_tuples,
-                mentioned_user_ids=mentioned_user_ids,
-                active_user_ids=send_request.active_user_ids,
-                recipient_type=send_request.message.recipient.type,
-            )
-
         bulk_insert_ums(ums)
 
         for send_request in send_message_requests:
@@ -2032,10 +2029,13 @@ def do_send_messages(
     # This next loop is responsible for notifying other parts of the
     # Zulip system about the messages we just committed to the database:
     # * Notifying clients via send_event
-    # * Triggering outgoing webhooks via the service event queue.
     # * Updating the `first_message_id` field for streams without any message history.
     # * Implementing the Welcome Bot reply hack
-    # * Adding links to the embed_links queue for open graph processing.
+    # * Queueing a record of the message for the message_sent worker,
+    #   which triggers outgoing webhooks and embedded bots and adds links
+    #   to the embed_links queue for open graph processing; see
+    #   do_message_sent_side_effects.
+    message_sent_events: List[Dict[str, Any]] = []
     for send_request in send_message_requests:
         realm_id: Optional[int] = None
         if send_request.message.is_stream_message():
@@ -2094,6 +2094,19 @@ def do_send_messages(
 
         sender = send_request.message.sender
         message_type = wide_message_dict["type"]
+        # Only users who get notifications for every message (as for
+        # private messages, or streams with notifications enabled), or
+        # have flags like mentions, can need a notification, so we
+        # don't build the notification data for the other recipients of
+        # a stream message.
+        if message_type == "private":
+            notification_candidate_ids = send_request.active_user_ids
+        else:
+            notification_candidate_ids = send_request.active_user_ids & (
+                {user_id for user_id, flags in user_flags.items() if flags}
+                | send_request.stream_push_user_ids
+                | send_request.stream_email_user_ids
+            )
         active_users_data = [
             ActivePresenceIdleUserData(
                 alerted="has_alert_word" in user_flags.get(user_id, []),
@@ -2110,7 +2123,7 @@ def do_send_messages(
                     muted_sender_user_ids=send_request.muted_sender_user_ids,
                 ),
             )
-            for user_id in send_request.active_user_ids
+            for user_id in notification_candidate_ids
         ]
 
         presence_idle_user_ids = get_active_presence_idle_user_ids(
@@ -2158,15 +2171,6 @@ def do_send_messages(
             event["sender_queue_id"] = send_request.sender_queue_id
         send_event(send_request.realm, event, users)
 
-        if send_request.links_for_embed:
-            event_data = {
-                "message_id": send_request.message.id,
-                "message_content": send_request.message.content,
-                "message_realm_id": send_request.realm.id,
-                "urls": list(send_request.links_for_embed),
-            }
-            queue_json_publish("embed_links", event_data)
-
         if send_request.message.recipient.type == Recipient.PERSONAL:
             welcome_bot_id = get_system_bot(
                 settings.WELCOME_BOT, send_request.message.sender.realm_id
@@ -2179,19 +2183,81 @@ def do_send_messages(
 
                 send_welcome_bot_response(send_request)
 
-        for queue_name, events in send_request.message.service_queue_events.items():
-            for event in events:
+        # The record only has the IDs of the bots that the message
+        # triggers; the worker builds their events.
+        service_bot_events = get_service_bot_events(
+            sender=sender,
+            service_bot_tuples=send_request.service_bot_tuples,
+            mentioned_user_ids=send_request.rendering_result.mentions_user_ids,
+            active_user_ids=send_request.active_user_ids,
+            recipient_type=send_request.message.recipient.type,
+        )
+        if service_bot_events or send_request.links_for_embed:
+            message_sent_events.append(
+                {
+                    "message_id": send_request.message.id,
+                    "realm_id": send_request.realm.id,
+                    "service_bot_events": service_bot_events,
+                    "links_for_embed": list(send_request.links_for_embed),
+                }
+            )
+
+    # The side effects that the sender doesn't need to wait for, and
+    # that can involve many users, happen in the message_sent worker.
+    # We may be inside an outer transaction (e.g. do_update_message),
+    # and the worker needs to be able to see the messages.
+    if message_sent_events:
+        transaction.on_commit(lambda: queue_json_publish_many("message_sent", message_sent_events))
+
+    return [send_request.message.id for send_request in send_message_requests]
+
+
+def do_message_sent_side_effects(event: Dict[str, Any]) -> None:
+    """Processes the record that do_send_messages queues for a message
+    to the message_sent worker: sends the events for the outgoing
+    webhooks and embedded bots that the message triggers, and queues
+    its links for previews."""
+    try:
+        message = Message.objects.select_related().get(id=event["message_id"])
+    except Message.DoesNotExist:
+        # The record is only queued once the message is committed, so
+        # the message must have been deleted before we got to it.
+        logging.warning(
+            "message_sent: Message %s was deleted before its side effects were processed",
+            event["message_id"],
+        )
+        return
+
+    if event["links_for_embed"]:
+        queue_json_publish(
+            "embed_links",
+            {
+                "message_id": message.id,
+                "message_content": message.content,
+                "message_realm_id": event["realm_id"],
+                "urls": event["links_for_embed"],
+            },
+        )
+
+    if not event["service_bot_events"]:
+        return
+
+    realm_id = event["realm_id"] if message.is_stream_message() else None
+    wide_message_dict = MessageDict.wide_dict(message, realm_id)
+    # A message can trigger many bots at once, so send their
+    # events to RabbitMQ as one batch per queue.
+    with batched_queue_publish():
+        for queue_name, events in event["service_bot_events"].items():
+            for service_event in events:
                 queue_json_publish(
                     queue_name,
                     {
                         "message": wide_message_dict,
-                        "trigger": event["trigger"],
-                        "user_profile_id": event["user_profile_id"],
+                        "trigger": service_event["trigger"],
+                        "user_profile_id": service_event["user_profile_id"],
                     },
                 )
 
-    return [send_request.message.id for send_request in send_message_requests]
-
 
 class UserMessageLite:
     """
@@ -2281,16 +2347,32 @@ def create_user_messages(
     return user_messages
 
 
+# Above this many rows, bulk_insert_ums uses COPY rather than INSERT.
+# See `./manage.py benchmark_bulk_insert_ums`, which compares the two.
+BULK_INSERT_UMS_COPY_THRESHOLD = 1000
+
+
 def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
     """
     Doing bulk inserts this way is much faster than using Django,
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
+
+    For messages with many recipients, like those sent to large
+    streams, we stream the rows to PostgreSQL with COPY, which avoids
+    building, sending and parsing hundreds of INSERT statements.
     """
     if not ums:
         return
 
+    if len(ums) >= BULK_INSERT_UMS_COPY_THRESHOLD:
+        copy_ums(ums)
+    else:
+        insert_ums(ums)
+
+
+def insert_ums(ums: List[UserMessageLite]) -> None:
     vals = [(um.user_profile_id, um.message_id, um.flags) for um in ums]
     query = SQL(
         """
@@ -2304,6 +2386,16 @@ def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
         execute_values(cursor.cursor, query, vals)
 
 
+def copy_ums(ums: List[UserMessageLite]) -> None:
+    rows = io.StringIO(
+        "".join(f"{um.user_profile_id}\t{um.message_id}\t{int(um.flags)}\n" for um in ums)
+    )
+    with connection.cursor() as cursor:
+        cursor.cursor.copy_from(
+            rows, "zerver_usermessage", columns=("user_profile_id", "message_id", "flags")
+        )
+
+
 def verify_submessage_sender(
     *,
     message_id: int,
@@ -2548,7 +2640,7 @@ def do_send_typing_notification(
     # Only deliver the notification to active user recipients
     user_ids_to_notify = [user.id for user in recipient_user_profiles if user.is_active]
 
-    send_event(realm, event, user_ids_to_notify)
+    send_ephemeral_event(realm, event, user_ids_to_notify)
 
 
 # check_send_typing_notification:
@@ -2600,7 +2692,7 @@ def do_send_stream_typing_notification(
 
     user_ids_to_notify = get_user_ids_for_streams({stream.id})[stream.id]
 
-    send_event(sender.realm, event, user_ids_to_notify)
+    send_ephemeral_event(sender.realm, event, user_ids_to_notify)
 
 
 def ensure_stream(
@@ -3906,28 +3998,31 @@ def bulk_add_subscriptions(
     # We now send several types of events to notify browsers.  The
     # first batches of notifications are sent only to the user(s)
     # being subscribed; we can skip these notifications when this is
-    # being called from the new user creation flow.
-    if not from_user_creation:
-        send_stream_creation_events_for_private_streams(
-            realm=realm,
-            stream_dict=stream_dict,
-            altered_user_dict=altered_user_dict,
-        )
+    # being called from the new user creation flow.  Subscribing many
+    # users sends an event per user, which we send to Tornado's queue
+    # in one batch.
+    with batched_queue_publish():
+        if not from_user_creation:
+            send_stream_creation_events_for_private_streams(
+                realm=realm,
+                stream_dict=stream_dict,
+                altered_user_dict=altered_user_dict,
+            )
 
-        send_subscription_add_events(
+            send_subscription_add_events(
+                realm=realm,
+                sub_info_list=subs_to_add + subs_to_activate,
+                subscriber_dict=subscriber_peer_info.subscribed_ids,
+            )
+
+        send_peer_subscriber_events(
+            op="peer_add",
             realm=realm,
-            sub_info_list=subs_to_add + subs_to_activate,
-            subscriber_dict=subscriber_peer_info.subscribed_ids,
+            altered_user_dict=altered_user_dict,
+            stream_dict=stream_dict,
+            private_peer_dict=subscriber_peer_info.private_peer_dict,
         )
 
-    send_peer_subscriber_events(
-        op="peer_add",
-        realm=realm,
-        altered_user_dict=altered_user_dict,
-        stream_dict=stream_dict,
-        private_peer_dict=subscriber_peer_info.private_peer_dict,
-    )
-
     return (
         subs_to_add + subs_to_activate,
         already_subscribed,
@@ -3946,9 +4041,26 @@ def bulk_add_subs_to_db_with_logging(
     subs_to_activate: List[SubInfo],
 ) -> None:
 
+    # Subscribers of fanout-on-read streams receive messages after the
+    # current last message, and have read everything before it.
+    fanout_message_id = None
+    if any(info.stream.fanout_on_read for info in subs_to_add + subs_to_activate):
+        fanout_message_id = get_last_message_id()
+    for info in subs_to_add:
+        if info.stream.fanout_on_read:
+            info.sub.fanout_start_message_id = fanout_message_id
+            info.sub.fanout_read_message_id = fanout_message_id
+
     Subscription.objects.bulk_create(info.sub for info in subs_to_add)
     sub_ids = [info.sub.id for info in subs_to_activate]
     Subscription.objects.filter(id__in=sub_ids).update(active=True)
+    fanout_sub_ids = [info.sub.id for info in subs_to_activate if info.stream.fanout_on_read]
+    if fanout_sub_ids:
+        Subscription.objects.filter(id__in=fanout_sub_ids).update(
+            fanout_start_message_id=fanout_message_id,
+            fanout_read_message_id=fanout_message_id,
+        )
+    flush_stream_recipients({info.sub.recipient_id for info in subs_to_add + subs_to_activate})
 
     # Log subscription activities in RealmAuditLog
     event_time = timezone_now()
@@ -4184,6 +4296,7 @@ def bulk_remove_subscriptions(
         Subscription.objects.filter(
             id__in=sub_ids_to_deactivate,
         ).update(active=False)
+        flush_stream_recipients({sub_info.sub.recipient_id for sub_info in subs_to_deactivate})
         occupied_streams_after = list(get_occupied_streams(our_realm))
 
         # Log subscription activities in RealmAuditLog
@@ -4853,6 +4966,12 @@ def do_change_stream_invite_only(
         invite_only,
         history_public_to_subscribers,
     )
+    # Subscribers of fanout-on-read streams access most messages
+    # through the stream's history; see zerver/lib/fanout_on_read.py.
+    if stream.fanout_on_read and not history_public_to_subscribers:
+        raise JsonableError(
+            _("Fanout-on-read requires the stream's history to be public to subscribers.")
+        )
     stream.invite_only = invite_only
     stream.history_public_to_subscribers = history_public_to_subscribers
     stream.is_web_public = False
@@ -5105,6 +5224,43 @@ def do_change_stream_message_retention_days(
     )
 
 
+def do_change_stream_fanout_on_read(stream: Stream, fanout_on_read: bool) -> None:
+    """Turns fanout-on-read on or off for a stream; see
+    zerver/lib/fanout_on_read.py.  Subscribers keep their unread
+    messages either way."""
+    if fanout_on_read == stream.fanout_on_read:
+        return
+
+    if fanout_on_read:
+        # Subscribers without a UserMessage row for a message can only
+        # access it if they can access the stream's history.
+        if not stream.is_history_public_to_subscribers():
+            raise JsonableError(
+                _("Fanout-on-read requires the stream's history to be public to subscribers.")
+            )
+        with transaction.atomic():
+            stream.fanout_on_read = True
+            stream.save(update_fields=["fanout_on_read"])
+            last_message_id = get_last_message_id()
+            Subscription.objects.filter(recipient_id=stream.recipient_id, active=True).update(
+                fanout_start_message_id=last_message_id,
+                fanout_read_message_id=last_message_id,
+            )
+        return
+
+    # We first commit turning the flag off, so that new messages get
+    # UserMessage rows for every subscriber, and then create the rows
+    # that the stream's existing messages are missing.
+    stream.fanout_on_read = False
+    stream.save(update_fields=["fanout_on_read"])
+    with transaction.atomic():
+        materialize_fanout_stream(stream)
+        Subscription.objects.filter(recipient_id=stream.recipient_id).update(
+            fanout_start_message_id=None,
+            fanout_read_message_id=None,
+        )
+
+
 def set_realm_permissions_based_on_org_type(realm: Realm) -> None:
     """This function implements overrides for the default configuration
     for new organizations when the administrator selected specific
@@ -5587,6 +5743,17 @@ def send_presence_changed(user_profile: UserProfile, presence: UserPresence) ->
     # See https://zulip.readthedocs.io/en/latest/subsystems/presence.html for
     # internals documentation on presence.
     user_ids = active_user_ids(user_profile.realm_id)
+    presence_dict = presence.to_dict()
+    event = dict(
+        type="presence",
+        email=user_profile.email,
+        user_id=user_profile.id,
+        server_timestamp=time.time(),
+        presence={presence_dict["client"]: presence_dict},
+        # Used by Tornado to batch presence changes for clients with
+        # the batched_presence capability.
+        realm_id=user_profile.realm_id,
+    )
     if len(user_ids) > settings.USER_LIMIT_FOR_SENDING_PRESENCE_UPDATE_EVENTS:
         # These immediate presence generate quadratic work for Tornado
         # (linear number of users in each event and the frequency of
@@ -5598,17 +5765,15 @@ def send_presence_changed(user_profile: UserProfile, presence: UserPresence) ->
         # The utility of these live-presence updates goes down as
         # organizations get bigger (since one is much less likely to
         # be paying attention to the sidebar); so beyond a limit, we
-        # stop sending them at all.
-        return
-
-    presence_dict = presence.to_dict()
-    event = dict(
-        type="presence",
-        email=user_profile.email,
-        user_id=user_profile.id,
-        server_timestamp=time.time(),
-        presence={presence_dict["client"]: presence_dict},
-    )
+        # only send them to clients with the batched_presence
+        # capability, which receive each realm's changes in a single
+        # event every few seconds.  The notice has no user list, since
+        # Tornado sends the batched event to all such clients in the
+        # realm; and it is not sent at all if there are none.
+        if not realm_has_batched_presence_clients(user_profile.realm_id):
+            return
+        event["batched_only"] = True
+        user_ids = []
     send_event(user_profile.realm, event, user_ids)
 
 
@@ -5774,6 +5939,7 @@ def do_mark_all_as_read(user_profile: UserProfile, client: Client) -> int:
     count = msgs.update(
         flags=F("flags").bitor(UserMessage.flags.read),
     )
+    count += mark_all_fanout_messages_as_read(user_profile)
 
     event = asdict(
         ReadMessagesEvent(
@@ -5826,6 +5992,10 @@ def do_mark_stream_messages_as_read(
         flags=F("flags").bitor(UserMessage.flags.read),
     )
 
+    fanout_message_ids = mark_fanout_stream_as_read(user_profile, stream_recipient_id, topic_name)
+    message_ids += fanout_message_ids
+    count += len(fanout_message_ids)
+
     event = asdict(
         ReadMessagesEvent(
             messages=message_ids,
@@ -5958,6 +6128,11 @@ def do_update_message_flags(
     flagattr = getattr(UserMessage.flags, flag)
 
     msgs = UserMessage.objects.filter(user_profile=user_profile, message_id__in=messages)
+    marking_as_read = flag == "read" and operation == "add"
+    if not marking_as_read:
+        # Messages received in fanout-on-read streams may not have a
+        # UserMessage row to store the flag in yet.
+        materialize_fanout_user_messages(user_profile, messages)
     # This next block allows you to star any message, even those you
     # didn't receive (e.g. because you're looking at a public stream
     # you're not subscribed to, etc.).  The problem is that starring
@@ -5988,6 +6163,8 @@ def do_update_message_flags(
         count = msgs.update(flags=F("flags").bitor(flagattr))
     elif operation == "remove":
         count = msgs.update(flags=F("flags").bitand(~flagattr))
+    if marking_as_read:
+        count += len(mark_fanout_messages_as_read(user_profile, messages))
 
     event = {
         "type": "update_message_flags",
@@ -5999,7 +6176,7 @@ def do_update_message_flags(
     }
     send_event(user_profile.realm, event, [user_profile.id])
 
-    if flag == "read" and operation == "add":
+    if marking_as_read:
         event_time = timezone_now()
         do_clear_mobile_push_notifications_for_ids([user_profile.id], messages)
 
@@ -6389,6 +6566,21 @@ def do_update_message(
 
         edit_history_event["prev_stream"] = stream_being_edited.id
         event[ORIG_TOPIC] = orig_topic_name
+
+        if stream_being_edited.fanout_on_read:
+            # Whether subscribers without a UserMessage row received
+            # these messages, and have read them, is derived from the
+            # stream they're in; record it before moving them.
+            moved_message_ids = [target_message.id]
+            if propagate_mode in ["change_later", "change_all"]:
+                topic_messages = messages_for_topic(
+                    stream_being_edited.recipient_id, orig_topic_name
+                )
+                if propagate_mode == "change_later":
+                    topic_messages = topic_messages.filter(id__gt=target_message.id)
+                moved_message_ids += topic_messages.values_list("id", flat=True)
+            materialize_fanout_stream(stream_being_edited, moved_message_ids)
+
         target_message.recipient_id = new_stream.recipient_id
 
         event["new_stream_id"] = new_stream.id
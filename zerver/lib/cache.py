@@ -26,6 +26,7 @@ from django.conf import settings
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.core.cache.backends.base import BaseCache
+from django.db import transaction
 from django.db.models import Q
 from django.http import HttpRequest
 
@@ -34,7 +35,16 @@ from zerver.lib.utils import make_safe_digest, statsd, statsd_key
 if TYPE_CHECKING:
     # These modules have to be imported for type annotations but
     # they cannot be imported at runtime due to cyclic dependency.
-    from zerver.models import Attachment, Message, MutedUser, Realm, Stream, SubMessage, UserProfile
+    from zerver.models import (
+        Attachment,
+        Message,
+        MutedUser,
+        Realm,
+        Stream,
+        SubMessage,
+        Subscription,
+        UserProfile,
+    )
 
 MEMCACHED_MAX_KEY_LENGTH = 250
 
@@ -477,6 +487,10 @@ def preview_url_cache_key(url: str) -> str:
     return f"preview_url:{make_safe_digest(url)}"
 
 
+def preview_host_failure_cache_key(host: str) -> str:
+    return f"preview_host_failure:{make_safe_digest(host)}"
+
+
 def display_recipient_cache_key(recipient_id: int) -> str:
     return f"display_recipient_dict:{recipient_id}"
 
@@ -576,6 +590,72 @@ def get_stream_cache_key(stream_name: str, realm_id: int) -> str:
     return f"stream_by_realm_and_name:{realm_id}:{make_safe_digest(stream_name.strip().lower())}"
 
 
+# The snapshots of stream subscribers used for sending messages (see
+# get_stream_recipient_snapshot) are cached under a key that includes
+# a version for the stream, which changes whenever its subscriptions
+# do, and one for the realm, which changes whenever a user setting
+# that the snapshots contain does.  This way, a change to a user's
+# settings doesn't require finding and deleting the snapshots for
+# every stream they are subscribed to.
+def stream_recipients_version_cache_key(recipient_id: int) -> str:
+    return f"stream_recipients_version:{recipient_id}"
+
+
+def realm_recipients_version_cache_key(realm_id: int) -> str:
+    return f"realm_recipients_version:{realm_id}"
+
+
+def stream_recipients_cache_key(recipient_id: int, stream_version: str, realm_version: str) -> str:
+    return f"stream_recipients:{recipient_id}:{stream_version}:{realm_version}"
+
+
+def bump_recipients_versions(keys: List[str]) -> None:
+    def bump() -> None:
+        cache_set_many({key: secrets.token_hex(8) for key in keys})
+
+    # We bump the versions immediately, so that this process doesn't
+    # read back a stale snapshot, and again once the transaction
+    # commits, since another process could otherwise cache a snapshot
+    # of the data from before the commit under the new versions.
+    bump()
+    transaction.on_commit(bump)
+
+
+def flush_stream_recipients(recipient_ids: Iterable[int]) -> None:
+    bump_recipients_versions(
+        [stream_recipients_version_cache_key(recipient_id) for recipient_id in recipient_ids]
+    )
+
+
+def flush_realm_recipients(realm_id: int) -> None:
+    bump_recipients_versions([realm_recipients_version_cache_key(realm_id)])
+
+
+# The UserProfile fields included in the stream recipient snapshots.
+stream_recipients_user_fields: List[str] = [
+    "is_active",
+    "is_bot",
+    "bot_type",
+    "long_term_idle",
+    "enable_stream_email_notifications",
+    "enable_stream_push_notifications",
+    "wildcard_mentions_notify",
+    "enable_online_push_notifications",
+    "enable_offline_email_notifications",
+    "enable_offline_push_notifications",
+]
+
+# The Subscription fields included in the stream recipient snapshots.
+stream_recipients_subscription_fields: List[str] = [
+    "active",
+    "is_user_active",
+    "is_muted",
+    "push_notifications",
+    "email_notifications",
+    "wildcard_mentions_notify",
+]
+
+
 def delete_user_profile_caches(user_profiles: Iterable["UserProfile"]) -> None:
     # Imported here to avoid cyclic dependency.
     from zerver.lib.users import get_all_api_keys
@@ -639,6 +719,9 @@ def flush_user_profile(
     if changed(update_fields, ["role"]):
         cache_delete(active_non_guest_user_ids_cache_key(user_profile.realm_id))
 
+    if changed(update_fields, stream_recipients_user_fields):
+        flush_realm_recipients(user_profile.realm_id)
+
     if changed(update_fields, ["email", "full_name", "id", "is_mirror_dummy"]):
         delete_display_recipient_cache(user_profile)
 
@@ -730,6 +813,18 @@ def flush_stream(
         cache_delete(bot_dicts_in_realm_cache_key(stream.realm))
 
 
+# Called by models.py to flush the stream recipient snapshots whenever
+# we save a Subscription object.
+def flush_subscription(
+    *,
+    instance: "Subscription",
+    update_fields: Optional[Sequence[str]] = None,
+    **kwargs: object,
+) -> None:
+    if changed(update_fields, stream_recipients_subscription_fields):
+        flush_stream_recipients([instance.recipient_id])
+
+
 def flush_used_upload_space_cache(
     *,
     instance: "Attachment",
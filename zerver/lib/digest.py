@@ -13,7 +13,7 @@ from zerver.context_processors import common_context
 from zerver.lib.email_notifications import build_message_list
 from zerver.lib.logging_util import log_to_file
 from zerver.lib.message import get_last_message_id
-from zerver.lib.queue import queue_json_publish
+from zerver.lib.queue import batched_queue_publish, queue_json_publish
 from zerver.lib.send_email import FromAddress, send_future_email
 from zerver.lib.url_encoding import encode_stream
 from zerver.models import (
@@ -151,13 +151,14 @@ def _enqueue_emails_for_realm(realm: Realm, cutoff: datetime.datetime) -> None:
     # to amorize work, but not so big that a single item
     # from the queue takes too long to process.
     chunk_size = 30
-    for i in range(0, len(user_ids), chunk_size):
-        chunk_user_ids = user_ids[i : i + chunk_size]
-        queue_digest_user_ids(chunk_user_ids, cutoff)
-        logger.info(
-            "Queuing user_ids for potential digest: %s",
-            chunk_user_ids,
-        )
+    with batched_queue_publish():
+        for i in range(0, len(user_ids), chunk_size):
+            chunk_user_ids = user_ids[i : i + chunk_size]
+            queue_digest_user_ids(chunk_user_ids, cutoff)
+            logger.info(
+                "Queuing user_ids for potential digest: %s",
+                chunk_user_ids,
+            )
 
 
 def get_recent_topics(
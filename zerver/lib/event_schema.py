@@ -423,6 +423,18 @@ presence_event = event_dict_type(
 _check_presence = make_checker(presence_event)
 
 
+# Sent, instead of presence_event, to clients with the
+# batched_presence client capability.
+batched_presence_event = event_dict_type(
+    required_keys=[
+        ("type", Equals("presence")),
+        ("server_timestamp", NumberType()),
+        ("presences", StringDictType(StringDictType(presence_type))),
+    ]
+)
+check_batched_presence = make_checker(batched_presence_event)
+
+
 def check_presence(
     var_name: str,
     event: Dict[str, object],
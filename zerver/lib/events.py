@@ -1081,13 +1081,21 @@ def apply_event(
         else:
             raise AssertionError("Unexpected event type {type}/{op}".format(**event))
     elif event["type"] == "presence":
-        if slim_presence:
-            user_key = str(event["user_id"])
+        if "presences" in event:
+            # A batched_presence event, covering several users, whose
+            # keys are user IDs or emails as in state["presences"].
+            presences = get_presences_for_realm(user_profile.realm, slim_presence)
+            for user_key in event["presences"]:
+                if user_key in presences:
+                    state["presences"][user_key] = presences[user_key]
         else:
-            user_key = event["email"]
-        state["presences"][user_key] = get_presence_for_user(event["user_id"], slim_presence)[
-            user_key
-        ]
+            if slim_presence:
+                user_key = str(event["user_id"])
+            else:
+                user_key = event["email"]
+            state["presences"][user_key] = get_presence_for_user(event["user_id"], slim_presence)[
+                user_key
+            ]
     elif event["type"] == "update_message":
         # We don't return messages in /register, so we don't need to
         # do anything for content updates, but we may need to update
@@ -1317,6 +1325,7 @@ def do_events_register(
     )
     stream_typing_notifications = client_capabilities.get("stream_typing_notifications", False)
     user_settings_object = client_capabilities.get("user_settings_object", False)
+    batched_presence = client_capabilities.get("batched_presence", False)
 
     if user_profile.realm.email_address_visibility != Realm.EMAIL_ADDRESS_VISIBILITY_EVERYONE:
         # If real email addresses are not available to the user, their
@@ -1349,6 +1358,7 @@ def do_events_register(
             bulk_message_deletion=bulk_message_deletion,
             stream_typing_notifications=stream_typing_notifications,
             user_settings_object=user_settings_object,
+            batched_presence=batched_presence,
         )
 
         if queue_id is None:
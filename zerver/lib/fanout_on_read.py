@@ -0,0 +1,228 @@
+# Documented in https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#fanout-on-read-streams
+from collections import defaultdict
+from dataclasses import dataclass
+from typing import DefaultDict, Dict, Iterable, List, Optional, Set
+
+from django.db import connection
+from django.db.models import Exists, OuterRef, Q, QuerySet
+from psycopg2.sql import SQL
+
+from zerver.lib.topic import TOPIC_NAME
+from zerver.models import Message, Stream, Subscription, UserMessage, UserProfile
+
+
+@dataclass
+class FanoutSubscription:
+    recipient_id: int
+    start_message_id: int
+    read_message_id: int
+
+
+def get_fanout_subscriptions(user_profile: UserProfile) -> Dict[int, FanoutSubscription]:
+    """Returns the user's active subscriptions to fanout-on-read
+    streams, by recipient ID."""
+    rows = Subscription.objects.filter(
+        user_profile=user_profile,
+        active=True,
+        fanout_start_message_id__isnull=False,
+    ).values_list("recipient_id", "fanout_start_message_id", "fanout_read_message_id")
+    return {
+        recipient_id: FanoutSubscription(recipient_id, start_message_id, read_message_id)
+        for (recipient_id, start_message_id, read_message_id) in rows
+    }
+
+
+def fanout_messages_without_user_message(
+    user_profile: UserProfile,
+    fanout_subscriptions: Iterable[FanoutSubscription],
+    *,
+    unread_only: bool,
+) -> QuerySet:
+    """Returns the messages in fanout-on-read streams that the user
+    received without getting a UserMessage row for them, or with
+    unread_only, just those of them that are unread."""
+    condition = Q(id__in=[])
+    for sub in fanout_subscriptions:
+        after_id = sub.read_message_id if unread_only else sub.start_message_id
+        condition |= Q(recipient_id=sub.recipient_id, id__gt=after_id)
+    return Message.objects.filter(condition).filter(
+        ~Exists(UserMessage.objects.filter(user_profile=user_profile, message_id=OuterRef("id")))
+    )
+
+
+def get_fanout_message_flags(
+    user_profile: UserProfile, message_ids: List[int]
+) -> Dict[int, List[str]]:
+    """Returns the flags for those of the given messages that the user
+    received in a fanout-on-read stream without a UserMessage row."""
+    fanout_subscriptions = get_fanout_subscriptions(user_profile)
+    if not fanout_subscriptions:
+        return {}
+
+    rows = (
+        fanout_messages_without_user_message(
+            user_profile, fanout_subscriptions.values(), unread_only=False
+        )
+        .filter(id__in=message_ids)
+        .values_list("id", "recipient_id")
+    )
+    return {
+        message_id: ["read"]
+        if message_id <= fanout_subscriptions[recipient_id].read_message_id
+        else []
+        for (message_id, recipient_id) in rows
+    }
+
+
+def materialize_fanout_user_messages(user_profile: UserProfile, message_ids: List[int]) -> None:
+    """Creates UserMessage rows, with their current flags, for those of
+    the given messages that the user received in a fanout-on-read
+    stream without one, so that flags other than read can be stored
+    for them."""
+    flags = get_fanout_message_flags(user_profile, message_ids)
+    UserMessage.objects.bulk_create(
+        [
+            UserMessage(
+                user_profile=user_profile,
+                message_id=message_id,
+                flags=UserMessage.flags.read if "read" in message_flags else 0,
+            )
+            for message_id, message_flags in flags.items()
+        ],
+        ignore_conflicts=True,
+    )
+
+
+def advance_read_watermark(
+    user_profile: UserProfile, recipient_id: int, read_message_id: int
+) -> None:
+    # The condition keeps concurrent requests from moving the
+    # watermark backwards.
+    Subscription.objects.filter(
+        user_profile=user_profile,
+        recipient_id=recipient_id,
+        fanout_read_message_id__lt=read_message_id,
+    ).update(fanout_read_message_id=read_message_id)
+
+
+def mark_fanout_messages_as_read(user_profile: UserProfile, message_ids: List[int]) -> List[int]:
+    """Marks those of the given messages that the user received in a
+    fanout-on-read stream without a UserMessage row as read, and
+    returns their IDs.
+
+    When the messages are all of the stream's unread messages up to
+    some point, as when the user reads the stream in order, we just
+    advance the read watermark; we only create (read) UserMessage rows
+    for messages after an unread one."""
+    fanout_subscriptions = get_fanout_subscriptions(user_profile)
+    if not fanout_subscriptions:
+        return []
+
+    unread_messages = fanout_messages_without_user_message(
+        user_profile, fanout_subscriptions.values(), unread_only=True
+    )
+    marked_ids_by_recipient: DefaultDict[int, Set[int]] = defaultdict(set)
+    for message_id, recipient_id in unread_messages.filter(id__in=message_ids).values_list(
+        "id", "recipient_id"
+    ):
+        marked_ids_by_recipient[recipient_id].add(message_id)
+
+    user_messages_to_create = []
+    for recipient_id, marked_ids in marked_ids_by_recipient.items():
+        read_message_id = fanout_subscriptions[recipient_id].read_message_id
+        unread_ids = (
+            unread_messages.filter(recipient_id=recipient_id, id__lte=max(marked_ids))
+            .order_by("id")
+            .values_list("id", flat=True)
+        )
+        for message_id in unread_ids:
+            if message_id not in marked_ids:
+                break
+            read_message_id = message_id
+        advance_read_watermark(user_profile, recipient_id, read_message_id)
+
+        user_messages_to_create += [
+            UserMessage(
+                user_profile=user_profile, message_id=message_id, flags=UserMessage.flags.read
+            )
+            for message_id in marked_ids
+            if message_id > read_message_id
+        ]
+    UserMessage.objects.bulk_create(user_messages_to_create, ignore_conflicts=True)
+
+    return sorted(
+        message_id for marked_ids in marked_ids_by_recipient.values() for message_id in marked_ids
+    )
+
+
+def mark_fanout_stream_as_read(
+    user_profile: UserProfile, stream_recipient_id: int, topic_name: Optional[str] = None
+) -> List[int]:
+    """Marks the user's unread messages without a UserMessage row in a
+    fanout-on-read stream, or in a topic of it, as read, and returns
+    their IDs."""
+    sub = get_fanout_subscriptions(user_profile).get(stream_recipient_id)
+    if sub is None:
+        return []
+
+    unread_messages = fanout_messages_without_user_message(user_profile, [sub], unread_only=True)
+    if topic_name:
+        topic_message_ids = list(
+            unread_messages.filter(**{f"{TOPIC_NAME}__iexact": topic_name}).values_list(
+                "id", flat=True
+            )
+        )
+        return mark_fanout_messages_as_read(user_profile, topic_message_ids)
+
+    message_ids = list(unread_messages.order_by("id").values_list("id", flat=True))
+    if message_ids:
+        advance_read_watermark(user_profile, stream_recipient_id, message_ids[-1])
+    return message_ids
+
+
+def mark_all_fanout_messages_as_read(user_profile: UserProfile) -> int:
+    count = 0
+    for recipient_id in get_fanout_subscriptions(user_profile):
+        count += len(mark_fanout_stream_as_read(user_profile, recipient_id))
+    return count
+
+
+def materialize_fanout_stream(stream: Stream, message_ids: Optional[List[int]] = None) -> None:
+    """Creates the UserMessage rows that the stream's subscribers would
+    have had if it hadn't been fanout-on-read, for turning it off, or
+    with message_ids, just for those messages, before moving them out
+    of the stream."""
+    if message_ids is None:
+        message_condition = SQL("")
+    else:
+        message_condition = SQL("AND zerver_message.id = ANY(%(message_ids)s)")
+    query = SQL(
+        """
+        INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+        SELECT
+            zerver_subscription.user_profile_id,
+            zerver_message.id,
+            CASE
+                WHEN zerver_message.id <= zerver_subscription.fanout_read_message_id
+                THEN %(read_flag)s
+                ELSE 0
+            END
+        FROM zerver_subscription
+        JOIN zerver_message
+            ON zerver_message.recipient_id = zerver_subscription.recipient_id
+            AND zerver_message.id > zerver_subscription.fanout_start_message_id
+            {message_condition}
+        WHERE zerver_subscription.recipient_id = %(recipient_id)s
+            AND zerver_subscription.active
+        ON CONFLICT (user_profile_id, message_id) DO NOTHING
+        """
+    ).format(message_condition=message_condition)
+    with connection.cursor() as cursor:
+        cursor.execute(
+            query,
+            {
+                "recipient_id": stream.recipient_id,
+                "read_flag": int(UserMessage.flags.read),
+                "message_ids": message_ids,
+            },
+        )
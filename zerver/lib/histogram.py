@@ -0,0 +1,65 @@
+import bisect
+import math
+from typing import List, Mapping, Optional, Sequence
+
+
+def exponential_buckets(start: float, factor: float, count: int) -> List[float]:
+    return [start * factor ** i for i in range(count)]
+
+
+class Histogram:
+    """A histogram with fixed bucket boundaries, like Prometheus's, which
+    records an observation in constant time and memory.
+
+    With exponentially spaced boundaries, as in an HDR histogram, the
+    error of a percentile read from the histogram is proportional to
+    the value, across many orders of magnitude; with a factor of
+    sqrt(2) between boundaries, a percentile is overestimated by at
+    most 41%.
+    """
+
+    def __init__(self, bounds: Sequence[float]) -> None:
+        self.bounds = list(bounds)
+        # counts[i] is the number of observations in (bounds[i - 1],
+        # bounds[i]]; the last entry counts those above every bound.
+        self.counts = [0] * (len(self.bounds) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def percentile(self, fraction: float) -> Optional[float]:
+        """Returns the upper bound of the bucket containing the given
+        percentile, with fraction=0.99 for the 99th percentile, or the
+        largest bound if it is beyond all of them."""
+        if self.count == 0:
+            return None
+        rank = max(1, math.ceil(fraction * self.count))
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            if cumulative >= rank:
+                return bound
+        return self.bounds[-1]
+
+    def prometheus_text(self, name: str, help_text: str, labels: Mapping[str, str]) -> str:
+        """Formats the histogram in the Prometheus text exposition format,
+        which node_exporter's textfile collector can serve."""
+
+        def format_labels(extra_labels: Mapping[str, str] = {}) -> str:
+            all_labels = {**labels, **extra_labels}
+            return "{" + ",".join(f'{key}="{value}"' for key, value in all_labels.items()) + "}"
+
+        lines = [f"# HELP {name} {help_text}", f"# TYPE {name} histogram"]
+        cumulative = 0
+        for bound, count in zip(self.bounds, self.counts):
+            cumulative += count
+            le = f"{bound:g}"
+            lines.append(f"{name}_bucket{format_labels({'le': le})} {cumulative}")
+        lines.append(f"{name}_bucket{format_labels({'le': '+Inf'})} {self.count}")
+        lines.append(f"{name}_sum{format_labels()} {self.sum!r}")
+        lines.append(f"{name}_count{format_labels()} {self.count}")
+        return "\n".join(lines) + "\n"
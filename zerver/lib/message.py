@@ -25,6 +25,7 @@ from zerver.lib.cache import (
 )
 from zerver.lib.display_recipient import bulk_fetch_display_recipients
 from zerver.lib.exceptions import JsonableError, MissingAuthenticationError
+from zerver.lib.fanout_on_read import FanoutSubscription, fanout_messages_without_user_message
 from zerver.lib.markdown import MessageRenderingResult, markdown_convert, topic_links
 from zerver.lib.markdown import version as markdown_version
 from zerver.lib.mention import MentionData
@@ -966,20 +967,6 @@ def aggregate_message_dict(
     return [lookup_dict[k] for k in sorted_keys]
 
 
-def get_inactive_recipient_ids(user_profile: UserProfile) -> List[int]:
-    rows = (
-        get_stream_subscriptions_for_user(user_profile)
-        .filter(
-            active=False,
-        )
-        .values(
-            "recipient_id",
-        )
-    )
-    inactive_recipient_ids = [row["recipient_id"] for row in rows]
-    return inactive_recipient_ids
-
-
 def get_muted_stream_ids(user_profile: UserProfile) -> List[int]:
     rows = (
         get_stream_subscriptions_for_user(user_profile)
@@ -1011,7 +998,18 @@ def get_starred_message_ids(user_profile: UserProfile) -> List[int]:
 
 
 def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
-    excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
+    excluded_recipient_ids: List[int] = []
+    fanout_subscriptions: Dict[int, FanoutSubscription] = {}
+    sub_rows = get_stream_subscriptions_for_user(user_profile).values_list(
+        "recipient_id", "active", "fanout_start_message_id", "fanout_read_message_id"
+    )
+    for recipient_id, active, fanout_start_message_id, fanout_read_message_id in sub_rows:
+        if not active:
+            excluded_recipient_ids.append(recipient_id)
+        elif fanout_start_message_id is not None:
+            fanout_subscriptions[recipient_id] = FanoutSubscription(
+                recipient_id, fanout_start_message_id, fanout_read_message_id
+            )
 
     user_msgs = (
         UserMessage.objects.filter(
@@ -1038,6 +1036,33 @@ def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
     # Limit unread messages for performance reasons.
     user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
 
+    # Unread messages in fanout-on-read streams mostly don't have a
+    # UserMessage row; see zerver/lib/fanout_on_read.py.
+    if fanout_subscriptions:
+        fanout_msgs = (
+            fanout_messages_without_user_message(
+                user_profile, fanout_subscriptions.values(), unread_only=True
+            )
+            .values_list("id", "sender_id", TOPIC_NAME, "recipient_id", "recipient__type_id")
+            .order_by("-id")
+        )
+        user_msgs += [
+            {
+                "message_id": message_id,
+                "message__sender_id": sender_id,
+                MESSAGE__TOPIC: topic_name,
+                "message__recipient_id": recipient_id,
+                "message__recipient__type": Recipient.STREAM,
+                "message__recipient__type_id": stream_id,
+                "flags": 0,
+            }
+            for (message_id, sender_id, topic_name, recipient_id, stream_id) in fanout_msgs[
+                :MAX_UNREAD_MESSAGES
+            ]
+        ]
+        user_msgs.sort(key=lambda row: row["message_id"], reverse=True)
+        user_msgs = user_msgs[:MAX_UNREAD_MESSAGES]
+
     rows = list(reversed(user_msgs))
     return extract_unread_data_from_um_rows(rows, user_profile)
 
@@ -11,6 +11,7 @@ class OutgoingSession(requests.Session):
         timeout: int,
         headers: Optional[Dict[str, str]] = None,
         max_retries: Optional[Union[int, Retry]] = None,
+        pool_maxsize: int = requests.adapters.DEFAULT_POOLSIZE,
     ) -> None:
         super().__init__()
         retry: Optional[Retry] = Retry(total=0)
@@ -19,7 +20,9 @@ class OutgoingSession(requests.Session):
                 retry = max_retries
             else:
                 retry = Retry(total=max_retries, backoff_factor=1)
-        outgoing_adapter = OutgoingHTTPAdapter(role=role, timeout=timeout, max_retries=retry)
+        outgoing_adapter = OutgoingHTTPAdapter(
+            role=role, timeout=timeout, max_retries=retry, pool_maxsize=pool_maxsize
+        )
         self.mount("http://", outgoing_adapter)
         self.mount("https://", outgoing_adapter)
         if headers:
@@ -30,10 +33,16 @@ class OutgoingHTTPAdapter(requests.adapters.HTTPAdapter):
     role: str
     timeout: int
 
-    def __init__(self, role: str, timeout: int, max_retries: Optional[Retry]) -> None:
+    def __init__(
+        self,
+        role: str,
+        timeout: int,
+        max_retries: Optional[Retry],
+        pool_maxsize: int = requests.adapters.DEFAULT_POOLSIZE,
+    ) -> None:
         self.role = role
         self.timeout = timeout
-        super().__init__(max_retries=max_retries)
+        super().__init__(max_retries=max_retries, pool_maxsize=pool_maxsize)
 
     def send(self, *args: Any, **kwargs: Any) -> requests.Response:
         if kwargs.get("timeout") is None:
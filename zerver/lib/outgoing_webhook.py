@@ -1,7 +1,10 @@
 import abc
 import json
 import logging
-from time import perf_counter
+from functools import lru_cache
+from http.cookiejar import DefaultCookiePolicy
+from threading import Lock
+from time import monotonic, perf_counter
 from typing import Any, AnyStr, Dict, Optional
 
 import requests
@@ -28,16 +31,30 @@ from zerver.models import (
 )
 
 
+@lru_cache(None)
+def get_outgoing_webhook_session() -> requests.Session:
+    """All outgoing webhook requests share one session, so that
+    requests to a bot's server can reuse the persistent connections
+    in the session's per-host connection pools, rather than paying
+    for a new TCP and TLS handshake for every message."""
+    session = OutgoingSession(
+        role="webhook",
+        timeout=settings.OUTGOING_WEBHOOK_TIMEOUT_SECONDS,
+        headers={"User-Agent": "ZulipOutgoingWebhook/" + ZULIP_VERSION},
+        pool_maxsize=settings.OUTGOING_WEBHOOK_CONCURRENCY,
+    )
+    # Since the session is shared between bots, it must not keep
+    # cookies from one bot's server to send with another's requests.
+    session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+    return session
+
+
 class OutgoingWebhookServiceInterface(metaclass=abc.ABCMeta):
     def __init__(self, token: str, user_profile: UserProfile, service_name: str) -> None:
         self.token: str = token
         self.user_profile: UserProfile = user_profile
         self.service_name: str = service_name
-        self.session: requests.Session = OutgoingSession(
-            role="webhook",
-            timeout=10,
-            headers={"User-Agent": "ZulipOutgoingWebhook/" + ZULIP_VERSION},
-        )
+        self.session: requests.Session = get_outgoing_webhook_session()
 
     @abc.abstractmethod
     def make_request(
@@ -340,12 +357,74 @@ def process_success_response(
     send_response_message(bot_id=bot_id, message_info=message_info, response_data=response_data)
 
 
+class CircuitBreaker:
+    """Tracks the consecutive failed requests to each outgoing webhook
+    URL.  Once a URL has failed failure_threshold times in a row, we
+    stop sending it requests for reset_seconds; after that, we try
+    again, and the first failure stops them again, until a request
+    succeeds.  This keeps a bot server which is down from tying up
+    the OutgoingWebhookWorker with requests that will time out.
+
+    The worker's delivery threads share one of these, so all access
+    to its state is under a lock.
+    """
+
+    def __init__(self, failure_threshold: int, reset_seconds: float) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_seconds = reset_seconds
+        self.lock = Lock()
+        # maps URLs to their number of consecutive failed requests
+        self.failures: Dict[str, int] = {}
+        # maps URLs to the monotonic time until which we don't send them requests
+        self.open_until: Dict[str, float] = {}
+
+    def allow_request(self, url: str) -> bool:
+        with self.lock:
+            return monotonic() >= self.open_until.get(url, 0)
+
+    def record_success(self, url: str) -> None:
+        with self.lock:
+            self.failures.pop(url, None)
+            self.open_until.pop(url, None)
+
+    def record_failure(self, url: str) -> bool:
+        """Returns whether this failure newly stopped requests to the URL."""
+        with self.lock:
+            failures = self.failures.get(url, 0) + 1
+            self.failures[url] = failures
+            if failures < self.failure_threshold:
+                return False
+            self.open_until[url] = monotonic() + self.reset_seconds
+            return failures == self.failure_threshold
+
+
 def do_rest_call(
     base_url: str,
     event: Dict[str, Any],
     service_handler: OutgoingWebhookServiceInterface,
+    circuit_breaker: Optional[CircuitBreaker] = None,
 ) -> Optional[Response]:
     """Returns response of call if no exception occurs."""
+    if circuit_breaker is not None and not circuit_breaker.allow_request(base_url):
+        logging.info(
+            "Not sending trigger event %s to %s, since its recent requests have failed",
+            event["command"],
+            event["service_name"],
+        )
+        fail_with_message(event, "Bot is unavailable")
+        return None
+
+    def record_failure() -> None:
+        if circuit_breaker is not None and circuit_breaker.record_failure(base_url):
+            notify_bot_owner(
+                event,
+                failure_message=(
+                    f"The webhook has failed {circuit_breaker.failure_threshold} times in a row, "
+                    "so Zulip will not send it requests for the next "
+                    f"{circuit_breaker.reset_seconds:g} seconds."
+                ),
+            )
+
     try:
         start_time = perf_counter()
         bot_profile = service_handler.user_profile
@@ -363,6 +442,8 @@ def do_rest_call(
         if response is None:
             return None
         if str(response.status_code).startswith("2"):
+            if circuit_breaker is not None:
+                circuit_breaker.record_success(base_url)
             try:
                 process_success_response(event, service_handler, response)
             except JsonableError as e:
@@ -388,6 +469,7 @@ def do_rest_call(
             failure_message = f"Third party responded with {response.status_code}"
             fail_with_message(event, failure_message)
             notify_bot_owner(event, response.status_code, response.content)
+            record_failure()
         return response
     except requests.exceptions.Timeout:
         logging.info(
@@ -399,6 +481,7 @@ def do_rest_call(
             f"Request timed out after {settings.OUTGOING_WEBHOOK_TIMEOUT_SECONDS} seconds."
         )
         request_retry(event, failure_message=failure_message)
+        record_failure()
         return None
 
     except requests.exceptions.ConnectionError:
@@ -409,6 +492,7 @@ def do_rest_call(
         )
         failure_message = "A connection error occurred. Is my bot server down?"
         request_retry(event, failure_message=failure_message)
+        record_failure()
         return None
 
     except requests.exceptions.RequestException as e:
@@ -419,4 +503,5 @@ def do_rest_call(
         logging.exception("Outhook trigger failed:", stack_info=True)
         fail_with_message(event, response_message)
         notify_bot_owner(event, exception=e)
+        record_failure()
         return None
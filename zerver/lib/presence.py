@@ -6,9 +6,26 @@ from typing import Any, Dict, Mapping, Sequence, Set
 
 from django.utils.timezone import now as timezone_now
 
+from zerver.lib.cache import cache_get
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.models import PushDeviceToken, Realm, UserPresence, UserProfile, query_for_ids
 
+# Tornado marks the realms where it has clients with the
+# batched_presence capability in the cache, when a realm gets its
+# first such client, and refreshes the marks periodically, so that in
+# realms too large for immediate presence events, presence changes are
+# only sent to Tornado when someone will receive them.
+BATCHED_PRESENCE_REALM_CACHE_TIMEOUT = 5 * 60
+BATCHED_PRESENCE_REALM_REFRESH_FREQ_MSECS = 1000 * 60
+
+
+def batched_presence_realm_cache_key(realm_id: int) -> str:
+    return f"batched_presence_realm:{realm_id}"
+
+
+def realm_has_batched_presence_clients(realm_id: int) -> bool:
+    return cache_get(batched_presence_realm_cache_key(realm_id)) is not None
+
 
 def get_status_dicts_for_rows(
     all_rows: Sequence[Mapping[str, Any]], mobile_user_ids: Set[int], slim_presence: bool
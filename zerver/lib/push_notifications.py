@@ -4,9 +4,10 @@ import asyncio
 import base64
 import logging
 import re
+from collections import defaultdict
 from dataclasses import dataclass
 from functools import lru_cache
-from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Tuple, Type, Union
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Sequence, Set, Tuple, Type, Union
 
 import gcm
 import lxml.html
@@ -22,9 +23,14 @@ from zerver.decorator import statsd_increment
 from zerver.lib.avatar import absolute_avatar_url
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.message import access_message, bulk_access_messages_expect_usermessage, huddle_users
-from zerver.lib.remote_server import send_json_to_push_bouncer, send_to_push_bouncer
+from zerver.lib.remote_server import (
+    PushNotificationBouncerRetryLaterError,
+    send_json_to_push_bouncer,
+    send_to_push_bouncer,
+)
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.user_groups import access_user_group_by_id
+from zerver.lib.utils import statsd
 from zerver.models import (
     AbstractPushDeviceToken,
     ArchivedMessage,
@@ -135,7 +141,24 @@ def send_apple_push_notification(
     payload_data: Dict[str, Any],
     remote: Optional["RemoteZulipServer"] = None,
 ) -> None:
-    if not devices:
+    send_apple_push_notifications([(user_id, devices, payload_data)], remote)
+
+
+def send_apple_push_notifications(
+    notifications: Sequence[Tuple[int, Sequence[DeviceToken], Dict[str, Any]]],
+    remote: Optional["RemoteZulipServer"] = None,
+) -> None:
+    """Sends each (user_id, devices, payload_data) notification to its
+    devices.  The requests to APNs for all of the notifications are
+    in flight at once, over APNs' HTTP/2 connection, so that sending
+    a batch of notifications takes about one round trip, rather than
+    one per device."""
+    notifications = [
+        (user_id, devices, payload_data)
+        for (user_id, devices, payload_data) in notifications
+        if devices
+    ]
+    if not notifications:
         return
     # We lazily do the APNS imports as part of optimizing Zulip's base
     # import time; since these are only needed in the push
@@ -158,39 +181,57 @@ def send_apple_push_notification(
     else:
         DeviceTokenClass = PushDeviceToken
 
-    if remote:
-        logger.info(
-            "APNs: Sending notification for remote user %s:%d to %d devices",
-            remote.uuid,
-            user_id,
-            len(devices),
-        )
-    else:
-        logger.info(
-            "APNs: Sending notification for local user %d to %d devices", user_id, len(devices)
-        )
-    payload_data = modernize_apns_payload(payload_data).copy()
-    message = {**payload_data.pop("custom", {}), "aps": payload_data}
-    for device in devices:
-        # TODO obviously this should be made to actually use the async
-        request = aioapns.NotificationRequest(
-            device_token=device.token, message=message, time_to_live=24 * 3600
+    requests: List[Tuple[int, DeviceToken, "aioapns.NotificationRequest"]] = []
+    for user_id, devices, payload_data in notifications:
+        if remote:
+            logger.info(
+                "APNs: Sending notification for remote user %s:%d to %d devices",
+                remote.uuid,
+                user_id,
+                len(devices),
+            )
+        else:
+            logger.info(
+                "APNs: Sending notification for local user %d to %d devices",
+                user_id,
+                len(devices),
+            )
+        payload_data = modernize_apns_payload(payload_data).copy()
+        message = {**payload_data.pop("custom", {}), "aps": payload_data}
+        for device in devices:
+            request = aioapns.NotificationRequest(
+                device_token=device.token, message=message, time_to_live=24 * 3600
+            )
+            requests.append((user_id, device, request))
+
+    apns = apns_context.apns
+
+    async def send_requests() -> List[Any]:
+        return await asyncio.gather(
+            *(apns.send_notification(request) for (user_id, device, request) in requests),
+            return_exceptions=True,
         )
 
-        try:
-            result = apns_context.loop.run_until_complete(
-                apns_context.apns.send_notification(request)
-            )
-        except aioapns.exceptions.ConnectionError as e:
+    results = apns_context.loop.run_until_complete(send_requests())
+    for (user_id, device, request), result in zip(requests, results):
+        if isinstance(result, aioapns.exceptions.ConnectionError):
             logger.warning(
                 "APNs: ConnectionError sending for user %d to device %s: %s",
                 user_id,
                 device.token,
-                e.__class__.__name__,
+                result.__class__.__name__,
             )
-            continue
-
-        if result.is_successful:
+        elif isinstance(result, Exception):
+            # The other requests in the batch were sent independently.
+            logger.error(
+                "APNs: Error sending for user %d to device %s",
+                user_id,
+                device.token,
+                exc_info=result,
+            )
+        elif isinstance(result, BaseException):
+            raise result
+        elif result.is_successful:
             logger.info("APNs: Success sending for user %d to device %s", user_id, device.token)
         elif result.description in ["Unregistered", "BadDeviceToken", "DeviceTokenNotForTopic"]:
             logger.info(
@@ -938,6 +979,47 @@ def handle_remove_push_notification(user_profile_id: int, message_ids: List[int]
     ).update(flags=F("flags").bitand(~UserMessage.flags.active_mobile_push_notification))
 
 
+def get_message_payloads(
+    user_profile: UserProfile, message: Message, missed_message: Dict[str, Any]
+) -> Tuple[Dict[str, Any], Dict[str, Any], Dict[str, Any]]:
+    """The APNs payload, and GCM payload and options, for a
+    missed_message event."""
+    trigger = missed_message["trigger"]
+    mentioned_user_group_name = None
+    mentioned_user_group_id = missed_message.get("mentioned_user_group_id")
+
+    if mentioned_user_group_id is not None:
+        user_group = access_user_group_by_id(
+            mentioned_user_group_id, user_profile, for_mention=True
+        )
+        mentioned_user_group_name = user_group.name
+
+    apns_payload = get_message_payload_apns(
+        user_profile, message, trigger, mentioned_user_group_id, mentioned_user_group_name
+    )
+    gcm_payload, gcm_options = get_message_payload_gcm(
+        user_profile, message, trigger, mentioned_user_group_id, mentioned_user_group_name
+    )
+    return apns_payload, gcm_payload, gcm_options
+
+
+def send_message_notifications_to_bouncer(
+    user_profile_id: int,
+    apns_payload: Dict[str, Any],
+    gcm_payload: Dict[str, Any],
+    gcm_options: Dict[str, Any],
+) -> None:
+    total_android_devices, total_apple_devices = send_notifications_to_bouncer(
+        user_profile_id, apns_payload, gcm_payload, gcm_options
+    )
+    logger.info(
+        "Sent mobile push notifications for user %s through bouncer: %s via FCM devices, %s via APNs devices",
+        user_profile_id,
+        total_android_devices,
+        total_apple_devices,
+    )
+
+
 @statsd_increment("push_notifications")
 def handle_push_notification(user_profile_id: int, missed_message: Dict[str, Any]) -> None:
     """
@@ -996,34 +1078,15 @@ def handle_push_notification(user_profile_id: int, missed_message: Dict[str, Any
             )
             return
 
-    trigger = missed_message["trigger"]
-    mentioned_user_group_name = None
-    mentioned_user_group_id = missed_message.get("mentioned_user_group_id")
-
-    if mentioned_user_group_id is not None:
-        user_group = access_user_group_by_id(
-            mentioned_user_group_id, user_profile, for_mention=True
-        )
-        mentioned_user_group_name = user_group.name
-
-    apns_payload = get_message_payload_apns(
-        user_profile, message, trigger, mentioned_user_group_id, mentioned_user_group_name
-    )
-    gcm_payload, gcm_options = get_message_payload_gcm(
-        user_profile, message, trigger, mentioned_user_group_id, mentioned_user_group_name
+    apns_payload, gcm_payload, gcm_options = get_message_payloads(
+        user_profile, message, missed_message
     )
     logger.info("Sending push notifications to mobile clients for user %s", user_profile_id)
 
     if uses_notification_bouncer():
-        total_android_devices, total_apple_devices = send_notifications_to_bouncer(
+        send_message_notifications_to_bouncer(
             user_profile_id, apns_payload, gcm_payload, gcm_options
         )
-        logger.info(
-            "Sent mobile push notifications for user %s through bouncer: %s via FCM devices, %s via APNs devices",
-            user_profile_id,
-            total_android_devices,
-            total_apple_devices,
-        )
         return
 
     android_devices = list(
@@ -1042,3 +1105,137 @@ def handle_push_notification(user_profile_id: int, missed_message: Dict[str, Any
     )
     send_apple_push_notification(user_profile.id, apple_devices, apns_payload)
     send_android_push_notification(user_profile.id, android_devices, gcm_payload, gcm_options)
+
+
+def log_push_notification_error(missed_message: Dict[str, Any]) -> None:
+    # A notification which we fail to send is dropped, like a failed
+    # event in a QueueProcessingWorker, without affecting the rest of
+    # its batch.
+    logger.exception(
+        "Error sending push notification for user %s, message %s",
+        missed_message["user_profile_id"],
+        missed_message["message_id"],
+        stack_info=True,
+    )
+
+
+def handle_push_notifications(missed_messages: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Equivalent to calling handle_push_notification for each of a
+    batch of missed_message events, but with a few queries for the
+    whole batch, rather than several for each event, and with all of
+    the batch's APNs requests sent at once.  A message sent to a busy
+    stream queues a push notification for each of its recipients
+    with mobile devices, so this is what lets the
+    PushNotificationsWorker keep up with such bursts.
+
+    Returns the events which the push notification bouncer has asked
+    us to retry later.
+    """
+    if not push_notifications_enabled():
+        return []
+
+    user_profiles = UserProfile.objects.select_related("realm").in_bulk(
+        {missed_message["user_profile_id"] for missed_message in missed_messages}
+    )
+    messages = Message.objects.select_related("sender", "recipient").in_bulk(
+        {missed_message["message_id"] for missed_message in missed_messages}
+    )
+    user_messages = {
+        (user_message.user_profile_id, user_message.message_id): user_message
+        for user_message in UserMessage.objects.filter(
+            user_profile_id__in=user_profiles.keys(), message_id__in=messages.keys()
+        ).only("id", "user_profile_id", "message_id", "flags")
+    }
+
+    retry_events: List[Dict[str, Any]] = []
+    notifications: List[
+        Tuple[Dict[str, Any], UserProfile, Dict[str, Any], Dict[str, Any], Dict[str, Any]]
+    ] = []
+    notified_user_message_ids: Set[int] = set()
+    for missed_message in missed_messages:
+        user_profile_id = missed_message["user_profile_id"]
+        message_id = missed_message["message_id"]
+        user_profile = user_profiles.get(user_profile_id)
+        message = messages.get(message_id)
+        user_message = user_messages.get((user_profile_id, message_id))
+        if user_profile is None or message is None or user_message is None:
+            # Messages which were deleted, or which a long-term idle
+            # user never received, are rare; handle_push_notification
+            # takes care of them, and of logging anything unexpected.
+            try:
+                handle_push_notification(user_profile_id, missed_message)
+            except PushNotificationBouncerRetryLaterError:
+                retry_events.append(missed_message)
+            except Exception:
+                log_push_notification_error(missed_message)
+            continue
+
+        if user_profile.is_bot or not (
+            user_profile.enable_offline_push_notifications
+            or user_profile.enable_online_push_notifications
+        ):
+            # BUG: See the corresponding checks in handle_push_notification.
+            continue  # nocoverage
+
+        if (
+            user_message.flags.read
+            or user_message.flags.active_mobile_push_notification
+            or user_message.id in notified_user_message_ids
+        ):
+            continue
+
+        try:
+            apns_payload, gcm_payload, gcm_options = get_message_payloads(
+                user_profile, message, missed_message
+            )
+        except Exception:
+            log_push_notification_error(missed_message)
+            continue
+        notified_user_message_ids.add(user_message.id)
+        notifications.append((missed_message, user_profile, apns_payload, gcm_payload, gcm_options))
+
+    # Mark the messages as having active mobile push notifications,
+    # so that we can send revocation messages later.
+    UserMessage.objects.filter(id__in=notified_user_message_ids).update(
+        flags=F("flags").bitor(UserMessage.flags.active_mobile_push_notification)
+    )
+    statsd.incr("push_notifications", len(missed_messages))
+
+    if uses_notification_bouncer():
+        for missed_message, user_profile, apns_payload, gcm_payload, gcm_options in notifications:
+            logger.info("Sending push notifications to mobile clients for user %s", user_profile.id)
+            try:
+                send_message_notifications_to_bouncer(
+                    user_profile.id, apns_payload, gcm_payload, gcm_options
+                )
+            except PushNotificationBouncerRetryLaterError:
+                retry_events.append(missed_message)
+            except Exception:
+                log_push_notification_error(missed_message)
+        return retry_events
+
+    devices: Dict[Tuple[int, int], List[PushDeviceToken]] = defaultdict(list)
+    for device in PushDeviceToken.objects.filter(
+        user_id__in={notification[1].id for notification in notifications}
+    ):
+        devices[(device.user_id, device.kind)].append(device)
+
+    apple_notifications: List[Tuple[int, Sequence[DeviceToken], Dict[str, Any]]] = []
+    for missed_message, user_profile, apns_payload, gcm_payload, gcm_options in notifications:
+        android_devices = devices[(user_profile.id, PushDeviceToken.GCM)]
+        apple_devices = devices[(user_profile.id, PushDeviceToken.APNS)]
+        logger.info(
+            "Sending mobile push notifications for local user %s: %s via FCM devices, %s via APNs devices",
+            user_profile.id,
+            len(android_devices),
+            len(apple_devices),
+        )
+        apple_notifications.append((user_profile.id, apple_devices, apns_payload))
+        try:
+            send_android_push_notification(
+                user_profile.id, android_devices, gcm_payload, gcm_options
+            )
+        except Exception:
+            log_push_notification_error(missed_message)
+    send_apple_push_notifications(apple_notifications)
+    return retry_events
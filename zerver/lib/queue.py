@@ -4,7 +4,21 @@ import threading
 import time
 from abc import ABCMeta, abstractmethod
 from collections import defaultdict
-from typing import Any, Callable, Dict, Generic, List, Mapping, Optional, Set, TypeVar, Union
+from contextlib import contextmanager
+from typing import (
+    Any,
+    Callable,
+    Dict,
+    Generic,
+    Iterator,
+    List,
+    Mapping,
+    Optional,
+    Sequence,
+    Set,
+    TypeVar,
+    Union,
+)
 
 import orjson
 import pika
@@ -23,6 +37,13 @@ MAX_REQUEST_RETRIES = 3
 ChannelT = TypeVar("ChannelT", Channel, BlockingChannel)
 Consumer = Callable[[ChannelT, Basic.Deliver, pika.BasicProperties, bytes], None]
 
+
+def publish_properties() -> pika.BasicProperties:
+    # The publish time lets consumers measure how long events waited
+    # in the queue; the AMQP timestamp property only has 1s precision.
+    return pika.BasicProperties(delivery_mode=2, headers={"published_at": time.time()})
+
+
 # This simple queuing library doesn't expose much of the power of
 # rabbitmq/pika's queuing system; its purpose is to just provide an
 # interface for external files to put things into queues and take them
@@ -114,7 +135,7 @@ class QueueClient(Generic[ChannelT], metaclass=ABCMeta):
             channel.basic_publish(
                 exchange="",
                 routing_key=queue_name,
-                properties=pika.BasicProperties(delivery_mode=2),
+                properties=publish_properties(),
                 body=body,
             )
 
@@ -122,6 +143,10 @@ class QueueClient(Generic[ChannelT], metaclass=ABCMeta):
 
         self.ensure_queue(queue_name, do_publish)
 
+    def publish_many(self, queue_name: str, bodies: Sequence[bytes]) -> None:
+        for body in bodies:
+            self.publish(queue_name, body)
+
     def json_publish(self, queue_name: str, body: Mapping[str, Any]) -> None:
         data = orjson.dumps(body)
         try:
@@ -133,14 +158,28 @@ class QueueClient(Generic[ChannelT], metaclass=ABCMeta):
         self._reconnect()
         self.publish(queue_name, data)
 
+    def json_publish_many(self, queue_name: str, bodies: Sequence[Mapping[str, Any]]) -> None:
+        data = [orjson.dumps(body) for body in bodies]
+        try:
+            self.publish_many(queue_name, data)
+            return
+        except pika.exceptions.AMQPConnectionError:
+            self.log.warning("Failed to send to rabbitmq, trying to reconnect and send again")
+
+        self._reconnect()
+        self.publish_many(queue_name, data)
+
 
 class SimpleQueueClient(QueueClient[BlockingChannel]):
     connection: Optional[pika.BlockingConnection]
+    # A second channel, in transactional mode, used by publish_many.
+    batch_channel: Optional[BlockingChannel]
 
     def _connect(self) -> None:
         start = time.time()
         self.connection = pika.BlockingConnection(self._get_parameters())
         self.channel = self.connection.channel()
+        self.batch_channel = None
         self.log.info(f"SimpleQueueClient connected (connecting took {time.time() - start:.3f}s)")
 
     def _reconnect(self) -> None:
@@ -168,18 +207,51 @@ class SimpleQueueClient(QueueClient[BlockingChannel]):
 
         callback(self.channel)
 
+    def publish_many(self, queue_name: str, bodies: Sequence[bytes]) -> None:
+        """Publishes the messages in a single AMQP transaction, whose
+        commit returns only once the broker has taken responsibility
+        for all of them.  This gives the same guarantee as publisher
+        confirms, but BlockingChannel waits for the confirm of each
+        message in turn, while a transaction costs one round trip for
+        the whole batch.  If the commit fails, none of the messages
+        were delivered, so the batch can simply be sent again."""
+
+        def do_publish(channel: BlockingChannel) -> None:
+            if self.batch_channel is None or not self.batch_channel.is_open:
+                assert self.connection is not None
+                self.batch_channel = self.connection.channel()
+                self.batch_channel.tx_select()
+
+            for body in bodies:
+                self.batch_channel.basic_publish(
+                    exchange="",
+                    routing_key=queue_name,
+                    properties=publish_properties(),
+                    body=body,
+                )
+            self.batch_channel.tx_commit()
+
+            statsd.incr(f"rabbitmq.publish.{queue_name}", len(bodies))
+
+        self.ensure_queue(queue_name, do_publish)
+
     def start_json_consumer(
         self,
         queue_name: str,
         callback: Callable[[List[Dict[str, Any]]], None],
         batch_size: int = 1,
         timeout: Optional[int] = None,
+        lag_callback: Optional[Callable[[List[float]], None]] = None,
     ) -> None:
+        """If lag_callback is passed, it is called before each batch with
+        the number of seconds that each of its events, if published
+        with a timestamp, waited in the queue."""
         if batch_size == 1:
             timeout = None
 
         def do_consume(channel: BlockingChannel) -> None:
             events: List[Dict[str, Any]] = []
+            published_times: List[float] = []
             last_process = time.time()
             max_processed: Optional[int] = None
             self.is_consuming = True
@@ -195,10 +267,16 @@ class SimpleQueueClient(QueueClient[BlockingChannel]):
                     assert method is not None
                     events.append(orjson.loads(body))
                     max_processed = method.delivery_tag
+                    headers = properties.headers if properties is not None else None
+                    if headers and "published_at" in headers:
+                        published_times.append(headers["published_at"])
                 now = time.time()
                 if len(events) >= batch_size or (timeout and now >= last_process + timeout):
                     if events:
                         assert max_processed is not None
+                        if lag_callback is not None:
+                            lag_callback([now - published for published in published_times])
+                        published_times = []
                         try:
                             callback(events)
                             channel.basic_ack(max_processed, multiple=True)
@@ -416,6 +494,14 @@ def get_queue_client() -> Union[SimpleQueueClient, TornadoQueueClient]:
 # randomly close.
 queue_lock = threading.RLock()
 
+# The events buffered by batched_queue_publish, per queue, when this
+# thread is inside such a block.
+publish_buffer = threading.local()
+
+
+def get_publish_buffer() -> Optional[Dict[str, List[Dict[str, Any]]]]:
+    return getattr(publish_buffer, "events", None)
+
 
 def queue_json_publish(
     queue_name: str,
@@ -424,7 +510,11 @@ def queue_json_publish(
 ) -> None:
     with queue_lock:
         if settings.USING_RABBITMQ:
-            get_queue_client().json_publish(queue_name, event)
+            buffered_events = get_publish_buffer()
+            if buffered_events is not None:
+                buffered_events[queue_name].append(event)
+            else:
+                get_queue_client().json_publish(queue_name, event)
         elif processor:
             processor(event)
         else:
@@ -434,6 +524,47 @@ def queue_json_publish(
             get_worker(queue_name).consume_single_event(event)
 
 
+def queue_json_publish_many(
+    queue_name: str,
+    events: Sequence[Dict[str, Any]],
+    processor: Optional[Callable[[Any], None]] = None,
+) -> None:
+    """Like calling queue_json_publish for each event, but with RabbitMQ,
+    sends all of the events to the broker in one batch."""
+    if len(events) == 0:
+        return
+    with queue_lock:
+        if settings.USING_RABBITMQ:
+            buffered_events = get_publish_buffer()
+            if buffered_events is not None:
+                buffered_events[queue_name].extend(events)
+            else:
+                get_queue_client().json_publish_many(queue_name, events)
+        else:
+            for event in events:
+                queue_json_publish(queue_name, event, processor)
+
+
+@contextmanager
+def batched_queue_publish() -> Iterator[None]:
+    """Within this block, the events that this thread publishes to
+    RabbitMQ are buffered, and then sent with one batch per queue when
+    the outermost such block exits.  Without RabbitMQ, events are
+    processed immediately, as usual."""
+    if get_publish_buffer() is not None:
+        yield
+        return
+
+    publish_buffer.events = defaultdict(list)
+    try:
+        yield
+    finally:
+        buffered_events = publish_buffer.events
+        publish_buffer.events = None
+        for queue_name, events in buffered_events.items():
+            queue_json_publish_many(queue_name, events)
+
+
 def retry_event(
     queue_name: str, event: Dict[str, Any], failure_processor: Callable[[Dict[str, Any]], None]
 ) -> None:
@@ -35,16 +35,17 @@ class RateLimitedObject(ABC):
         else:
             self.backend = RedisRateLimiterBackend
 
-    def rate_limit(self) -> Tuple[bool, float]:
-        # Returns (ratelimited, secs_to_freedom)
+    def rate_limit(self, weight: int = 1) -> Tuple[bool, float]:
+        # Returns (ratelimited, secs_to_freedom).  A weight greater
+        # than 1 counts this as that many API calls, all or none.
         return self.backend.rate_limit_entity(
-            self.key(), self.get_rules(), self.max_api_calls(), self.max_api_window()
+            self.key(), self.get_rules(), self.max_api_calls(), self.max_api_window(), weight
         )
 
-    def rate_limit_request(self, request: HttpRequest) -> None:
+    def rate_limit_request(self, request: HttpRequest, weight: int = 1) -> None:
         from zerver.lib.request import RequestNotes
 
-        ratelimited, time = self.rate_limit()
+        ratelimited, time = self.rate_limit(weight)
         request_notes = RequestNotes.get_notes(request)
 
         request_notes.ratelimits_applied.append(
@@ -203,7 +204,12 @@ class RateLimiterBackend(ABC):
     @classmethod
     @abstractmethod
     def rate_limit_entity(
-        cls, entity_key: str, rules: List[Tuple[int, int]], max_api_calls: int, max_api_window: int
+        cls,
+        entity_key: str,
+        rules: List[Tuple[int, int]],
+        max_api_calls: int,
+        max_api_window: int,
+        weight: int = 1,
     ) -> Tuple[bool, float]:
         # Returns (ratelimited, secs_to_freedom)
         pass
@@ -242,9 +248,12 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
             del cls.reset_times[(time_window, max_count)]
 
     @classmethod
-    def need_to_limit(cls, entity_key: str, time_window: int, max_count: int) -> Tuple[bool, float]:
+    def need_to_limit(
+        cls, entity_key: str, time_window: int, max_count: int, weight: int = 1
+    ) -> Tuple[bool, float]:
         """
-        Returns a tuple of `(rate_limited, time_till_free)`.
+        Returns a tuple of `(rate_limited, time_till_free)`, for a
+        request counted as `weight` requests.
         For simplicity, we have loosened the semantics here from
         - each key may make atmost `count * (t / window)` request within any t
           time interval.
@@ -264,7 +273,9 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
             cls._garbage_collect_for_rule(now, time_window, max_count)
 
         reset_times_for_rule = cls.reset_times.setdefault((time_window, max_count), {})
-        new_reset = max(reset_times_for_rule.get(entity_key, now), now) + time_window / max_count
+        new_reset = (
+            max(reset_times_for_rule.get(entity_key, now), now) + weight * time_window / max_count
+        )
 
         if new_reset > now + time_window:
             # Compute for how long the bucket will remain filled.
@@ -306,7 +317,12 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
 
     @classmethod
     def rate_limit_entity(
-        cls, entity_key: str, rules: List[Tuple[int, int]], max_api_calls: int, max_api_window: int
+        cls,
+        entity_key: str,
+        rules: List[Tuple[int, int]],
+        max_api_calls: int,
+        max_api_window: int,
+        weight: int = 1,
     ) -> Tuple[bool, float]:
         now = time.time()
         if entity_key in cls.timestamps_blocked_until:
@@ -319,7 +335,9 @@ class TornadoInMemoryRateLimiterBackend(RateLimiterBackend):
 
         assert rules
         for time_window, max_count in rules:
-            ratelimited, time_till_free = cls.need_to_limit(entity_key, time_window, max_count)
+            ratelimited, time_till_free = cls.need_to_limit(
+                entity_key, time_window, max_count, weight
+            )
 
             if ratelimited:
                 statsd.incr(f"ratelimiter.limited.{entity_key}")
@@ -385,17 +403,25 @@ class RedisRateLimiterBackend(RateLimiterBackend):
         return calls_left, time_reset - now
 
     @classmethod
-    def is_ratelimited(cls, entity_key: str, rules: List[Tuple[int, int]]) -> Tuple[bool, float]:
+    def is_ratelimited(
+        cls, entity_key: str, rules: List[Tuple[int, int]], weight: int = 1
+    ) -> Tuple[bool, float]:
         "Returns a tuple of (rate_limited, time_till_free)"
         assert rules
         list_key, set_key, blocking_key = cls.get_keys(entity_key)
 
+        for range_seconds, num_requests in rules:
+            if weight > num_requests:
+                # No amount of waiting will allow this request.
+                return True, range_seconds
+
         # Go through the rules from shortest to longest,
         # seeing if this user has violated any of them. First
-        # get the timestamps for each nth items
+        # get the timestamps for each nth items, where n leaves
+        # room for this request's weight
         with client.pipeline() as pipe:
             for _, request_count in rules:
-                pipe.lindex(list_key, request_count - 1)  # 0-indexed list
+                pipe.lindex(list_key, request_count - weight)  # 0-indexed list
 
             # Get blocking info
             pipe.get(blocking_key)
@@ -430,10 +456,16 @@ class RedisRateLimiterBackend(RateLimiterBackend):
         return False, 0.0
 
     @classmethod
-    def incr_ratelimit(cls, entity_key: str, max_api_calls: int, max_api_window: int) -> None:
-        """Increases the rate-limit for the specified entity"""
+    def incr_ratelimit(
+        cls, entity_key: str, max_api_calls: int, max_api_window: int, weight: int = 1
+    ) -> None:
+        """Increases the rate-limit for the specified entity, by `weight` calls"""
         list_key, set_key, _ = cls.get_keys(entity_key)
         now = time.time()
+        # Each call needs a distinct value, since they are also members
+        # of our sorted set; we space a weighted call's timestamps a
+        # microsecond apart, ending at now.
+        timestamps = [now - (weight - 1 - i) / 1000000 for i in range(weight)]
 
         # Start Redis transaction
         with client.pipeline() as pipe:
@@ -446,28 +478,29 @@ class RedisRateLimiterBackend(RateLimiterBackend):
                     # When watching a value, the pipeline is set to Immediate mode
                     pipe.watch(list_key)
 
-                    # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                    last_val = cast(  # mypy doesn’t know the pipe is in immediate mode
-                        Optional[bytes], pipe.lindex(list_key, max_api_calls - 1)
+                    # Get the last elems that we'll trim (so we can remove them from our sorted set)
+                    last_vals = cast(  # mypy doesn’t know the pipe is in immediate mode
+                        List[bytes],
+                        pipe.lrange(list_key, max(max_api_calls - weight, 0), max_api_calls - 1),
                     )
 
                     # Restart buffered execution
                     pipe.multi()
 
-                    # Add this timestamp to our list
-                    pipe.lpush(list_key, now)
+                    # Add these timestamps to our list, newest first
+                    pipe.lpush(list_key, *timestamps)
 
                     # Trim our list to the oldest rule we have
                     pipe.ltrim(list_key, 0, max_api_calls - 1)
 
-                    # Add our new value to the sorted set that we keep
+                    # Add our new values to the sorted set that we keep
                     # We need to put the score and val both as timestamp,
                     # as we sort by score but remove by value
-                    pipe.zadd(set_key, {str(now): now})
+                    pipe.zadd(set_key, {str(timestamp): timestamp for timestamp in timestamps})
 
-                    # Remove the trimmed value from our sorted set, if there was one
-                    if last_val is not None:
-                        pipe.zrem(set_key, last_val)
+                    # Remove the trimmed values from our sorted set, if there were any
+                    if last_vals:
+                        pipe.zrem(set_key, *last_vals)
 
                     # Set the TTL for our keys as well
                     api_window = max_api_window
@@ -487,16 +520,21 @@ class RedisRateLimiterBackend(RateLimiterBackend):
 
     @classmethod
     def rate_limit_entity(
-        cls, entity_key: str, rules: List[Tuple[int, int]], max_api_calls: int, max_api_window: int
+        cls,
+        entity_key: str,
+        rules: List[Tuple[int, int]],
+        max_api_calls: int,
+        max_api_window: int,
+        weight: int = 1,
     ) -> Tuple[bool, float]:
-        ratelimited, time = cls.is_ratelimited(entity_key, rules)
+        ratelimited, time = cls.is_ratelimited(entity_key, rules, weight)
 
         if ratelimited:
             statsd.incr(f"ratelimiter.limited.{entity_key}")
 
         else:
             try:
-                cls.incr_ratelimit(entity_key, max_api_calls, max_api_window)
+                cls.incr_ratelimit(entity_key, max_api_calls, max_api_window, weight)
             except RateLimiterLockingException:
                 logger.warning("Deadlock trying to incr_ratelimit for %s", entity_key)
                 # rate-limit users who are hitting the API so hard we can't update our stats.
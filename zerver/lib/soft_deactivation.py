@@ -147,9 +147,13 @@ def add_missing_messages(user_profile: UserProfile) -> None:
 
     """
     assert user_profile.last_active_message_id is not None
+    # Messages in fanout-on-read streams never need UserMessage rows
+    # with zero flags; see zerver/lib/fanout_on_read.py.
     all_stream_subs = list(
         Subscription.objects.filter(
-            user_profile=user_profile, recipient__type=Recipient.STREAM
+            user_profile=user_profile,
+            recipient__type=Recipient.STREAM,
+            fanout_start_message_id__isnull=True,
         ).values("recipient_id", "recipient__type_id")
     )
 
@@ -1,11 +1,22 @@
+import array
 import itertools
+import secrets
 from collections import defaultdict
 from dataclasses import dataclass
 from operator import itemgetter
-from typing import AbstractSet, Any, Dict, List, Optional, Set
+from typing import AbstractSet, Any, ClassVar, Dict, List, Optional, Set
 
 from django.db.models import Q, QuerySet
 
+from zerver.lib.cache import (
+    cache_get,
+    cache_get_many,
+    cache_set,
+    cache_set_many,
+    realm_recipients_version_cache_key,
+    stream_recipients_cache_key,
+    stream_recipients_version_cache_key,
+)
 from zerver.models import AlertWord, Realm, Recipient, Stream, Subscription, UserProfile
 
 
@@ -341,3 +352,174 @@ def get_subscriptions_for_send_message(
         )
     )
     return query
+
+
+@dataclass
+class StreamRecipientSnapshot:
+    """The active subscribers of a stream, with the subscription and
+    user settings that get_recipient_info needs to send a message to
+    it.  This is stored compactly, as one integer of flags per
+    subscriber, so that the snapshot for a stream with tens of
+    thousands of subscribers fits in a single memcached item."""
+
+    # The notification flags combine the stream-level setting with the
+    # user's default, but ignore whether the stream is muted.
+    PUSH_NOTIFICATIONS: ClassVar[int] = 1 << 0
+    EMAIL_NOTIFICATIONS: ClassVar[int] = 1 << 1
+    WILDCARD_MENTIONS_NOTIFY: ClassVar[int] = 1 << 2
+    IS_MUTED: ClassVar[int] = 1 << 3
+    LONG_TERM_IDLE: ClassVar[int] = 1 << 4
+    HAS_ALERT_WORDS: ClassVar[int] = 1 << 5
+    ENABLE_ONLINE_PUSH_NOTIFICATIONS: ClassVar[int] = 1 << 6
+    ENABLE_OFFLINE_EMAIL_NOTIFICATIONS: ClassVar[int] = 1 << 7
+    ENABLE_OFFLINE_PUSH_NOTIFICATIONS: ClassVar[int] = 1 << 8
+
+    user_ids: "array.array[int]"
+    flags: "array.array[int]"
+    # The bot_type of each subscriber who is a bot.
+    bot_types: Dict[int, int]
+
+    def get_rows_for_send_message(
+        self,
+        *,
+        possible_wildcard_mention: bool,
+        possibly_mentioned_user_ids: AbstractSet[int],
+    ) -> List[Dict[str, Any]]:
+        """Returns a row for each subscriber that
+        get_subscriptions_for_send_message would return, with the
+        fields of both the Subscription and the UserProfile that
+        get_recipient_info uses."""
+        may_need_idle_user = (
+            self.PUSH_NOTIFICATIONS | self.EMAIL_NOTIFICATIONS | self.HAS_ALERT_WORDS
+        )
+        rows = []
+        for user_id, flags in zip(self.user_ids, self.flags):
+            if (
+                flags & self.LONG_TERM_IDLE
+                and not possible_wildcard_mention
+                and not flags & may_need_idle_user
+                and user_id not in possibly_mentioned_user_ids
+            ):
+                continue
+            bot_type = self.bot_types.get(user_id)
+            rows.append(
+                dict(
+                    id=user_id,
+                    is_muted=bool(flags & self.IS_MUTED),
+                    push_notifications=bool(flags & self.PUSH_NOTIFICATIONS),
+                    email_notifications=bool(flags & self.EMAIL_NOTIFICATIONS),
+                    wildcard_mentions_notify=bool(flags & self.WILDCARD_MENTIONS_NOTIFY),
+                    enable_online_push_notifications=bool(
+                        flags & self.ENABLE_ONLINE_PUSH_NOTIFICATIONS
+                    ),
+                    enable_offline_email_notifications=bool(
+                        flags & self.ENABLE_OFFLINE_EMAIL_NOTIFICATIONS
+                    ),
+                    enable_offline_push_notifications=bool(
+                        flags & self.ENABLE_OFFLINE_PUSH_NOTIFICATIONS
+                    ),
+                    is_bot=bot_type is not None,
+                    bot_type=bot_type,
+                    long_term_idle=bool(flags & self.LONG_TERM_IDLE),
+                )
+            )
+        return rows
+
+
+def fetch_stream_recipient_snapshot(*, realm_id: int, recipient_id: int) -> StreamRecipientSnapshot:
+    alert_word_user_ids = set(
+        AlertWord.objects.filter(realm_id=realm_id).values_list("user_profile_id", flat=True)
+    )
+    rows = (
+        Subscription.objects.filter(
+            recipient_id=recipient_id,
+            active=True,
+            is_user_active=True,
+        )
+        .values(
+            "user_profile_id",
+            "is_muted",
+            "push_notifications",
+            "email_notifications",
+            "wildcard_mentions_notify",
+            "user_profile__enable_stream_push_notifications",
+            "user_profile__enable_stream_email_notifications",
+            "user_profile__wildcard_mentions_notify",
+            "user_profile__long_term_idle",
+            "user_profile__enable_online_push_notifications",
+            "user_profile__enable_offline_email_notifications",
+            "user_profile__enable_offline_push_notifications",
+            "user_profile__is_bot",
+            "user_profile__bot_type",
+        )
+        .order_by("user_profile_id")
+    )
+
+    def setting(row: Dict[str, Any], name: str) -> bool:
+        # The UserProfile stream notification settings are defaults,
+        # which can be overridden by the stream-level settings (if
+        # those values are not null).
+        if row[name] is not None:
+            return row[name]
+        return row["user_profile__" + name]
+
+    snapshot = StreamRecipientSnapshot(
+        user_ids=array.array("i"), flags=array.array("H"), bot_types={}
+    )
+    for row in rows:
+        user_id = row["user_profile_id"]
+        flag_values = [
+            (StreamRecipientSnapshot.PUSH_NOTIFICATIONS, setting(row, "push_notifications")),
+            (StreamRecipientSnapshot.EMAIL_NOTIFICATIONS, setting(row, "email_notifications")),
+            (
+                StreamRecipientSnapshot.WILDCARD_MENTIONS_NOTIFY,
+                setting(row, "wildcard_mentions_notify"),
+            ),
+            (StreamRecipientSnapshot.IS_MUTED, row["is_muted"]),
+            (StreamRecipientSnapshot.LONG_TERM_IDLE, row["user_profile__long_term_idle"]),
+            (StreamRecipientSnapshot.HAS_ALERT_WORDS, user_id in alert_word_user_ids),
+            (
+                StreamRecipientSnapshot.ENABLE_ONLINE_PUSH_NOTIFICATIONS,
+                row["user_profile__enable_online_push_notifications"],
+            ),
+            (
+                StreamRecipientSnapshot.ENABLE_OFFLINE_EMAIL_NOTIFICATIONS,
+                row["user_profile__enable_offline_email_notifications"],
+            ),
+            (
+                StreamRecipientSnapshot.ENABLE_OFFLINE_PUSH_NOTIFICATIONS,
+                row["user_profile__enable_offline_push_notifications"],
+            ),
+        ]
+        snapshot.user_ids.append(user_id)
+        snapshot.flags.append(sum(flag for (flag, value) in flag_values if value))
+        if row["user_profile__is_bot"]:
+            snapshot.bot_types[user_id] = row["user_profile__bot_type"]
+    return snapshot
+
+
+def get_stream_recipient_snapshot(*, realm_id: int, recipient_id: int) -> StreamRecipientSnapshot:
+    """Returns the StreamRecipientSnapshot for a stream from the cache,
+    if we have one for the current versions of the stream and realm;
+    see stream_recipients_version_cache_key for how those change."""
+    stream_version_key = stream_recipients_version_cache_key(recipient_id)
+    realm_version_key = realm_recipients_version_cache_key(realm_id)
+    version_keys = [stream_version_key, realm_version_key]
+    versions = cache_get_many(version_keys)
+    new_versions = {key: secrets.token_hex(8) for key in version_keys if key not in versions}
+    if new_versions:
+        # This must happen before we query the database, so that a
+        # concurrent change to the subscriptions, which will bump the
+        # version again after it commits, can't be missed.
+        cache_set_many(new_versions)
+        versions.update(new_versions)
+
+    key = stream_recipients_cache_key(
+        recipient_id, versions[stream_version_key], versions[realm_version_key]
+    )
+    cached = cache_get(key)
+    if cached is not None:
+        return cached[0]
+    snapshot = fetch_stream_recipient_snapshot(realm_id=realm_id, recipient_id=recipient_id)
+    cache_set(key, snapshot, timeout=3600)
+    return snapshot
@@ -781,14 +781,17 @@ Output:
         recipient_list = [to_user.id]
         (sending_client, _) = Client.objects.get_or_create(name=sending_client_name)
 
-        return check_send_message(
-            from_user,
-            sending_client,
-            "private",
-            recipient_list,
-            None,
-            content,
-        )
+        # Run the message's on-commit side effects, such as triggering
+        # service bots; see do_send_messages.
+        with self.captureOnCommitCallbacks(execute=True):
+            return check_send_message(
+                from_user,
+                sending_client,
+                "private",
+                recipient_list,
+                None,
+                content,
+            )
 
     def send_huddle_message(
         self,
@@ -802,14 +805,15 @@ Output:
 
         (sending_client, _) = Client.objects.get_or_create(name=sending_client_name)
 
-        return check_send_message(
-            from_user,
-            sending_client,
-            "private",
-            to_user_ids,
-            None,
-            content,
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            return check_send_message(
+                from_user,
+                sending_client,
+                "private",
+                to_user_ids,
+                None,
+                content,
+            )
 
     def send_stream_message(
         self,
@@ -823,14 +827,15 @@ Output:
     ) -> int:
         (sending_client, _) = Client.objects.get_or_create(name=sending_client_name)
 
-        message_id = check_send_stream_message(
-            sender=sender,
-            client=sending_client,
-            stream_name=stream_name,
-            topic=topic_name,
-            body=content,
-            realm=recipient_realm,
-        )
+        with self.captureOnCommitCallbacks(execute=True):
+            message_id = check_send_stream_message(
+                sender=sender,
+                client=sending_client,
+                stream_name=stream_name,
+                topic=topic_name,
+                body=content,
+                realm=recipient_realm,
+            )
         if not UserMessage.objects.filter(user_profile=sender, message_id=message_id).exists():
             if not sender.is_bot and not allow_unsubscribed_sender:
                 raise AssertionError(
@@ -1,6 +1,6 @@
 import re
 from typing import Any, Callable, Dict, Match, Optional
-from urllib.parse import urljoin
+from urllib.parse import urljoin, urlsplit
 
 import magic
 import requests
@@ -8,7 +8,14 @@ from django.conf import settings
 from django.utils.encoding import smart_str
 
 from version import ZULIP_VERSION
-from zerver.lib.cache import cache_with_key, get_cache_with_key, preview_url_cache_key
+from zerver.lib.cache import (
+    cache_get,
+    cache_set,
+    cache_with_key,
+    get_cache_with_key,
+    preview_host_failure_cache_key,
+    preview_url_cache_key,
+)
 from zerver.lib.outgoing_http import OutgoingSession
 from zerver.lib.pysa import mark_sanitized
 from zerver.lib.url_preview.oembed import get_oembed_data
@@ -37,6 +44,16 @@ ZULIP_URL_PREVIEW_USER_AGENT = (
 HEADERS = {"User-Agent": ZULIP_URL_PREVIEW_USER_AGENT}
 TIMEOUT = 15
 
+# After a request to a host fails with a network error, we don't try
+# to fetch previews from it again for this many seconds, so that a
+# host which is down doesn't cost every message linking to it a
+# request timeout.
+HOST_FAILURE_CACHE_TIMEOUT = 10 * 60
+
+
+class PreviewHostUnavailableError(requests.exceptions.RequestException):
+    """Raised instead of fetching a URL whose host recently failed."""
+
 
 class PreviewSession(OutgoingSession):
     def __init__(self) -> None:
@@ -47,6 +64,22 @@ def is_link(url: str) -> Optional[Match[str]]:
     return link_regex.match(smart_str(url))
 
 
+def get_url_host(url: str) -> str:
+    return urlsplit(url).hostname or ""
+
+
+def record_host_failure(url: str) -> None:
+    cache_set(
+        preview_host_failure_cache_key(get_url_host(url)),
+        True,
+        timeout=HOST_FAILURE_CACHE_TIMEOUT,
+    )
+
+
+def host_recently_failed(url: str) -> bool:
+    return cache_get(preview_host_failure_cache_key(get_url_host(url))) is not None
+
+
 def guess_mimetype_from_content(response: requests.Response) -> str:
     mime_magic = magic.Magic(mime=True)
     try:
@@ -59,6 +92,9 @@ def guess_mimetype_from_content(response: requests.Response) -> str:
 def valid_content_type(url: str) -> bool:
     try:
         response = PreviewSession().get(url, stream=True)
+    except (requests.ConnectionError, requests.Timeout):
+        record_host_failure(url)
+        return False
     except requests.RequestException:
         return False
 
@@ -74,9 +110,11 @@ def valid_content_type(url: str) -> bool:
 
 
 def catch_network_errors(func: Callable[..., Any]) -> Callable[..., Any]:
-    def wrapper(*args: Any, **kwargs: Any) -> Any:
+    def wrapper(url: str, *args: Any, **kwargs: Any) -> Any:
         try:
-            return func(*args, **kwargs)
+            return func(url, *args, **kwargs)
+        except (requests.exceptions.ConnectionError, requests.exceptions.Timeout):
+            record_host_failure(url)
         except requests.exceptions.RequestException:
             pass
 
@@ -91,6 +129,12 @@ def get_link_embed_data(
     if not is_link(url):
         return None
 
+    if host_recently_failed(url):
+        # Raising, rather than returning None, means that we don't
+        # cache a result for this URL, so we'll try it again once
+        # the host's failure has expired from the cache.
+        raise PreviewHostUnavailableError(url)
+
     if not valid_content_type(url):
         return None
 
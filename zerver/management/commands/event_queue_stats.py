@@ -0,0 +1,42 @@
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado.django_api import requests_client
+
+
+class Command(BaseCommand):
+    help = """Prints statistics about the event queues held by each Tornado process,
+including the largest queues, the total number of events held, and how
+many events have been pruned or dropped for exceeding
+TORNADO_EVENT_QUEUE_MAX_EVENTS."""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument("--top", help="Number of largest queues to list", default=10, type=int)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        for port in settings.TORNADO_PORTS:
+            stats = (
+                requests_client()
+                .post(
+                    f"http://127.0.0.1:{port}/api/v1/events/internal/stats",
+                    data=dict(top=options["top"], secret=settings.SHARED_SECRET),
+                )
+                .json()
+            )
+            print(
+                f"Tornado {port}: {stats['queues']} queues for {stats['users']} users, "
+                f"holding {stats['events']} events"
+            )
+            print(
+                f"  {stats['pruned_events']} events pruned; {stats['overflows']} queues "
+                f"overflowed, dropping {stats['overflow_dropped_events']} events"
+            )
+            for queue in stats["largest_queues"]:
+                print(
+                    "  {queue_id}: {events} events, user {user_profile_id} via "
+                    "{client_type_name}{status}".format(
+                        status=" (connected)" if queue["connected"] else "", **queue
+                    )
+                )
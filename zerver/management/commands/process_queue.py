@@ -1,18 +1,25 @@
+import gc
+import itertools
 import logging
 import os
+import random
 import signal
 import sys
 import threading
+import time
 from argparse import ArgumentParser
 from contextlib import contextmanager
 from types import FrameType
-from typing import Any, Iterator, List
+from typing import Any, Dict, Iterator, List, Tuple
 
 from django.conf import settings
+from django.core.cache import close_caches
 from django.core.management.base import BaseCommand, CommandError
+from django.db import connections
 from django.utils import autoreload
 from sentry_sdk import configure_scope
 
+from zerver.lib.markdown import DEFAULT_MARKDOWN_KEY, maybe_update_markdown_engines
 from zerver.worker.queue_processors import get_active_worker_queues, get_worker
 
 
@@ -32,6 +39,47 @@ def log_and_exit_if_exception(
             sys.exit(1)
 
 
+# The prefork launcher restarts a child worker process that exits
+# after this delay, which is doubled, up to the maximum, each time the
+# child exits within PREFORK_MIN_UPTIME_SECS of being started.
+PREFORK_RESTART_DELAY_SECS = 1
+PREFORK_MAX_RESTART_DELAY_SECS = 60
+PREFORK_MIN_UPTIME_SECS = 60
+
+
+def run_worker(queue_name: str, worker_num: int, logger: logging.Logger) -> None:
+    def signal_handler(signal: int, frame: FrameType) -> None:
+        logger.info("Worker %d disconnecting from queue %s", worker_num, queue_name)
+        worker.stop()
+        sys.exit(0)
+
+    logger.info("Worker %d connecting to queue %s", worker_num, queue_name)
+    with log_and_exit_if_exception(logger, queue_name, threaded=False):
+        worker = get_worker(queue_name)
+        with configure_scope() as scope:
+            scope.set_tag("queue_worker", queue_name)
+            scope.set_tag("worker_num", worker_num)
+
+            worker.setup()
+            signal.signal(signal.SIGTERM, signal_handler)
+            signal.signal(signal.SIGINT, signal_handler)
+            signal.signal(signal.SIGUSR1, signal_handler)
+            worker.ENABLE_TIMEOUTS = True
+            worker.start()
+
+
+def run_threaded_workers(queues: List[str], logger: logging.Logger) -> None:
+    cnt = 0
+    for queue_name in queues:
+        if not settings.DEVELOPMENT:
+            logger.info("launching queue worker thread " + queue_name)
+        cnt += 1
+        td = ThreadedWorker(queue_name, logger)
+        td.start()
+    assert len(queues) == cnt
+    logger.info("%d queue worker threads were launched", cnt)
+
+
 class Command(BaseCommand):
     def add_arguments(self, parser: ArgumentParser) -> None:
         parser.add_argument("--queue_name", metavar="<queue name>", help="queue to process")
@@ -46,6 +94,14 @@ class Command(BaseCommand):
             required=False,
             help="list of queue to process",
         )
+        parser.add_argument(
+            "--prefork",
+            nargs="+",
+            metavar="<queue name>[,<queue name>...]",
+            required=False,
+            help="fork a worker process for each queue, after loading the app; "
+            "comma-separated queues share a multithreaded worker process",
+        )
 
     help = "Runs a queue processing worker"
 
@@ -69,17 +125,6 @@ class Command(BaseCommand):
                 logger.error("Cannot run a queue processor when USING_RABBITMQ is False!")
             raise CommandError
 
-        def run_threaded_workers(queues: List[str], logger: logging.Logger) -> None:
-            cnt = 0
-            for queue_name in queues:
-                if not settings.DEVELOPMENT:
-                    logger.info("launching queue worker thread " + queue_name)
-                cnt += 1
-                td = ThreadedWorker(queue_name, logger)
-                td.start()
-            assert len(queues) == cnt
-            logger.info("%d queue worker threads were launched", cnt)
-
         if options["all"]:
             signal.signal(signal.SIGUSR1, exit_with_three)
             autoreload.run_with_reloader(run_threaded_workers, get_active_worker_queues(), logger)
@@ -87,28 +132,14 @@ class Command(BaseCommand):
             signal.signal(signal.SIGUSR1, exit_with_three)
             queues = options["multi_threaded"]
             autoreload.run_with_reloader(run_threaded_workers, queues, logger)
+        elif options["prefork"]:
+            worker_groups = [group.split(",") for group in options["prefork"]]
+            for queue_name in itertools.chain.from_iterable(worker_groups):
+                if queue_name not in get_active_worker_queues():
+                    raise CommandError(f"Unknown queue: {queue_name}")
+            PreforkLauncher(worker_groups, logger).run()
         else:
-            queue_name = options["queue_name"]
-            worker_num = options["worker_num"]
-
-            def signal_handler(signal: int, frame: FrameType) -> None:
-                logger.info("Worker %d disconnecting from queue %s", worker_num, queue_name)
-                worker.stop()
-                sys.exit(0)
-
-            logger.info("Worker %d connecting to queue %s", worker_num, queue_name)
-            with log_and_exit_if_exception(logger, queue_name, threaded=False):
-                worker = get_worker(queue_name)
-                with configure_scope() as scope:
-                    scope.set_tag("queue_worker", queue_name)
-                    scope.set_tag("worker_num", worker_num)
-
-                    worker.setup()
-                    signal.signal(signal.SIGTERM, signal_handler)
-                    signal.signal(signal.SIGINT, signal_handler)
-                    signal.signal(signal.SIGUSR1, signal_handler)
-                    worker.ENABLE_TIMEOUTS = True
-                    worker.start()
+            run_worker(options["queue_name"], options["worker_num"], logger)
 
 
 class ThreadedWorker(threading.Thread):
@@ -126,5 +157,127 @@ class ThreadedWorker(threading.Thread):
         ):
             scope.set_tag("queue_worker", self.worker.queue_name)
             self.worker.setup()
+            self.worker.ENABLE_TIMEOUTS = True
             logging.debug("starting consuming " + self.worker.queue_name)
             self.worker.start()
+
+
+class PreforkLauncher:
+    """Runs queue workers in child processes forked from a single
+    launcher process, which imports and warms up the app once, so that
+    workers start quickly and share the memory holding the app's code
+    and data copy-on-write, rather than each importing it separately.
+    The launcher restarts any child that exits, with an increasing
+    delay for children that keep exiting soon after starting."""
+
+    def __init__(self, worker_groups: List[List[str]], logger: logging.Logger) -> None:
+        self.worker_groups = worker_groups
+        self.logger = logger
+        self.pid = os.getpid()
+        self.stopping = False
+        # maps child pids to their queues and start times
+        self.children: Dict[int, Tuple[List[str], float]] = {}
+        # (start time, queues) for children waiting to be restarted
+        self.pending: List[Tuple[float, List[str]]] = []
+        # maps comma-joined queue names to the current restart delay
+        self.restart_delays: Dict[str, float] = {}
+
+    def warm_up(self) -> None:
+        # Building a Markdown engine compiles a large number of
+        # regular expressions, which the workers can then share.
+        maybe_update_markdown_engines(DEFAULT_MARKDOWN_KEY, False)
+
+        # Connections can't be shared between processes, so close any
+        # that warming up opened; each child opens its own.
+        connections.close_all()
+        close_caches()
+        # Keep the garbage collector from touching, and thus copying,
+        # every object from before the fork in each child.
+        #
+        # TODO/compatibility: Remove the version check once we no longer
+        # support Ubuntu 18.04, whose Python 3.6 lacks gc.freeze.
+        if sys.version_info >= (3, 7):
+            gc.freeze()
+
+    def start_child(self, queues: List[str]) -> None:
+        pid = os.fork()
+        if pid != 0:
+            self.children[pid] = (queues, time.time())
+            return
+
+        status = 1
+        try:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            random.seed()
+            if len(queues) == 1:
+                run_worker(queues[0], 0, self.logger)
+            else:
+                # Exiting the main thread would leave the worker
+                # threads running; exit the whole process instead.
+                signal.signal(signal.SIGTERM, lambda signal, frame: os._exit(0))
+                signal.signal(signal.SIGUSR1, lambda signal, frame: os._exit(3))
+                run_threaded_workers(queues, self.logger)
+                while True:
+                    signal.pause()
+            status = 0
+        except SystemExit as e:
+            status = e.code if isinstance(e.code, int) else 1
+        except BaseException:
+            self.logger.exception("Unhandled exception in worker for %s", ",".join(queues))
+        finally:
+            # Never return into the launcher's code in the child.
+            os._exit(status)
+
+    def reap_children(self) -> None:
+        while self.children:
+            pid, status = os.waitpid(-1, os.WNOHANG)
+            if pid == 0:
+                return
+            queues, start_time = self.children.pop(pid)
+            if self.stopping:
+                continue
+
+            name = ",".join(queues)
+            if time.time() - start_time >= PREFORK_MIN_UPTIME_SECS:
+                delay: float = PREFORK_RESTART_DELAY_SECS
+            else:
+                delay = min(
+                    2 * self.restart_delays.get(name, PREFORK_RESTART_DELAY_SECS / 2),
+                    PREFORK_MAX_RESTART_DELAY_SECS,
+                )
+            self.restart_delays[name] = delay
+            self.logger.warning(
+                "Worker for %s exited with status %d; restarting in %d seconds",
+                name,
+                os.WEXITSTATUS(status) if os.WIFEXITED(status) else -os.WTERMSIG(status),
+                delay,
+            )
+            self.pending.append((time.time() + delay, queues))
+
+    def stop(self, signum: int, frame: FrameType) -> None:
+        if os.getpid() != self.pid:
+            # A child that was signalled before resetting its handlers.
+            os._exit(0)
+        self.logger.info("Stopping %d queue worker processes", len(self.children))
+        self.stopping = True
+        for pid in self.children:
+            os.kill(pid, signal.SIGTERM)
+
+    def run(self) -> None:
+        self.pid = os.getpid()
+        self.warm_up()
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+        for queues in self.worker_groups:
+            self.start_child(queues)
+        self.logger.info("%d queue worker processes were forked", len(self.children))
+
+        while self.children or (self.pending and not self.stopping):
+            self.reap_children()
+            if not self.stopping:
+                now = time.time()
+                for start_time, queues in [entry for entry in self.pending if entry[0] <= now]:
+                    self.pending.remove((start_time, queues))
+                    self.start_child(queues)
+            time.sleep(1)
@@ -21,6 +21,7 @@ instrument_tornado_ioloop()
 from zerver.lib.debug import interactive_debug_listen
 from zerver.tornado.application import create_tornado_application, setup_tornado_rabbitmq
 from zerver.tornado.autoreload import start as zulip_autoreload_start
+from zerver.tornado.ephemeral import setup_ephemeral_event_listener
 from zerver.tornado.event_queue import (
     add_client_gc_hook,
     get_wrapped_process_notification,
@@ -105,6 +106,8 @@ class Command(BaseCommand):
 
                 logging_data["port"] = str(port)
                 setup_event_queue(http_server, port)
+                if settings.TORNADO_EPHEMERAL_EVENTS:
+                    setup_ephemeral_event_listener(port)
                 add_client_gc_hook(missedmessage_hook)
                 setup_tornado_rabbitmq()
 
@@ -0,0 +1,39 @@
+from argparse import ArgumentParser
+from typing import Any
+
+from django.core.management.base import CommandError
+
+from zerver.lib.actions import do_change_stream_fanout_on_read
+from zerver.lib.exceptions import JsonableError
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import get_stream
+
+
+class Command(ZulipBaseCommand):
+    help = """Turn fanout-on-read on or off for a stream.
+
+In a fanout-on-read stream, new messages only get UserMessage rows
+for subscribers who need flags or notifications for them, and other
+subscribers' read state is tracked with a per-subscription read
+watermark.  Use this for very large announcement-style streams; see
+https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#fanout-on-read-streams
+
+Turning it off creates the UserMessage rows that were skipped, which
+can take a while for a large stream."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument("stream_name", metavar="<stream name>", help="name of the stream")
+        parser.add_argument(
+            "--disable", action="store_true", help="Turn fanout-on-read off for the stream"
+        )
+        self.add_realm_args(parser, required=True)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        stream = get_stream(options["stream_name"], realm)
+
+        try:
+            do_change_stream_fanout_on_read(stream, not options["disable"])
+        except JsonableError as error:
+            raise CommandError(error.msg)
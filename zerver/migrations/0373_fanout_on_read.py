@@ -0,0 +1,26 @@
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("zerver", "0372_realmemoji_unique_realm_emoji_when_false_deactivated"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="stream",
+            name="fanout_on_read",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="subscription",
+            name="fanout_start_message_id",
+            field=models.IntegerField(null=True),
+        ),
+        migrations.AddField(
+            model_name="subscription",
+            name="fanout_read_message_id",
+            field=models.IntegerField(null=True),
+        ),
+    ]
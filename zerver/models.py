@@ -53,8 +53,10 @@ from zerver.lib.cache import (
     flush_message,
     flush_muting_users_cache,
     flush_realm,
+    flush_realm_recipients,
     flush_stream,
     flush_submessage,
+    flush_subscription,
     flush_used_upload_space_cache,
     flush_user_profile,
     get_realm_used_upload_space_cache_key,
@@ -2285,6 +2287,14 @@ class Stream(models.Model):
     # stream based on what messages they have cached.
     first_message_id: Optional[int] = models.IntegerField(null=True, db_index=True)
 
+    # Whether messages to this stream are fanned out on read: rather
+    # than a UserMessage row for every subscriber, we only create rows
+    # for subscribers who need flags (e.g. because they were
+    # mentioned), and derive the other subscribers' unread state from
+    # the read watermarks on their Subscription objects.  Intended for
+    # very large announcement streams; see zerver/lib/fanout_on_read.py.
+    fanout_on_read: bool = models.BooleanField(default=False)
+
     def __str__(self) -> str:
         return f"<Stream: {self.name}>"
 
@@ -3213,6 +3223,14 @@ class Subscription(models.Model):
     email_notifications: Optional[bool] = models.BooleanField(null=True, default=None)
     wildcard_mentions_notify: Optional[bool] = models.BooleanField(null=True, default=None)
 
+    # For streams with fanout_on_read set, the user received the
+    # messages after fanout_start_message_id (the last message when
+    # they subscribed), even those without a UserMessage row, and
+    # those without a row up to fanout_read_message_id are read.  Both
+    # are None for other streams.
+    fanout_start_message_id: Optional[int] = models.IntegerField(null=True)
+    fanout_read_message_id: Optional[int] = models.IntegerField(null=True)
+
     class Meta:
         unique_together = ("user_profile", "recipient")
         indexes = [
@@ -3257,6 +3275,9 @@ class Subscription(models.Model):
     ]
 
 
+post_save.connect(flush_subscription, sender=Subscription)
+
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600 * 24 * 7)
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
@@ -4246,6 +4267,8 @@ class AlertWord(models.Model):
 def flush_realm_alert_words(realm: Realm) -> None:
     cache_delete(realm_alert_words_cache_key(realm))
     cache_delete(realm_alert_words_automaton_cache_key(realm))
+    # The stream recipient snapshots record which users have alert words.
+    flush_realm_recipients(realm.id)
 
 
 def flush_alert_word(*, instance: AlertWord, **kwargs: object) -> None:
@@ -1,8 +1,11 @@
+import os
+import shutil
 import time
-from typing import Any, Callable, Collection, Dict, List
+from typing import Any, Callable, Collection, Dict, List, Optional
 from unittest import mock
 
 import orjson
+from django.conf import settings
 from django.http import HttpRequest, HttpResponse
 
 from zerver.lib.actions import do_change_subscription_property, do_mute_topic
@@ -10,15 +13,32 @@ from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import HostRequestMock, mock_queue_publish
 from zerver.lib.user_groups import create_user_group, remove_user_from_user_group
 from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
+from zerver.tornado import event_queue
 from zerver.tornado.event_queue import (
     ClientDescriptor,
+    add_client_gc_hook,
     allocate_client_descriptor,
+    batched_event_delivery,
+    clear_client_event_queues_for_testing,
+    coalesce_notifications,
+    create_heartbeat_event,
+    dump_event_queues,
+    fetch_events,
+    gc_event_queues,
     get_client_descriptor,
+    get_event_queue_stats,
+    get_wrapped_process_notification,
+    load_event_queues,
     maybe_enqueue_notifications,
     missedmessage_hook,
     persistent_queue_filename,
+    persistent_queue_journal_filename,
     process_notification,
+    start_event_queue_journal,
 )
+from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.journal import read_event_queue_journal
+from zerver.tornado.preserialized import PreserializedDict, encode_events, json_events_response
 from zerver.tornado.views import cleanup_event_queue, get_events
 
 
@@ -582,6 +602,377 @@ class FileReloadLogicTest(ZulipTestCase):
                 persistent_queue_filename(9800, last=True),
                 "/home/zulip/tornado/event_queues.9800.last.json",
             )
+            self.assertEqual(
+                persistent_queue_journal_filename(9800),
+                "/home/zulip/tornado/event_queues.9800.journal",
+            )
+
+    def test_event_queue_journal(self) -> None:
+        queue_dir = os.path.join(settings.TEST_WORKER_DIR, "event-queues")
+        shutil.rmtree(queue_dir, ignore_errors=True)
+        os.makedirs(queue_dir)
+        hamlet = self.example_user("hamlet")
+
+        def allocate() -> ClientDescriptor:
+            return allocate_client_descriptor(
+                dict(
+                    all_public_streams=False,
+                    apply_markdown=False,
+                    client_gravatar=True,
+                    client_type_name="website",
+                    event_types=None,
+                    last_connection_time=time.time(),
+                    queue_timeout=0,
+                    realm_id=hamlet.realm.id,
+                    user_profile_id=hamlet.id,
+                )
+            )
+
+        def umfe(messages: List[int]) -> Dict[str, Any]:
+            return dict(
+                type="update_message_flags",
+                operation="add",
+                flag="read",
+                all=False,
+                messages=messages,
+            )
+
+        def verify_reload() -> None:
+            # Simulate a crash: nothing is dumped, and only the
+            # flushed journal and the last snapshot survive.
+            assert event_queue.event_queue_journal is not None
+            event_queue.event_queue_journal.flush()
+            expected = {qid: client.to_dict() for (qid, client) in event_queue.clients.items()}
+            clear_client_event_queues_for_testing()
+
+            with self.assertLogs(level="INFO"):
+                last_seq = load_event_queues(9800)
+            self.assertEqual(
+                {qid: client.to_dict() for (qid, client) in event_queue.clients.items()},
+                expected,
+            )
+            start_event_queue_journal(9800, last_seq)
+
+        with self.settings(
+            JSON_PERSISTENT_QUEUE_FILENAME_PATTERN=os.path.join(queue_dir, "event_queues%s.json"),
+            JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME_PATTERN=os.path.join(
+                queue_dir, "event_queues%s.journal"
+            ),
+        ):
+            start_event_queue_journal(9800, 0)
+            client = allocate()
+            client.event_queue.push(dict(type="unknown"))
+            client.event_queue.push(umfe([1, 2]))
+            client.event_queue.push(umfe([3]))
+            gc_client = allocate()
+            gc_client.cleanup()
+            verify_reload()
+
+            # Merging the virtual events means later flags events
+            # start a new virtual event, both live and on replay.
+            client = get_client_descriptor(client.event_queue.id)
+            client.event_queue.contents()
+            client.event_queue.push(umfe([4]))
+            client.event_queue.prune(0)
+            verify_reload()
+
+            # Compaction writes a snapshot and empties the journal.
+            with self.assertLogs(level="INFO"):
+                dump_event_queues(9800)
+            self.assertEqual(read_event_queue_journal(persistent_queue_journal_filename(9800)), [])
+            client = get_client_descriptor(client.event_queue.id)
+            client.event_queue.push(dict(type="unknown"))
+            verify_reload()
+
+            # An event pushed to several queues is journaled once, and
+            # the queues share its payload again after a reload.
+            other_client = allocate()
+            client = get_client_descriptor(client.event_queue.id)
+            shared_event = dict(type="unknown", value="shared")
+            client.event_queue.push(shared_event)
+            other_client.event_queue.push(shared_event, dict(flags=["read"]))
+            assert event_queue.event_queue_journal is not None
+            event_queue.event_queue_journal.flush()
+            records = read_event_queue_journal(persistent_queue_journal_filename(9800))
+            self.assertEqual([record[1] for record in records[-3:]], ["event", "push", "push"])
+            self.assertEqual(records[-1][3], [records[-3][0], dict(flags=["read"])])
+            verify_reload()
+            self.assertIs(
+                get_client_descriptor(client.event_queue.id).event_queue.queue[-1].payload,
+                get_client_descriptor(other_client.event_queue.id).event_queue.queue[-1].payload,
+            )
+
+            # A torn record from a crash mid-write is discarded.
+            assert event_queue.event_queue_journal is not None
+            event_queue.event_queue_journal.flush()
+            with open(persistent_queue_journal_filename(9800), "ab") as f:
+                f.write(b'[99, "push", "')
+            with self.assertLogs(level="WARNING"):
+                records = read_event_queue_journal(persistent_queue_journal_filename(9800))
+            self.assertEqual(records[-1][1], "push")
+            self.assertNotEqual(records[-1][0], 99)
+            self.assertEqual(
+                read_event_queue_journal(persistent_queue_journal_filename(9800)), records
+            )
+
+
+class GarbageCollectionTest(ZulipTestCase):
+    def test_gc_event_queues(self) -> None:
+        hamlet = self.example_user("hamlet")
+        removed: List[str] = []
+
+        def gc_hook(user_profile_id: int, client: ClientDescriptor, last_for_client: bool) -> None:
+            removed.append(client.event_queue.id)
+
+        add_client_gc_hook(gc_hook)
+
+        def allocate() -> ClientDescriptor:
+            return allocate_client_descriptor(
+                dict(
+                    all_public_streams=False,
+                    apply_markdown=False,
+                    client_gravatar=True,
+                    client_type_name="website",
+                    event_types=None,
+                    last_connection_time=1000,
+                    queue_timeout=600,
+                    realm_id=hamlet.realm.id,
+                    user_profile_id=hamlet.id,
+                )
+            )
+
+        def gc_at(now: float) -> None:
+            with mock.patch("zerver.tornado.event_queue.time.time", return_value=now):
+                gc_event_queues(9800)
+
+        client = allocate()
+        reconnected_client = allocate()
+        removed_client = allocate()
+        self.assert_length(event_queue.expiry_heap, 3)
+        removed_client.cleanup()
+
+        gc_at(1599)
+        self.assertEqual(removed, [])
+        self.assert_length(event_queue.expiry_heap, 3)
+
+        # A client that reconnected is rescheduled for its new
+        # deadline, and the entry for the deleted queue is dropped.
+        reconnected_client.last_connection_time = 1500
+        gc_at(1600)
+        self.assertEqual(removed, [client.event_queue.id])
+        self.assert_length(event_queue.expiry_heap, 1)
+
+        gc_at(2099)
+        self.assertEqual(removed, [client.event_queue.id])
+        gc_at(2100)
+        self.assertEqual(removed, [client.event_queue.id, reconnected_client.event_queue.id])
+        self.assert_length(event_queue.expiry_heap, 0)
+        self.assertEqual(event_queue.clients, {})
+
+
+class ShardedEventQueueTest(ZulipTestCase):
+    def test_cleanup_event_queue_on_other_process(self) -> None:
+        hamlet = self.example_user("hamlet")
+        with self.settings(TORNADO_PROCESSES=2), mock.patch.object(
+            event_queue, "tornado_port", 9801
+        ):
+            client = allocate_client_descriptor(
+                dict(
+                    all_public_streams=False,
+                    apply_markdown=False,
+                    client_gravatar=True,
+                    client_type_name="website",
+                    event_types=None,
+                    last_connection_time=time.time(),
+                    queue_timeout=600,
+                    realm_id=hamlet.realm.id,
+                    user_profile_id=hamlet.id,
+                )
+            )
+        queue_id = client.event_queue.id
+        self.assertTrue(queue_id.startswith("9801:"))
+
+        # A DELETE request that reaches another process is passed along
+        # to the one holding the queue, which checks the user.
+        with mock.patch.object(event_queue, "tornado_port", 9800):
+            othello = self.example_user("othello")
+            request = HostRequestMock({"queue_id": queue_id}, othello)
+            self.assert_json_success(cleanup_event_queue(request, othello))
+            self.assertIn(queue_id, event_queue.clients)
+
+            request = HostRequestMock({"queue_id": queue_id}, hamlet)
+            self.assert_json_success(cleanup_event_queue(request, hamlet))
+            self.assertNotIn(queue_id, event_queue.clients)
+
+
+class NotificationBatchTest(ZulipTestCase):
+    def test_coalesce_notifications(self) -> None:
+        def presence(user_id: int, status: str, users: List[int]) -> Dict[str, Any]:
+            return dict(
+                event=dict(
+                    type="presence",
+                    user_id=user_id,
+                    email=f"user{user_id}@zulip.testserver",
+                    server_timestamp=1000,
+                    presence=dict(website=dict(status=status)),
+                ),
+                users=users,
+            )
+
+        def flags(messages: List[int], operation: str = "add") -> Dict[str, Any]:
+            return dict(
+                event=dict(
+                    type="update_message_flags",
+                    op=operation,
+                    operation=operation,
+                    flag="read",
+                    messages=messages,
+                    all=False,
+                ),
+                users=[10],
+            )
+
+        typing = dict(event=dict(type="typing", op="start"), users=[10])
+        notices = [
+            presence(1, "active", [10, 11]),
+            flags([1, 2]),
+            flags([3]),
+            presence(2, "active", [10, 11]),
+            presence(1, "idle", [10, 11]),
+            presence(1, "active", [10]),
+            typing,
+            flags([4]),
+            flags([5], operation="remove"),
+        ]
+        self.assertEqual(
+            coalesce_notifications(notices),
+            [
+                flags([1, 2, 3]),
+                notices[3],
+                notices[4],
+                notices[5],
+                typing,
+                flags([4]),
+                flags([5], operation="remove"),
+            ],
+        )
+
+    def test_batched_event_delivery(self) -> None:
+        hamlet = self.example_user("hamlet")
+        client = allocate_client_descriptor(
+            dict(
+                all_public_streams=False,
+                apply_markdown=False,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=None,
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=hamlet.realm.id,
+                user_profile_id=hamlet.id,
+            )
+        )
+        notices = [dict(event=dict(type="unknown", value=i), users=[hamlet.id]) for i in range(3)]
+        process_notifications = get_wrapped_process_notification("notify_tornado")
+        with mock.patch.object(client, "deliver_events") as deliver:
+            process_notifications(notices)
+            deliver.assert_called_once_with()
+
+            # Nested batches are delivered with the outer batch.
+            with batched_event_delivery():
+                process_notifications(notices)
+                deliver.assert_called_once_with()
+            self.assertEqual(deliver.call_count, 2)
+
+        self.assertEqual(
+            [event["value"] for event in client.event_queue.contents()], [0, 1, 2, 0, 1, 2]
+        )
+
+
+class QueueOverflowTest(ZulipTestCase):
+    def allocate(self, event_types: Optional[List[str]] = None) -> ClientDescriptor:
+        hamlet = self.example_user("hamlet")
+        return allocate_client_descriptor(
+            dict(
+                all_public_streams=False,
+                apply_markdown=False,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=event_types,
+                last_connection_time=time.time(),
+                queue_timeout=600,
+                realm_id=hamlet.realm.id,
+                user_profile_id=hamlet.id,
+            )
+        )
+
+    def fetch(self, client: ClientDescriptor, last_event_id: int) -> Dict[str, Any]:
+        return fetch_events(
+            dict(
+                queue_id=client.event_queue.id,
+                dont_block=True,
+                last_event_id=last_event_id,
+                user_profile_id=client.user_profile_id,
+                client_type_name="website",
+                handler_id=1,
+            )
+        )
+
+    def test_overflow_restart(self) -> None:
+        with self.settings(TORNADO_EVENT_QUEUE_MAX_EVENTS=3):
+            client = self.allocate()
+            for i in range(3):
+                client.add_event(dict(type="unknown", value=i))
+            client.event_queue.prune(0)
+            self.assertEqual(client.event_queue.size(), 2)
+
+            client.add_event(dict(type="unknown", value=3))
+            client.add_event(dict(type="unknown", value=4))
+
+            # The client gets the restart event, whichever of the
+            # dropped events it last received.
+            result = self.fetch(client, last_event_id=2)
+            self.assertEqual(result["type"], "response")
+            [restart_event] = result["response"]["events"]
+            self.assertEqual(restart_event["type"], "restart")
+            self.assertEqual(restart_event["id"], 5)
+            self.assertTrue(restart_event["immediate"])
+
+            # Clients that don't accept restart events are garbage-collected.
+            other_client = self.allocate(event_types=["unknown"])
+            for i in range(4):
+                other_client.add_event(dict(type="unknown", value=i))
+            self.assertTrue(other_client.event_queue.empty())
+            other_client.add_event(dict(type="unknown", value=4))
+            self.assertTrue(other_client.event_queue.empty())
+
+            stats = get_event_queue_stats(1)
+            self.assertEqual(stats["queues"], 2)
+            self.assertEqual(stats["events"], 1)
+            self.assertEqual(stats["pruned_events"], 1)
+            self.assertEqual(stats["overflows"], 2)
+            self.assertEqual(stats["overflow_dropped_events"], 8)
+            self.assertEqual(stats["largest_queues"][0]["queue_id"], client.event_queue.id)
+
+            gc_event_queues(9800)
+            self.assertEqual(list(event_queue.clients), [client.event_queue.id])
+
+    def test_overflow_gc(self) -> None:
+        with self.settings(TORNADO_EVENT_QUEUE_MAX_EVENTS=3, TORNADO_EVENT_QUEUE_OVERFLOW="gc"):
+            client = self.allocate()
+            for i in range(4):
+                client.add_event(dict(type="unknown", value=i))
+            self.assertTrue(client.event_queue.empty())
+
+            # Until it is garbage-collected, the queue is rejected, so
+            # that the client registers a new one.
+            client.add_event(create_heartbeat_event())
+            result = self.fetch(client, last_event_id=0)
+            self.assertEqual(result["type"], "error")
+            self.assertIsInstance(result["exception"], BadEventQueueIdError)
+
+            gc_event_queues(9800)
+            self.assertEqual(event_queue.clients, {})
 
 
 class PruneInternalDataTest(ZulipTestCase):
@@ -621,6 +1012,28 @@ class PruneInternalDataTest(ZulipTestCase):
         self.assertTrue("internal_data" in events[2])
 
 
+class PreserializedEventsTest(ZulipTestCase):
+    def test_encode_events(self) -> None:
+        message = PreserializedDict(id=1, content="<p>hello</p>")
+        events = [
+            dict(type="message", message=message, flags=["read"], id=0),
+            dict(type="message", message=dict(id=2, content="plain"), flags=[], id=1),
+            dict(type="heartbeat", id=2),
+        ]
+        self.assertEqual(orjson.loads(encode_events(events)), events)
+        self.assertEqual(orjson.loads(encode_events([])), [])
+
+        # The message's encoding is computed only once.
+        self.assertIs(message.json(), message.json())
+
+        response = json_events_response(data=dict(events=events, queue_id="1:0"))
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(
+            orjson.loads(response.content),
+            dict(result="success", msg="", events=events, queue_id="1:0"),
+        )
+
+
 class EventQueueTest(ZulipTestCase):
     def get_client_descriptor(self) -> ClientDescriptor:
         hamlet = self.example_user("hamlet")
@@ -670,6 +1083,36 @@ class EventQueueTest(ZulipTestCase):
         self.assertEqual(queue.contents(), [out_dict])
         self.verify_to_dict_end_to_end(client)
 
+    def test_shared_event_payload(self) -> None:
+        client = self.get_client_descriptor()
+        other_client = self.get_client_descriptor()
+        other_client.event_queue.push(dict(type="unknown"))
+
+        event = dict(type="message", message=dict(id=1, content="hello"))
+        client.event_queue.push(event, dict(flags=["read"], internal_data={}))
+        other_client.event_queue.push(event, dict(flags=[], internal_data={}))
+
+        # Both queues reference the original event, rather than a copy.
+        self.assertIs(client.event_queue.queue[0].payload, event)
+        self.assertIs(other_client.event_queue.queue[1].payload, event)
+        self.verify_to_dict_end_to_end(client)
+
+        self.assertEqual(
+            client.event_queue.contents(),
+            [dict(id=0, type="message", message=dict(id=1, content="hello"), flags=["read"])],
+        )
+        self.assertEqual(
+            other_client.event_queue.contents(include_internal_data=True)[1],
+            dict(
+                id=1,
+                type="message",
+                message=dict(id=1, content="hello"),
+                flags=[],
+                internal_data={},
+            ),
+        )
+        self.assertEqual(event, dict(type="message", message=dict(id=1, content="hello")))
+
     def test_event_collapsing(self) -> None:
         client = self.get_client_descriptor()
         queue = client.event_queue
@@ -860,7 +1303,10 @@ class EventQueueTest(ZulipTestCase):
         self.verify_to_dict_end_to_end(client)
 
         queue.push({"type": "unknown", "timestamp": "1"})
-        self.assertEqual(list(queue.queue), [{"id": 1, "type": "unknown", "timestamp": "1"}])
+        self.assertEqual(
+            [event.to_dict() for event in queue.queue],
+            [{"id": 1, "type": "unknown", "timestamp": "1"}],
+        )
         self.assertEqual(
             queue.virtual_events,
             {"restart": {"id": 0, "type": "restart", "server_generation": 1, "timestamp": "1"}},
@@ -14,9 +14,11 @@ from zerver.lib.actions import (
     do_set_realm_property,
     do_update_user_presence,
 )
+from zerver.lib.cache import cache_delete, cache_set
 from zerver.lib.event_schema import check_restart_event
 from zerver.lib.events import fetch_initial_state_data
 from zerver.lib.exceptions import AccessDeniedError
+from zerver.lib.presence import batched_presence_realm_cache_key, realm_has_batched_presence_clients
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import HostRequestMock, queries_captured, stub_event_queue_user_events
 from zerver.lib.users import get_api_key, get_raw_user_data
@@ -25,19 +27,27 @@ from zerver.models import (
     UserMessage,
     UserPresence,
     UserProfile,
+    active_user_ids,
     flush_per_request_caches,
     get_client,
     get_realm,
     get_stream,
     get_system_bot,
 )
+from zerver.tornado.django_api import send_event
 from zerver.tornado.event_queue import (
+    ClientDescriptor,
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
+    get_client_descriptor,
+    get_client_descriptors_for_user_and_event_type,
     get_client_info_for_message_event,
     process_message_event,
+    process_notification,
+    send_batched_presence_changes,
     send_restart_events,
 )
+from zerver.tornado.sharding import get_tornado_port, get_tornado_ports, get_tornado_uri, shard_map
 from zerver.tornado.views import get_events, get_events_backend
 from zerver.views.events_register import (
     _default_all_public_streams,
@@ -681,6 +691,85 @@ class ClientDescriptorsTest(ZulipTestCase):
         test_get_info(apply_markdown=False, client_gravatar=True)
         test_get_info(apply_markdown=True, client_gravatar=True)
 
+    def test_get_client_info_uses_routing_indexes(self) -> None:
+        hamlet = self.example_user("hamlet")
+        realm = hamlet.realm
+
+        def allocate(
+            narrow: List[List[str]],
+            all_public_streams: bool = False,
+            event_types: Optional[List[str]] = None,
+        ) -> str:
+            queue_data = dict(
+                all_public_streams=all_public_streams,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name="website",
+                event_types=event_types,
+                last_connection_time=time.time(),
+                narrow=narrow,
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=hamlet.id,
+            )
+            return allocate_client_descriptor(queue_data).event_queue.id
+
+        all_streams_queue = allocate([], all_public_streams=True)
+        stream_queue = allocate([["stream", "Denmark"]])
+        topic_queue = allocate([["stream", "denmark"], ["topic", "Foo"]])
+        topic_only_queue = allocate([["topic", "foo"]])
+        other_stream_queue = allocate([["stream", "Verona"]])
+        other_topic_queue = allocate([["stream", "Denmark"], ["topic", "bar"]])
+        private_queue = allocate([["is", "private"]])
+        presence_queue = allocate([], event_types=["presence"])
+
+        message_event = dict(
+            realm_id=realm.id,
+            stream_name="Denmark",
+            message_dict=dict(type="stream", subject="foo"),
+        )
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(
+            set(client_info),
+            {all_streams_queue, stream_queue, topic_queue, topic_only_queue},
+        )
+
+        # The user's own queues are indexed by event type.
+        client_info = get_client_info_for_message_event(message_event, users=[dict(id=hamlet.id)])
+        self.assertNotIn(presence_queue, client_info)
+        self.assertIn(other_stream_queue, client_info)
+        self.assertIn(other_topic_queue, client_info)
+        self.assertIn(private_queue, client_info)
+        self.assertEqual(
+            [
+                client.event_queue.id
+                for client in get_client_descriptors_for_user_and_event_type(hamlet.id, "presence")
+            ],
+            [
+                all_streams_queue,
+                stream_queue,
+                topic_queue,
+                topic_only_queue,
+                other_stream_queue,
+                other_topic_queue,
+                private_queue,
+                presence_queue,
+            ],
+        )
+
+        # Garbage-collected queues are removed from the indexes.
+        get_client_descriptor(topic_queue).cleanup()
+        get_client_descriptor(presence_queue).cleanup()
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(set(client_info), {all_streams_queue, stream_queue, topic_only_queue})
+        self.assertNotIn(
+            presence_queue,
+            [
+                client.event_queue.id
+                for client in get_client_descriptors_for_user_and_event_type(hamlet.id, "presence")
+            ],
+        )
+
     def test_process_message_event_with_mocked_client_info(self) -> None:
         hamlet = self.example_user("hamlet")
 
@@ -701,8 +790,10 @@ class ClientDescriptorsTest(ZulipTestCase):
                 assert event["type"] == "message"
                 return True
 
-            def add_event(self, event: Dict[str, Any]) -> None:
-                self.events.append(event)
+            def add_event(
+                self, event: Dict[str, Any], overrides: Optional[Dict[str, Any]] = None
+            ) -> None:
+                self.events.append({**event, **(overrides or {})})
 
         client1 = MockClient(
             user_profile_id=hamlet.id,
@@ -1165,6 +1256,8 @@ class TestUserPresenceUpdatesDisabled(ZulipTestCase):
                 UserPresence.ACTIVE,
             )
 
+        self.assertNotIn("batched_only", events[0]["event"])
+
         # Now check that if the realm has more than the USER_LIMIT_FOR_SENDING_PRESENCE_UPDATE_EVENTS
         # amount of active users, send_event doesn't get called.
         with self.tornado_redirected_to_list(events, expected_num_events=0):
@@ -1175,3 +1268,170 @@ class TestUserPresenceUpdatesDisabled(ZulipTestCase):
                     timezone_now(),
                     UserPresence.ACTIVE,
                 )
+
+        # Unless the realm has clients with the batched_presence
+        # capability, which get a realm-level notice with no users.
+        cache_set(batched_presence_realm_cache_key(get_realm("zulip").id), True)
+        with self.tornado_redirected_to_list(events, expected_num_events=1):
+            with self.settings(USER_LIMIT_FOR_SENDING_PRESENCE_UPDATE_EVENTS=1):
+                do_update_user_presence(
+                    self.example_user("hamlet"),
+                    get_client("website"),
+                    timezone_now(),
+                    UserPresence.ACTIVE,
+                )
+        cache_delete(batched_presence_realm_cache_key(get_realm("zulip").id))
+        self.assertTrue(events[0]["event"]["batched_only"])
+        self.assertEqual(events[0]["users"], [])
+
+
+class BatchedPresenceTest(ZulipTestCase):
+    def test_batched_presence(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+
+        def allocate(batched_presence: bool, slim_presence: bool = True) -> ClientDescriptor:
+            return allocate_client_descriptor(
+                dict(
+                    user_profile_id=hamlet.id,
+                    realm_id=hamlet.realm_id,
+                    event_types=["presence"],
+                    client_type_name="website",
+                    apply_markdown=True,
+                    client_gravatar=True,
+                    slim_presence=slim_presence,
+                    all_public_streams=False,
+                    queue_timeout=600,
+                    last_connection_time=time.time(),
+                    narrow=[],
+                    batched_presence=batched_presence,
+                )
+            )
+
+        self.assertFalse(realm_has_batched_presence_clients(hamlet.realm_id))
+        client = allocate(batched_presence=False)
+        batched_client = allocate(batched_presence=True)
+        self.assertTrue(realm_has_batched_presence_clients(hamlet.realm_id))
+        # Only the realm's first such client marks it in the cache.
+        with mock.patch("zerver.tornado.event_queue.cache_set_many") as mock_cache_set_many:
+            legacy_batched_client = allocate(batched_presence=True, slim_presence=False)
+        mock_cache_set_many.assert_not_called()
+
+        def send_presence(
+            user: UserProfile, client_name: str, status: str, batched_only: bool = False
+        ) -> None:
+            presence = dict(client=client_name, status=status, timestamp=1000, pushable=False)
+            process_notification(
+                dict(
+                    event=dict(
+                        type="presence",
+                        email=user.email,
+                        user_id=user.id,
+                        server_timestamp=1000,
+                        presence={client_name: presence},
+                        realm_id=user.realm_id,
+                        **(dict(batched_only=True) if batched_only else {}),
+                    ),
+                    users=[] if batched_only else [hamlet.id],
+                )
+            )
+
+        send_presence(cordelia, "website", "active")
+        send_presence(othello, "website", "active")
+        send_presence(cordelia, "ZulipMobile", "idle")
+        send_presence(cordelia, "website", "idle", batched_only=True)
+        self.assert_length(client.event_queue.contents(), 3)
+        self.assertTrue(batched_client.event_queue.empty())
+
+        send_batched_presence_changes(hamlet.realm_id)
+        [event] = batched_client.event_queue.contents()
+        cordelia_presence = {
+            "website": dict(client="website", status="idle", timestamp=1000, pushable=False),
+            "ZulipMobile": dict(
+                client="ZulipMobile", status="idle", timestamp=1000, pushable=False
+            ),
+        }
+        othello_presence = {
+            "website": dict(client="website", status="active", timestamp=1000, pushable=False),
+        }
+        self.assertEqual(
+            event["presences"],
+            {str(cordelia.id): cordelia_presence, str(othello.id): othello_presence},
+        )
+
+        # Clients without slim_presence get presences keyed by email.
+        [event] = legacy_batched_client.event_queue.contents()
+        self.assertEqual(
+            event["presences"],
+            {cordelia.email: cordelia_presence, othello.email: othello_presence},
+        )
+
+        # Nothing is sent if nothing changed.
+        send_batched_presence_changes(hamlet.realm_id)
+        self.assert_length(batched_client.event_queue.contents(), 1)
+
+        # The mark goes away with the realm's last such client.
+        batched_client.cleanup()
+        self.assertTrue(realm_has_batched_presence_clients(hamlet.realm_id))
+        legacy_batched_client.cleanup()
+        self.assertFalse(realm_has_batched_presence_clients(hamlet.realm_id))
+
+
+class TornadoShardingTest(ZulipTestCase):
+    def test_user_sharding(self) -> None:
+        realm = get_realm("zulip")
+        user_ids = range(1, 1001)
+
+        with mock.patch.dict(shard_map, {realm.host: 9801}):
+            self.assertEqual(get_tornado_ports(realm), [9801])
+            self.assertEqual(get_tornado_port(realm, 1), 9801)
+            self.assertEqual(get_tornado_uri(realm), "http://127.0.0.1:9801")
+
+        with mock.patch.dict(shard_map, {realm.host: [9800, 9801]}):
+            two_ports = {user_id: get_tornado_port(realm, user_id) for user_id in user_ids}
+            self.assertEqual(get_tornado_uri(realm, 1), f"http://127.0.0.1:{two_ports[1]}")
+        self.assertGreater(list(two_ports.values()).count(9800), 400)
+        self.assertGreater(list(two_ports.values()).count(9801), 400)
+
+        # Adding a port only moves users to the new port.
+        with mock.patch.dict(shard_map, {realm.host: [9800, 9801, 9802]}):
+            three_ports = {user_id: get_tornado_port(realm, user_id) for user_id in user_ids}
+        moved = [user_id for user_id in user_ids if three_ports[user_id] != two_ports[user_id]]
+        self.assertTrue(all(three_ports[user_id] == 9802 for user_id in moved))
+        self.assertGreater(len(moved), 200)
+        self.assertLess(len(moved), 450)
+
+    def test_send_event_fan_out(self) -> None:
+        realm = get_realm("zulip")
+        hamlet = self.example_user("hamlet")
+        user_ids = sorted(active_user_ids(realm.id))
+
+        with mock.patch.dict(shard_map, {realm.host: [9800, 9801]}), self.settings(
+            TORNADO_PROCESSES=2
+        ), mock.patch("zerver.tornado.django_api.queue_json_publish") as m:
+            send_event(realm, dict(type="realm_emoji"), user_ids)
+            published = {args[0]: args[1]["users"] for (args, kwargs) in m.call_args_list}
+            self.assertEqual(
+                published.keys(), {"notify_tornado_port_9800", "notify_tornado_port_9801"}
+            )
+            for port in [9800, 9801]:
+                users = published[f"notify_tornado_port_{port}"]
+                self.assertTrue(all(get_tornado_port(realm, user_id) == port for user_id in users))
+            self.assertEqual(sorted(sum(published.values(), [])), user_ids)
+
+            # Message events go to every process, for their
+            # all_public_streams queues.
+            m.reset_mock()
+            send_event(realm, dict(type="message"), [dict(id=hamlet.id)])
+            published = {args[0]: args[1]["users"] for (args, kwargs) in m.call_args_list}
+            hamlet_port = get_tornado_port(realm, hamlet.id)
+            self.assertEqual(
+                published,
+                {
+                    f"notify_tornado_port_{port}": [dict(id=hamlet.id)]
+                    if port == hamlet_port
+                    else []
+                    for port in [9800, 9801]
+                },
+            )
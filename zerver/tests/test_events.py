@@ -107,6 +107,7 @@ from zerver.lib.event_schema import (
     check_attachment_add,
     check_attachment_remove,
     check_attachment_update,
+    check_batched_presence,
     check_custom_profile_fields,
     check_default_stream_groups,
     check_default_streams,
@@ -211,6 +212,7 @@ from zerver.tornado.event_queue import (
     allocate_client_descriptor,
     clear_client_event_queues_for_testing,
     create_heartbeat_event,
+    send_batched_presence_changes,
     send_restart_events,
 )
 from zerver.views.realm_playgrounds import access_playground_by_id
@@ -244,6 +246,7 @@ class BaseAction(ZulipTestCase):
         bulk_message_deletion: bool = True,
         stream_typing_notifications: bool = True,
         user_settings_object: bool = False,
+        batched_presence: bool = False,
     ) -> List[Dict[str, Any]]:
         """
         Make sure we have a clean slate of client descriptors for these tests.
@@ -271,6 +274,7 @@ class BaseAction(ZulipTestCase):
                 bulk_message_deletion=bulk_message_deletion,
                 stream_typing_notifications=stream_typing_notifications,
                 user_settings_object=user_settings_object,
+                batched_presence=batched_presence,
             )
         )
 
@@ -910,6 +914,26 @@ class NormalActionsTest(BaseAction):
             status="active",
         )
 
+    def test_batched_presence_events(self) -> None:
+        def update_presence() -> None:
+            do_update_user_presence(
+                self.example_user("cordelia"),
+                get_client("website"),
+                timezone_now(),
+                UserPresence.ACTIVE,
+            )
+            send_batched_presence_changes(self.user_profile.realm_id)
+
+        for slim_presence in [False, True]:
+            events = self.verify_action(
+                update_presence, slim_presence=slim_presence, batched_presence=True
+            )
+            check_batched_presence("events[0]", events[0])
+            cordelia = self.example_user("cordelia")
+            user_key = str(cordelia.id) if slim_presence else cordelia.email
+            self.assertEqual(list(events[0]["presences"].keys()), [user_key])
+            self.assertEqual(events[0]["presences"][user_key]["website"]["status"], "active")
+
     def test_presence_events_multiple_clients(self) -> None:
         self.api_post(
             self.user_profile,
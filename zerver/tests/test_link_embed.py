@@ -637,6 +637,27 @@ class PreviewTestCase(ZulipTestCase):
             '<p><a href="http://test.org/">http://test.org/</a></p>', msg.rendered_content
         )
 
+    @responses.activate
+    def test_host_failure_cache(self) -> None:
+        url = "http://test.org/"
+        other_url = "http://test.org/other"
+        self.create_mock_response(url, body=ConnectionError())
+        self.create_mock_response(other_url)
+
+        with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
+            self.assertIsNone(get_link_embed_data(url))
+            # For a while, we don't try to fetch other URLs from the
+            # same host, nor cache that we didn't.
+            self.assertIsNone(get_link_embed_data(other_url))
+            with self.assertRaises(NotFoundInCache):
+                link_embed_data_from_cache(other_url)
+            self.assertTrue(responses.assert_call_count(other_url, 0))
+
+            with mock.patch(
+                "zerver.lib.url_preview.preview.host_recently_failed", return_value=False
+            ):
+                self.assertIsNotNone(get_link_embed_data(other_url))
+
     def test_invalid_link(self) -> None:
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
             self.assertIsNone(get_link_embed_data("com.notvalidlink"))
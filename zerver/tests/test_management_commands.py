@@ -1,5 +1,7 @@
+import logging
 import os
 import re
+import signal
 from datetime import timedelta
 from typing import Any, Dict, List, Optional
 from unittest import mock, skipUnless
@@ -17,6 +19,12 @@ from zerver.lib.actions import do_add_reaction, do_create_user
 from zerver.lib.management import ZulipBaseCommand, check_config
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import most_recent_message, stdout_suppressed
+from zerver.management.commands.process_queue import (
+    PREFORK_MAX_RESTART_DELAY_SECS,
+    PREFORK_MIN_UPTIME_SECS,
+    PREFORK_RESTART_DELAY_SECS,
+    PreforkLauncher,
+)
 from zerver.models import (
     Message,
     Reaction,
@@ -609,3 +617,62 @@ class TestSendCustomEmail(ZulipTestCase):
                     call("  hamlet@zulip.com (zulip)"),
                 ],
             )
+
+
+class TestProcessQueuePrefork(ZulipTestCase):
+    COMMAND_NAME = "process_queue"
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.logger = logging.getLogger("process_queue")
+        self.launcher = PreforkLauncher([["deferred_work"]], self.logger)
+
+    def exit_child(self, uptime: float) -> None:
+        """Has the launcher reap its child, which exited with status 1
+        after running for `uptime` seconds."""
+        self.launcher.children[101] = (["deferred_work"], 1000)
+        with patch("os.waitpid", return_value=(101, 1 << 8)), patch(
+            "time.time", return_value=1000 + uptime
+        ), self.assertLogs("process_queue", level="WARNING"):
+            self.launcher.reap_children()
+        self.assertEqual(self.launcher.children, {})
+
+    def test_unknown_queue(self) -> None:
+        with self.settings(USING_RABBITMQ=True), self.assertRaisesRegex(
+            CommandError, "Unknown queue: nonexistent"
+        ):
+            call_command(self.COMMAND_NAME, "--prefork", "deferred_work,nonexistent")
+
+    def test_restart_delay(self) -> None:
+        # Children that keep exiting soon after starting are restarted
+        # after a delay which doubles, up to a maximum.
+        delays = []
+        for i in range(8):
+            self.exit_child(uptime=1)
+            delays.append(self.launcher.restart_delays["deferred_work"])
+            self.assertEqual(self.launcher.pending[-1], (1001 + delays[-1], ["deferred_work"]))
+        self.assertEqual(delays, [1, 2, 4, 8, 16, 32, 60, 60])
+        self.assertEqual(delays[-1], PREFORK_MAX_RESTART_DELAY_SECS)
+
+        # Once a child stays up long enough, the delay resets.
+        self.exit_child(uptime=PREFORK_MIN_UPTIME_SECS)
+        self.assertEqual(self.launcher.restart_delays["deferred_work"], PREFORK_RESTART_DELAY_SECS)
+        self.assertEqual(
+            self.launcher.pending[-1],
+            (1000 + PREFORK_MIN_UPTIME_SECS + PREFORK_RESTART_DELAY_SECS, ["deferred_work"]),
+        )
+
+    def test_stop(self) -> None:
+        self.launcher.children = {101: (["deferred_work"], 1000), 102: (["email_senders"], 1000)}
+        with patch("os.kill") as mock_kill, self.assertLogs("process_queue", level="INFO"):
+            self.launcher.stop(signal.SIGTERM, MagicMock())
+        self.assertTrue(self.launcher.stopping)
+        self.assertEqual(
+            mock_kill.call_args_list, [call(101, signal.SIGTERM), call(102, signal.SIGTERM)]
+        )
+
+        # Children that exit while stopping are not restarted.
+        with patch("os.waitpid", side_effect=[(101, 0), (102, 0)]):
+            self.launcher.reap_children()
+        self.assertEqual(self.launcher.children, {})
+        self.assertEqual(self.launcher.pending, [])
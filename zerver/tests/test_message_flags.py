@@ -5,7 +5,8 @@ import orjson
 from django.db import connection
 from django.http import HttpResponse
 
-from zerver.lib.actions import do_change_stream_invite_only
+from zerver.lib.actions import do_change_stream_fanout_on_read, do_change_stream_invite_only
+from zerver.lib.exceptions import JsonableError
 from zerver.lib.fix_unreads import fix, fix_unsubscribed
 from zerver.lib.message import (
     MessageDict,
@@ -1384,3 +1385,172 @@ class PersonalMessagesFlagTest(ZulipTestCase):
 
         for msg in self.get_messages():
             self.assertNotIn("is_private", msg["flags"])
+
+
+class FanoutOnReadTest(ZulipTestCase):
+    def test_fanout_on_read_stream(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        stream = self.make_stream("announce")
+        self.subscribe(hamlet, "announce")
+        self.subscribe(cordelia, "announce")
+        do_change_stream_fanout_on_read(stream, True)
+
+        message_ids = [
+            self.send_stream_message(hamlet, "announce", f"announcement {i}") for i in range(3)
+        ]
+        mention_id = self.send_stream_message(hamlet, "announce", "@**Cordelia, Lear's daughter**")
+
+        # Only the mention gets a UserMessage row for Cordelia.
+        cordelia_message_ids = UserMessage.objects.filter(
+            user_profile=cordelia, message__recipient_id=stream.recipient_id
+        ).values_list("message_id", flat=True)
+        self.assertEqual(list(cordelia_message_ids), [mention_id])
+        raw_unread_data = get_raw_unread_data(cordelia)
+        self.assertTrue({*message_ids, mention_id} <= set(raw_unread_data["stream_dict"]))
+
+        # Reading the stream in order just advances the watermark.
+        self.login_user(cordelia)
+        result = self.client_post(
+            "/json/messages/flags",
+            {"messages": orjson.dumps(message_ids[:2]).decode(), "op": "add", "flag": "read"},
+        )
+        self.assert_json_success(result)
+        self.assertEqual(
+            get_subscription("announce", cordelia).fanout_read_message_id, message_ids[1]
+        )
+        self.assertEqual(list(cordelia_message_ids), [mention_id])
+
+        # Starring a message creates its UserMessage row.
+        result = self.client_post(
+            "/json/messages/flags",
+            {"messages": orjson.dumps([message_ids[2]]).decode(), "op": "add", "flag": "starred"},
+        )
+        self.assert_json_success(result)
+        self.assertEqual(
+            UserMessage.objects.get(user_profile=cordelia, message_id=message_ids[2]).flags_list(),
+            ["starred"],
+        )
+
+        flags = {
+            message["id"]: message["flags"]
+            for message in self.get_messages(anchor="newest", num_before=10, num_after=0)
+        }
+        check_flags(flags[message_ids[0]], {"read"})
+        check_flags(flags[message_ids[1]], {"read"})
+        check_flags(flags[message_ids[2]], {"starred"})
+        check_flags(flags[mention_id], {"mentioned"})
+        raw_unread_data = get_raw_unread_data(cordelia)
+        self.assertFalse({*message_ids[:2]} & set(raw_unread_data["stream_dict"]))
+        self.assertTrue({message_ids[2], mention_id} <= set(raw_unread_data["stream_dict"]))
+
+        # Turning fanout-on-read off creates the missing rows.
+        unread_message_id = self.send_stream_message(hamlet, "announce", "announcement")
+        do_change_stream_fanout_on_read(stream, False)
+        self.assertTrue(
+            UserMessage.objects.get(user_profile=cordelia, message_id=message_ids[0]).flags.read
+        )
+        self.assertFalse(
+            UserMessage.objects.get(user_profile=cordelia, message_id=unread_message_id).flags.read
+        )
+        self.assertIsNone(get_subscription("announce", cordelia).fanout_start_message_id)
+
+    def test_move_messages_out_of_fanout_on_read_stream(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        stream = self.make_stream("announce")
+        new_stream = self.make_stream("new announce")
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, "announce")
+            self.subscribe(user, "new announce")
+        do_change_stream_fanout_on_read(stream, True)
+
+        message_ids = [
+            self.send_stream_message(hamlet, "announce", f"announcement {i}", "moved")
+            for i in range(3)
+        ]
+        other_message_id = self.send_stream_message(hamlet, "announce", "staying", "other")
+        self.login_user(cordelia)
+        result = self.client_post(
+            "/json/messages/flags",
+            {"messages": orjson.dumps(message_ids[:1]).decode(), "op": "add", "flag": "read"},
+        )
+        self.assert_json_success(result)
+
+        self.login("iago")
+        result = self.client_patch(
+            f"/json/messages/{message_ids[1]}",
+            {"stream_id": new_stream.id, "propagate_mode": "change_all"},
+        )
+        self.assert_json_success(result)
+
+        # Cordelia keeps the moved messages, with their read state, as
+        # UserMessage rows; the message left behind still has none.
+        self.assertEqual(
+            {
+                um.message_id: um.flags.read
+                for um in UserMessage.objects.filter(user_profile=cordelia)
+                if um.message_id in [*message_ids, other_message_id]
+            },
+            {message_ids[0]: True, message_ids[1]: False, message_ids[2]: False},
+        )
+        raw_unread_data = get_raw_unread_data(cordelia)
+        self.assertTrue({*message_ids[1:], other_message_id} <= set(raw_unread_data["stream_dict"]))
+
+    def test_fanout_on_read_messages_in_narrow(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        stream = self.make_stream("announce")
+        self.subscribe(hamlet, "announce")
+        self.subscribe(cordelia, "announce")
+        do_change_stream_fanout_on_read(stream, True)
+
+        good_id = self.send_stream_message(hamlet, "announce", "announcement", "match")
+        bad_id = self.send_stream_message(hamlet, "announce", "announcement", "other")
+        self.assertFalse(UserMessage.objects.filter(user_profile=cordelia, message_id=good_id))
+
+        self.login_user(cordelia)
+        narrow = [dict(operator="topic", operand="match")]
+        raw_params = dict(msg_ids=[good_id, bad_id], narrow=narrow)
+        params = {k: orjson.dumps(v).decode() for k, v in raw_params.items()}
+        result = self.client_get("/json/messages/matches_narrow", params)
+        self.assert_json_success(result)
+        self.assertEqual(list(result.json()["messages"].keys()), [str(good_id)])
+
+    def test_fanout_on_read_requires_public_history(self) -> None:
+        stream = self.make_stream(
+            "private_announce", invite_only=True, history_public_to_subscribers=False
+        )
+        with self.assertRaisesRegex(JsonableError, "history to be public to subscribers"):
+            do_change_stream_fanout_on_read(stream, True)
+
+        # Nor can a fanout-on-read stream's history be made non-public,
+        # including by making it private with the default history setting.
+        stream = self.make_stream("announce")
+        do_change_stream_fanout_on_read(stream, True)
+        self.login("iago")
+        for params in [
+            {"is_private": orjson.dumps(True).decode()},
+            {
+                "is_private": orjson.dumps(True).decode(),
+                "history_public_to_subscribers": orjson.dumps(False).decode(),
+            },
+        ]:
+            result = self.client_patch(f"/json/streams/{stream.id}", params)
+            self.assert_json_error(
+                result, "Fanout-on-read requires the stream's history to be public to subscribers."
+            )
+        stream.refresh_from_db()
+        self.assertFalse(stream.invite_only)
+        self.assertTrue(stream.history_public_to_subscribers)
+
+        result = self.client_patch(
+            f"/json/streams/{stream.id}",
+            {
+                "is_private": orjson.dumps(True).decode(),
+                "history_public_to_subscribers": orjson.dumps(True).decode(),
+            },
+        )
+        self.assert_json_success(result)
+        stream.refresh_from_db()
+        self.assertTrue(stream.invite_only)
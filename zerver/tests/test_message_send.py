@@ -1,5 +1,5 @@
 import datetime
-from typing import Any, List, Mapping, Optional, Set
+from typing import Any, List, Mapping, Optional, Set, Tuple
 from unittest import mock
 
 import orjson
@@ -11,7 +11,9 @@ from django.test import override_settings
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.actions import (
+    UserMessageLite,
     build_message_send_dict,
+    bulk_insert_ums,
     check_message,
     check_send_stream_message,
     do_add_realm_domain,
@@ -34,7 +36,7 @@ from zerver.lib.actions import (
 )
 from zerver.lib.addressee import Addressee
 from zerver.lib.cache import cache_delete, get_stream_cache_key
-from zerver.lib.exceptions import JsonableError
+from zerver.lib.exceptions import JsonableError, RateLimited
 from zerver.lib.message import MessageDict, get_raw_unread_data, get_recent_private_conversations
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import (
@@ -65,7 +67,7 @@ from zerver.models import (
     get_system_bot,
     get_user,
 )
-from zerver.views.message_send import InvalidMirrorInput
+from zerver.views.message_send import MAX_MESSAGES_PER_BATCH, InvalidMirrorInput
 
 
 class MessagePOSTTest(ZulipTestCase):
@@ -1363,6 +1365,91 @@ class MessagePOSTTest(ZulipTestCase):
         result = self.api_post(sender, "/api/v1/messages", payload)
         self.assert_json_success(result)
 
+    def test_send_messages_batch(self) -> None:
+        """
+        Each message in a batch is sent or rejected on its own, and the
+        results are in the order of the messages.
+        """
+        sender = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        messages = [
+            dict(type="stream", to="Verona", topic="batch", content="First"),
+            dict(type="stream", to="nonexistent", topic="batch", content="Lost"),
+            dict(type="private", to=[othello.id], content="Second"),
+            dict(type="stream", to="Verona", content="No topic"),
+            dict(type="private", to=othello.email, content="Third"),
+        ]
+        result = self.api_post(
+            sender, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        results = self.assert_json_success(result)["results"]
+
+        sent_messages = list(Message.objects.filter(sender=sender).order_by("-id")[:3])[::-1]
+        self.assertEqual(
+            [message.content for message in sent_messages], ["First", "Second", "Third"]
+        )
+        self.assertEqual(
+            results,
+            [
+                {"result": "success", "id": sent_messages[0].id},
+                {
+                    "result": "error",
+                    "code": "STREAM_DOES_NOT_EXIST",
+                    "msg": "Stream 'nonexistent' does not exist",
+                    "stream": "nonexistent",
+                },
+                {"result": "success", "id": sent_messages[1].id},
+                {"result": "error", "code": "BAD_REQUEST", "msg": "Missing topic"},
+                {"result": "success", "id": sent_messages[2].id},
+            ],
+        )
+        self.assertEqual(sent_messages[0].topic_name(), "batch")
+        self.assertEqual(sent_messages[2].recipient_id, othello.recipient_id)
+
+        messages = [dict(type="private", to=[othello.id], content="Hi")] * (
+            MAX_MESSAGES_PER_BATCH + 1
+        )
+        result = self.api_post(
+            sender, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        self.assert_json_error(
+            result,
+            f"Too many messages; at most {MAX_MESSAGES_PER_BATCH} can be sent at once.",
+        )
+
+        messages = [dict(type="stream", to=["Verona"], topic="batch", content="Hi")]
+        result = self.api_post(
+            sender, "/api/v1/messages/batch", {"messages": orjson.dumps(messages).decode()}
+        )
+        self.assertEqual(
+            self.assert_json_success(result)["results"],
+            [{"result": "error", "code": "BAD_REQUEST", "msg": "Invalid data type for stream"}],
+        )
+
+    def test_send_messages_batch_rate_limit(self) -> None:
+        sender = self.example_user("hamlet")
+        othello = self.example_user("othello")
+        messages = [dict(type="private", to=[othello.id], content="Hi")] * 3
+        payload = {"messages": orjson.dumps(messages).decode()}
+
+        # The request is counted once, and the additional messages
+        # are counted together, once each.
+        with self.settings(RATE_LIMITING=True), mock.patch(
+            "zerver.views.message_send.rate_limit_user"
+        ) as rate_limit_mock:
+            result = self.api_post(sender, "/api/v1/messages/batch", payload)
+        self.assert_json_success(result)
+        rate_limit_mock.assert_called_once_with(mock.ANY, sender, domain="api_by_user", weight=2)
+
+        # Nothing is sent if the messages would exceed the limit.
+        last_message_id = self.get_last_message().id
+        with self.settings(RATE_LIMITING=True), mock.patch(
+            "zerver.views.message_send.rate_limit_user", side_effect=RateLimited(10.0)
+        ):
+            result = self.api_post(sender, "/api/v1/messages/batch", payload)
+        self.assertEqual(result.status_code, 429)
+        self.assertEqual(self.get_last_message().id, last_message_id)
+
 
 class ScheduledMessageTest(ZulipTestCase):
     def last_scheduled_message(self) -> ScheduledMessage:
@@ -1614,6 +1701,47 @@ class StreamMessagesTest(ZulipTestCase):
         num_active_users = num_extra_users / 2
         self.assertTrue(ums_created > (num_active_users * num_messages))
 
+    def test_bulk_insert_ums_with_copy(self) -> None:
+        sender = self.example_user("hamlet")
+        iago = self.example_user("iago")
+        self.subscribe(iago, "Denmark")
+        content = "@**Iago** check this out"
+
+        def sent_user_messages() -> Set[Tuple[int, int]]:
+            message_id = self.send_stream_message(sender, "Denmark", content)
+            return {
+                (um.user_profile_id, int(um.flags))
+                for um in UserMessage.objects.filter(message_id=message_id)
+            }
+
+        with mock.patch("zerver.lib.actions.copy_ums") as copy_ums:
+            inserted = sent_user_messages()
+        copy_ums.assert_not_called()
+
+        with mock.patch("zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD", 1), mock.patch(
+            "zerver.lib.actions.insert_ums"
+        ) as insert_ums:
+            copied = sent_user_messages()
+        insert_ums.assert_not_called()
+
+        self.assertEqual(copied, inserted)
+        self.assertIn((iago.id, int(UserMessage.flags.mentioned)), copied)
+
+        # Moving messages to a stream creates rows with a bitfield Bit,
+        # rather than an int, as their flags.
+        message_id = self.send_personal_message(sender, self.example_user("cordelia"))
+        with mock.patch("zerver.lib.actions.BULK_INSERT_UMS_COPY_THRESHOLD", 1):
+            bulk_insert_ums(
+                [
+                    UserMessageLite(
+                        user_profile_id=iago.id, message_id=message_id, flags=UserMessage.flags.read
+                    )
+                ]
+            )
+        self.assertTrue(
+            UserMessage.objects.get(user_profile=iago, message_id=message_id).flags.read
+        )
+
     def test_not_too_many_queries(self) -> None:
         recipient_list = [
             self.example_user("hamlet"),
@@ -1,3 +1,4 @@
+import time
 from typing import Any, Dict
 from unittest import mock
 
@@ -8,6 +9,7 @@ import responses
 from version import ZULIP_VERSION
 from zerver.lib.actions import do_create_user
 from zerver.lib.outgoing_webhook import (
+    CircuitBreaker,
     GenericOutgoingWebhookService,
     SlackOutgoingWebhookService,
     do_rest_call,
@@ -218,6 +220,47 @@ The webhook got a response with status code *400*.""",
 
             self.assertEqual(i.output, log_output)
 
+    def test_circuit_breaker(self) -> None:
+        bot_user = self.example_user("outgoing_webhook_bot")
+        mock_event = self.mock_event(bot_user)
+        service_handler = GenericOutgoingWebhookService("token", bot_user, "service")
+        circuit_breaker = CircuitBreaker(failure_threshold=2, reset_seconds=60)
+        url = "https://example.com/"
+
+        with mock.patch.object(service_handler, "session") as session, self.assertLogs(
+            level="INFO"
+        ):
+            session.post.side_effect = connection_error
+            do_rest_call(url, mock_event, service_handler, circuit_breaker)
+            do_rest_call(url, mock_event, service_handler, circuit_breaker)
+
+        bot_owner_notification = self.get_last_message()
+        self.assertIn("The webhook has failed 2 times in a row", bot_owner_notification.content)
+
+        # Now we don't even try to send requests to the URL.
+        with mock.patch.object(service_handler, "session") as session, self.assertLogs(
+            level="INFO"
+        ) as logs:
+            do_rest_call(url, mock_event, service_handler, circuit_breaker)
+        session.post.assert_not_called()
+        self.assertEqual(
+            logs.output,
+            [
+                f"INFO:root:Not sending trigger event {mock_event['command']} to {mock_event['service_name']}, "
+                "since its recent requests have failed"
+            ],
+        )
+
+        # Until the breaker resets, after which a success closes it.
+        with mock.patch.object(service_handler, "session") as session, mock.patch(
+            "zerver.lib.outgoing_webhook.monotonic", return_value=time.monotonic() + 61
+        ), self.assertLogs(level="INFO"):
+            session.post.return_value = ResponseMock(200, b"{}")
+            do_rest_call(url, mock_event, service_handler, circuit_breaker)
+            session.post.assert_called_once()
+        self.assertTrue(circuit_breaker.allow_request(url))
+        self.assertEqual(circuit_breaker.failures, {})
+
     def test_request_exception(self) -> None:
         bot_user = self.example_user("outgoing_webhook_bot")
         mock_event = self.mock_event(bot_user)
@@ -41,6 +41,7 @@ from zerver.lib.push_notifications import (
     get_message_payload_gcm,
     get_mobile_push_content,
     handle_push_notification,
+    handle_push_notifications,
     handle_remove_push_notification,
     hex_to_b64,
     modernize_apns_payload,
@@ -59,7 +60,7 @@ from zerver.lib.remote_server import (
 from zerver.lib.response import json_response_from_error
 from zerver.lib.soft_deactivation import do_soft_deactivate_users
 from zerver.lib.test_classes import ZulipTestCase
-from zerver.lib.test_helpers import mock_queue_publish
+from zerver.lib.test_helpers import mock_queue_publish, queries_captured
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.user_groups import create_user_group
 from zerver.models import (
@@ -1400,6 +1401,111 @@ class HandlePushNotificationTest(PushNotificationTest):
         # Check we didn't proceed ahead and function returned.
         mock_info.assert_not_called()
 
+    def test_handle_push_notifications_batch(self) -> None:
+        self.setup_apns_tokens()
+        self.setup_gcm_tokens()
+        othello = self.example_user("othello")
+        message = self.get_message(Recipient.PERSONAL, type_id=1)
+        read_message = self.get_message(Recipient.PERSONAL, type_id=1)
+        for user_profile in [self.user_profile, othello]:
+            UserMessage.objects.create(user_profile=user_profile, message=message)
+        UserMessage.objects.create(
+            user_profile=self.user_profile, message=read_message, flags=UserMessage.flags.read
+        )
+
+        android_devices = list(
+            PushDeviceToken.objects.filter(user=self.user_profile, kind=PushDeviceToken.GCM)
+        )
+        apple_devices = list(
+            PushDeviceToken.objects.filter(user=self.user_profile, kind=PushDeviceToken.APNS)
+        )
+
+        missed_messages = [
+            {"user_profile_id": user_id, "message_id": message_id, "trigger": "private_message"}
+            for (user_id, message_id) in [
+                (self.user_profile.id, message.id),
+                (othello.id, message.id),
+                # Duplicates and read messages don't get a notification.
+                (othello.id, message.id),
+                (self.user_profile.id, read_message.id),
+            ]
+        ]
+        with mock.patch(
+            "zerver.lib.push_notifications.get_message_payload_apns", return_value={"apns": True}
+        ), mock.patch(
+            "zerver.lib.push_notifications.get_message_payload_gcm",
+            return_value=({"gcm": True}, {}),
+        ), mock.patch(
+            "zerver.lib.push_notifications.send_apple_push_notifications"
+        ) as mock_send_apple, mock.patch(
+            "zerver.lib.push_notifications.send_android_push_notification"
+        ) as mock_send_android, mock.patch(
+            "zerver.lib.push_notifications.push_notifications_enabled", return_value=True
+        ), self.assertLogs(
+            "zerver.lib.push_notifications", level="INFO"
+        ), queries_captured() as queries:
+            self.assertEqual(handle_push_notifications(missed_messages), [])
+
+        # Users, messages, UserMessage rows, marking the notifications
+        # as active, and device tokens, for the whole batch.
+        self.assert_length(queries, 5)
+        mock_send_apple.assert_called_once_with(
+            [
+                (self.user_profile.id, apple_devices, {"apns": True}),
+                (othello.id, [], {"apns": True}),
+            ]
+        )
+        self.assertEqual(
+            mock_send_android.call_args_list,
+            [
+                mock.call(self.user_profile.id, android_devices, {"gcm": True}, {}),
+                mock.call(othello.id, [], {"gcm": True}, {}),
+            ],
+        )
+        for user_profile in [self.user_profile, othello]:
+            user_message = UserMessage.objects.get(user_profile=user_profile, message=message)
+            self.assertTrue(user_message.flags.active_mobile_push_notification)
+        user_message = UserMessage.objects.get(user_profile=self.user_profile, message=read_message)
+        self.assertFalse(user_message.flags.active_mobile_push_notification)
+
+    def test_handle_push_notifications_batch_error(self) -> None:
+        othello = self.example_user("othello")
+        message = self.get_message(Recipient.PERSONAL, type_id=1)
+        for user_profile in [self.user_profile, othello]:
+            UserMessage.objects.create(user_profile=user_profile, message=message)
+        missed_messages = [
+            {"user_profile_id": user_id, "message_id": message.id, "trigger": "private_message"}
+            for user_id in [self.user_profile.id, othello.id]
+        ]
+
+        # An error for one event doesn't affect the rest of the batch.
+        with mock.patch(
+            "zerver.lib.push_notifications.get_message_payload_apns",
+            side_effect=[JsonableError("Invalid user group ID"), {"apns": True}],
+        ), mock.patch(
+            "zerver.lib.push_notifications.get_message_payload_gcm",
+            return_value=({"gcm": True}, {}),
+        ), mock.patch(
+            "zerver.lib.push_notifications.send_apple_push_notifications"
+        ) as mock_send_apple, mock.patch(
+            "zerver.lib.push_notifications.send_android_push_notification"
+        ), mock.patch(
+            "zerver.lib.push_notifications.push_notifications_enabled", return_value=True
+        ), self.assertLogs(
+            "zerver.lib.push_notifications", level="INFO"
+        ) as logs:
+            self.assertEqual(handle_push_notifications(missed_messages), [])
+
+        self.assertIn(
+            f"ERROR:zerver.lib.push_notifications:Error sending push notification for user {self.user_profile.id}, message {message.id}",
+            logs.output[0],
+        )
+        mock_send_apple.assert_called_once_with([(othello.id, [], {"apns": True})])
+        user_message = UserMessage.objects.get(user_profile=self.user_profile, message=message)
+        self.assertFalse(user_message.flags.active_mobile_push_notification)
+        user_message = UserMessage.objects.get(user_profile=othello, message=message)
+        self.assertTrue(user_message.flags.active_mobile_push_notification)
+
 
 class TestAPNs(PushNotificationTest):
     def devices(self) -> List[DeviceToken]:
@@ -8,8 +8,10 @@ from pika.exceptions import AMQPConnectionError, ConnectionClosed
 from zerver.lib.queue import (
     SimpleQueueClient,
     TornadoQueueClient,
+    batched_queue_publish,
     get_queue_client,
     queue_json_publish,
+    queue_json_publish_many,
 )
 from zerver.lib.test_classes import ZulipTestCase
 
@@ -78,6 +80,39 @@ class TestQueueImplementation(ZulipTestCase):
         self.assert_length(output, 1)
         self.assertEqual(output[0]["event"], "my_event")
 
+    @override_settings(USING_RABBITMQ=True)
+    def test_publish_many(self) -> None:
+        output: List[Dict[str, Any]] = []
+
+        queue_client = get_queue_client()
+        assert isinstance(queue_client, SimpleQueueClient)
+        assert queue_client.channel
+
+        def collect(events: List[Dict[str, Any]]) -> None:
+            assert isinstance(queue_client, SimpleQueueClient)
+            output.extend(events)
+            queue_client.stop_consuming()
+
+        with batched_queue_publish():
+            queue_json_publish("test_suite", {"event": "first"})
+            with batched_queue_publish():
+                queue_json_publish_many("test_suite", [{"event": "second"}])
+            # Nothing is sent until the outermost block exits.
+            (_, _, message) = queue_client.channel.basic_get("test_suite")
+            assert not message
+        queue_json_publish_many("test_suite", [{"event": "third"}, {"event": "fourth"}])
+
+        queue_client.start_json_consumer("test_suite", collect, batch_size=4, timeout=1)
+        self.assertEqual(
+            [event["event"] for event in output], ["first", "second", "third", "fourth"]
+        )
+
+    def test_publish_many_without_rabbitmq(self) -> None:
+        events: List[Dict[str, Any]] = []
+        with batched_queue_publish():
+            queue_json_publish_many("test_suite", [{"event": "first"}], events.append)
+            self.assertEqual(events, [{"event": "first"}])
+
     @override_settings(USING_RABBITMQ=True)
     def test_queue_error_json(self) -> None:
         queue_client = get_queue_client()
@@ -2,12 +2,14 @@ import base64
 import datetime
 import os
 import signal
+import threading
 import time
 from collections import defaultdict
 from contextlib import contextmanager
 from inspect import isabstract
 from typing import Any, Callable, Dict, Iterator, List, Mapping, Optional
-from unittest.mock import MagicMock, patch
+from unittest.mock import MagicMock, call, patch
+from urllib.parse import urlsplit
 
 import orjson
 from django.conf import settings
@@ -22,12 +24,17 @@ from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
 from zerver.lib.send_email import EmailNotDeliveredException, FromAddress
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import mock_queue_publish
+from zerver.lib.url_preview import preview as url_preview
+from zerver.lib.users import add_service
 from zerver.models import (
     NotificationTriggers,
     PreregistrationUser,
     ScheduledMessageNotificationEmail,
+    Service,
     UserActivity,
+    UserMessage,
     UserProfile,
+    get_bot_services,
     get_client,
     get_realm,
     get_stream,
@@ -35,6 +42,7 @@ from zerver.models import (
 from zerver.tornado.event_queue import build_offline_notification
 from zerver.worker import queue_processors
 from zerver.worker.queue_processors import (
+    DeferredWorker,
     EmailSendingWorker,
     FetchLinksEmbedData,
     LoopQueueProcessingWorker,
@@ -59,12 +67,15 @@ class FakeClient:
         callback: Callable[[List[Dict[str, Any]]], None],
         batch_size: int = 1,
         timeout: Optional[int] = None,
+        lag_callback: Optional[Callable[[List[float]], None]] = None,
     ) -> None:
         chunk: List[Dict[str, Any]] = []
         queue = self.queues[queue_name]
         while queue:
             chunk.append(queue.pop(0))
             if len(chunk) >= batch_size or not len(queue):
+                if lag_callback is not None:
+                    lag_callback([0.0] * len(chunk))
                 callback(chunk)
                 chunk = []
 
@@ -385,7 +396,7 @@ class WorkerTest(ZulipTestCase):
         """
         The push notifications system has its own comprehensive test suite,
         so we can limit ourselves to simple unit testing the queue processor,
-        without going deeper into the system - by mocking the handle_push_notification
+        without going deeper into the system - by mocking the handle_push_notifications
         functions to immediately produce the effect we want, to test its handling by the queue
         processor.
         """
@@ -410,7 +421,7 @@ class WorkerTest(ZulipTestCase):
             worker = queue_processors.PushNotificationsWorker()
             worker.setup()
             with patch(
-                "zerver.worker.queue_processors.handle_push_notification"
+                "zerver.worker.queue_processors.handle_push_notifications", return_value=[]
             ) as mock_handle_new, patch(
                 "zerver.worker.queue_processors.handle_remove_push_notification"
             ) as mock_handle_remove, patch(
@@ -422,14 +433,15 @@ class WorkerTest(ZulipTestCase):
                 fake_client.enqueue("missedmessage_mobile_notifications", event_remove)
 
                 worker.start()
-                mock_handle_new.assert_called_once_with(event_new["user_profile_id"], event_new)
+                mock_handle_new.assert_called_once_with([event_new])
                 mock_handle_remove.assert_called_once_with(
                     event_remove["user_profile_id"], event_remove["message_ids"]
                 )
 
             with patch(
-                "zerver.worker.queue_processors.handle_push_notification",
-                side_effect=PushNotificationBouncerRetryLaterError("test"),
+                "zerver.worker.queue_processors.handle_push_notifications",
+                # Ask for every event in the batch to be retried.
+                side_effect=lambda events: events,
             ) as mock_handle_new, patch(
                 "zerver.worker.queue_processors.handle_remove_push_notification",
                 side_effect=PushNotificationBouncerRetryLaterError("test"),
@@ -472,6 +484,102 @@ class WorkerTest(ZulipTestCase):
                 # The `message_id` field should have been converted to a list with a single element.
                 mock_handle_remove.assert_called_once_with(10, [33])
 
+    def test_outgoing_webhook_worker(self) -> None:
+        bot = self.example_user("outgoing_webhook_bot")
+        add_service(
+            "qotd",
+            user_profile=bot,
+            interface=Service.GENERIC,
+            base_url="https://qotd.example.com/",
+            token="qotd_token",
+        )
+        services = get_bot_services(bot.id)
+        events = [
+            dict(message=dict(content=f"message {i}"), trigger="mention", user_profile_id=bot.id)
+            for i in range(3)
+        ]
+
+        worker = queue_processors.OutgoingWebhookWorker()
+        with patch.object(worker, "deliver") as mock_deliver:
+            worker.consume_batch(events)
+        self.assertEqual(
+            sorted(
+                (service.id, event["service_name"], event["command"])
+                for (service, event) in (call[0] for call in mock_deliver.call_args_list)
+            ),
+            sorted(
+                (service.id, service.name, f"message {i}") for service in services for i in range(3)
+            ),
+        )
+
+        # Retried events only go to the service they were for, and
+        # once a service's budget for a batch is spent, its remaining
+        # events are put back in the queue.
+        retried_event = dict(events[0], service_name="qotd")
+        with patch.object(worker, "deliver") as mock_deliver, self.settings(
+            OUTGOING_WEBHOOK_SERVICE_BUDGET_SECONDS=0
+        ), mock_queue_publish(
+            "zerver.worker.queue_processors.queue_json_publish"
+        ) as mock_publish, self.assertLogs(
+            level="INFO"
+        ):
+            worker.consume_batch([retried_event])
+        mock_deliver.assert_not_called()
+        mock_publish.assert_called_once_with("outgoing_webhooks", retried_event, None)
+
+        # An error delivering one event doesn't affect the others.
+        retried_events = [dict(event, service_name="qotd") for event in events]
+        with patch.object(
+            worker, "deliver", side_effect=[Exception("bad event"), None, None]
+        ) as mock_deliver, self.settings(OUTGOING_WEBHOOK_CONCURRENCY_PER_SERVICE=1), patch(
+            "zerver.worker.queue_processors.close_old_connections"
+        ) as mock_close_old_connections, self.assertLogs(
+            level="ERROR"
+        ) as logs:
+            worker.consume_batch(retried_events)
+        self.assertEqual(mock_deliver.call_count, 3)
+        # The pool thread checks its database connection before and
+        # after its task.
+        self.assertEqual(mock_close_old_connections.call_count, 2)
+        self.assertIn(
+            "ERROR:root:Error delivering outgoing webhook event to service", logs.output[0]
+        )
+
+        assert worker.executor is not None
+        worker.executor.shutdown()
+
+    def test_mark_stream_messages_as_read_for_everyone(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        stream = self.subscribe(cordelia, "Deactivating stream")
+        self.subscribe(hamlet, "Deactivating stream")
+        message_ids = [self.send_stream_message(hamlet, "Deactivating stream") for i in range(5)]
+
+        def unread_count() -> int:
+            return (
+                UserMessage.objects.filter(user_profile=cordelia, message_id__in=message_ids)
+                .extra(where=[UserMessage.where_unread()])
+                .count()
+            )
+
+        self.assertEqual(unread_count(), 5)
+        event = {
+            "type": "mark_stream_messages_as_read_for_everyone",
+            "stream_recipient_id": stream.recipient_id,
+        }
+        # Each event marks 4 messages, and queues another event for
+        # the rest, which the test queue processes immediately.
+        with patch.object(DeferredWorker, "MARK_AS_READ_BATCH_SIZE", 2), patch.object(
+            DeferredWorker, "MARK_AS_READ_MESSAGES_PER_EVENT", 4
+        ), self.assertLogs("zerver.worker.queue_processors", "INFO") as info_logs:
+            DeferredWorker().consume(event)
+        self.assertEqual(unread_count(), 0)
+        marked_logs = [line for line in info_logs.output if "Marked" in line]
+        self.assert_length(marked_logs, 2)
+        # The re-queued event is processed before the first one returns.
+        self.assertIn("Marked 1 messages", marked_logs[0])
+        self.assertIn("Marked 4 messages", marked_logs[1])
+
     @patch("zerver.worker.queue_processors.mirror_email")
     def test_mirror_worker(self, mock_mirror_email: MagicMock) -> None:
         fake_client = FakeClient()
@@ -723,6 +831,41 @@ class WorkerTest(ZulipTestCase):
             ["good", "fine", "unexpected behaviour", "back to normal"],
         )
 
+    def test_statistics(self) -> None:
+        @queue_processors.assign_queue("stats_worker", is_test_queue=True)
+        class StatsWorker(queue_processors.LoopQueueProcessingWorker):
+            batch_size = 2
+
+            def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+                pass
+
+        fake_client = FakeClient()
+        for i in range(3):
+            fake_client.enqueue("stats_worker", {"index": i})
+
+        with simulated_queue_client(fake_client):
+            worker = StatsWorker()
+            worker.setup()
+            worker.start()
+
+        self.assertEqual(worker.batch_size_histogram.counts[:3], [1, 1, 0])
+        self.assertEqual(worker.batch_size_histogram.percentile(0.5), 1)
+        self.assertEqual(worker.batch_size_histogram.percentile(0.99), 2)
+        self.assertEqual(worker.queue_lag_histogram.count, 3)
+
+        with open(os.path.join(settings.QUEUE_STATS_DIR, "stats_worker.stats"), "rb") as f:
+            stats = orjson.loads(f.read())
+        self.assertEqual(stats["queue_lag_p99"], 0.001)
+
+        with open(os.path.join(settings.QUEUE_STATS_DIR, "stats_worker.prom")) as f:
+            lines = f.read().splitlines()
+        self.assertIn("# TYPE zulip_queue_lag_seconds histogram", lines)
+        self.assertIn('zulip_queue_lag_seconds_bucket{queue="stats_worker",le="0.001"} 3', lines)
+        self.assertIn('zulip_queue_batch_size_bucket{queue="stats_worker",le="1"} 1', lines)
+        self.assertIn('zulip_queue_batch_size_bucket{queue="stats_worker",le="+Inf"} 2', lines)
+        self.assertIn('zulip_queue_batch_size_sum{queue="stats_worker"} 3.0', lines)
+        self.assertIn('zulip_queue_consume_seconds_count{queue="stats_worker"} 2', lines)
+
     def test_timeouts(self) -> None:
         processed = []
 
@@ -765,12 +908,48 @@ class WorkerTest(ZulipTestCase):
         event = events[0]
         self.assertEqual(event["type"], "timeout")
 
+    def test_timeouts_in_thread(self) -> None:
+        processed = []
+
+        @queue_processors.assign_queue("timeout_worker", is_test_queue=True)
+        class TimeoutWorker(queue_processors.QueueProcessingWorker):
+            MAX_CONSUME_SECONDS = 1
+
+            def consume(self, data: Mapping[str, Any]) -> None:
+                if data["type"] == "timeout":
+                    for i in range(50):
+                        time.sleep(0.1)
+                processed.append(data["type"])
+
+        fake_client = FakeClient()
+        for msg in ["good", "timeout", "back to normal"]:
+            fake_client.enqueue("timeout_worker", {"type": msg})
+
+        with simulated_queue_client(fake_client):
+            worker = TimeoutWorker()
+            worker.setup()
+            worker.ENABLE_TIMEOUTS = True
+            with self.assertLogs(level="ERROR") as m:
+                thread = threading.Thread(target=worker.start)
+                thread.start()
+                thread.join()
+                self.assertEqual(
+                    m.records[0].message,
+                    "Timed out in timeout_worker after 1 seconds processing 1 events",
+                )
+
+        self.assertEqual(processed, ["good", "back to normal"])
+
     def test_embed_links_timeout(self) -> None:
         @queue_processors.assign_queue("timeout_worker", is_test_queue=True)
         class TimeoutWorker(FetchLinksEmbedData):
             MAX_CONSUME_SECONDS = 1
 
-            def consume(self, data: Mapping[str, Any]) -> None:
+            def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+                if threading.current_thread() is not threading.main_thread():
+                    for i in range(50):
+                        time.sleep(0.1)
+                    return
                 # Send SIGALRM to ourselves to simulate a timeout.
                 pid = os.getpid()
                 os.kill(pid, signal.SIGALRM)
@@ -796,6 +975,109 @@ class WorkerTest(ZulipTestCase):
                     "Timed out in timeout_worker after 1 seconds while fetching URLs for message 15: ['first', 'second']",
                 )
 
+            # Threaded workers use the same timer_expired handler.
+            fake_client.enqueue(
+                "timeout_worker",
+                {
+                    "type": "timeout",
+                    "message_id": 16,
+                    "urls": ["third"],
+                },
+            )
+            with self.assertLogs(level="WARNING") as m:
+                thread = threading.Thread(target=worker.start)
+                thread.start()
+                thread.join()
+            self.assertEqual(
+                m.output,
+                [
+                    "WARNING:root:Timed out in timeout_worker after 1 seconds while fetching URLs for message 16: ['third']"
+                ],
+            )
+
+    def test_embed_links_concurrency(self) -> None:
+        worker = FetchLinksEmbedData()
+        lock = threading.Lock()
+        fetching: Dict[str, int] = defaultdict(int)
+        max_fetching: Dict[str, int] = defaultdict(int)
+        fetched: List[str] = []
+
+        def fake_get_link_embed_data(url: str) -> None:
+            domain = urlsplit(url).netloc
+            with lock:
+                fetching[domain] += 1
+                max_fetching[domain] = max(max_fetching[domain], fetching[domain])
+            time.sleep(0.01)
+            with lock:
+                fetching[domain] -= 1
+                fetched.append(url)
+
+        urls = [
+            f"https://{domain}/{i}"
+            for domain in ["one.example.com", "two.example.com"]
+            for i in range(5)
+        ]
+        with patch(
+            "zerver.lib.url_preview.preview.get_link_embed_data",
+            side_effect=fake_get_link_embed_data,
+        ), self.assertLogs(level="INFO"):
+            worker.fetch_link_embed_data(set(urls))
+        self.assertEqual(sorted(fetched), sorted(urls))
+        self.assertEqual(set(max_fetching), {"one.example.com", "two.example.com"})
+        self.assertLessEqual(max(max_fetching.values()), worker.FETCH_THREADS_PER_DOMAIN)
+
+    def test_embed_links_errors(self) -> None:
+        worker = FetchLinksEmbedData()
+        events = [
+            {
+                "message_id": message_id,
+                "message_content": "https://example.com/",
+                "message_realm_id": get_realm("zulip").id,
+                "urls": [url],
+            }
+            for (message_id, url) in [
+                (-1, "https://example.com/bad"),
+                (-2, "https://example.com/"),
+                (-3, "https://down.example.com/"),
+            ]
+        ]
+
+        def fake_get_link_embed_data(url: str) -> None:
+            if url.endswith("/bad"):
+                raise Exception("bad URL")
+            if url.startswith("https://down."):
+                raise url_preview.PreviewHostUnavailableError(url)
+
+        # Errors fetching one URL, or rendering one message, don't
+        # affect the rest of the batch.
+        with patch(
+            "zerver.lib.url_preview.preview.get_link_embed_data",
+            side_effect=fake_get_link_embed_data,
+        ) as mock_fetch, patch.object(
+            worker, "render_message_embeds", side_effect=[Exception("bad message"), None, None]
+        ) as mock_render, self.assertLogs(
+            level="INFO"
+        ) as logs:
+            worker.consume_batch(events)
+        self.assertEqual(mock_fetch.call_count, 3)
+        self.assertEqual(mock_render.call_args_list, [call(event) for event in events])
+        errors = [line.split("\n")[0] for line in logs.output if line.startswith("ERROR")]
+        self.assertEqual(
+            sorted(errors),
+            [
+                "ERROR:root:Error fetching link preview for https://example.com/bad",
+                "ERROR:root:Error rendering link previews for message -1",
+            ],
+        )
+        # A host in the failure cache is expected, not an error.
+        self.assertIn(
+            "INFO:root:Skipping link preview for https://down.example.com/; its host recently failed",
+            logs.output,
+        )
+
+        # Deleted messages are skipped.
+        worker.render_message_embeds(events[0])
+
     def test_worker_noname(self) -> None:
         class TestWorker(queue_processors.QueueProcessingWorker):
             def __init__(self) -> None:
@@ -811,7 +1093,12 @@ class WorkerTest(ZulipTestCase):
         test_queue_names = set(get_active_worker_queues(only_test_queues=True))
         worker_queue_names = {
             queue_class.queue_name
-            for base in [QueueProcessingWorker, EmailSendingWorker, LoopQueueProcessingWorker]
+            for base in [
+                QueueProcessingWorker,
+                EmailSendingWorker,
+                LoopQueueProcessingWorker,
+                DeferredWorker,
+            ]
             for queue_class in base.__subclasses__()
             if not isabstract(queue_class)
         }
@@ -106,6 +106,28 @@ class RateLimiterBackendBase(ZulipTestCase):
         with mock.patch("time.time", return_value=(start_time + 2.01)):
             self.make_request(obj, expect_ratelimited=False)
 
+    def test_weighted_request(self) -> None:
+        obj = self.create_object("test", [(2, 4)])
+        # A whole number of seconds, so the in-memory backend's
+        # arithmetic is exact.
+        start_time = float(int(time.time()))
+        with mock.patch("time.time", return_value=start_time):
+            self.assertEqual(obj.rate_limit(weight=3), (False, 0.0))
+            self.assertEqual(obj.api_calls_left()[0], 1)
+
+            # A request that doesn't fit in what's left is refused
+            # without using any of it.
+            self.assertTrue(obj.rate_limit(weight=2)[0])
+            self.assertEqual(obj.api_calls_left()[0], 1)
+            self.assertEqual(obj.rate_limit(), (False, 0.0))
+            self.assertTrue(obj.rate_limit()[0])
+
+        # One heavier than the limit itself is always refused.
+        obj.clear_history()
+        with mock.patch("time.time", return_value=start_time):
+            self.assertTrue(obj.rate_limit(weight=5)[0])
+            self.assertEqual(obj.api_calls_left()[0], 4)
+
     def test_clear_history(self) -> None:
         obj = self.create_object("test", [(2, 3)])
         start_time = time.time()
@@ -6,14 +6,14 @@ import orjson
 from django.conf import settings
 from django.test import override_settings
 
-from zerver.lib.actions import do_create_user, get_service_bot_events
+from zerver.lib.actions import do_create_user, get_service_bot_events, internal_send_stream_message
 from zerver.lib.bot_config import ConfigError, load_bot_config_template, set_bot_config
 from zerver.lib.bot_lib import EmbeddedBotEmptyRecipientsList, EmbeddedBotHandler, StateHandler
 from zerver.lib.bot_storage import StateError
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import patch_queue_publish
 from zerver.lib.validator import check_string
-from zerver.models import Recipient, UserProfile, get_realm
+from zerver.models import Recipient, UserProfile, get_realm, get_stream
 
 BOT_TYPE_TO_QUEUE_NAME = {
     UserProfile.OUTGOING_WEBHOOK_BOT: "outgoing_webhooks",
@@ -478,6 +478,42 @@ class TestServiceBotEventTriggers(ZulipTestCase):
         self.send_stream_message(self.user_profile, "Denmark", content)
         self.assertTrue(mock_queue_json_publish.called)
 
+    @mock.patch("zerver.lib.actions.queue_json_publish_many")
+    def test_message_sent_record(self, mock_queue_json_publish_many: mock.Mock) -> None:
+        # Service bot events are sent by the message_sent worker, from
+        # a record that doesn't include the message itself.
+        message_id = self.send_stream_message(
+            self.user_profile, "Denmark", "@**FooBot** foo bar!!!"
+        )
+        mock_queue_json_publish_many.assert_called_once()
+        queue_name, events = mock_queue_json_publish_many.call_args[0]
+        self.assertEqual(queue_name, "message_sent")
+        self.assert_length(events, 1)
+        self.assertEqual(events[0]["message_id"], message_id)
+        self.assertEqual(
+            events[0]["service_bot_events"],
+            {"outgoing_webhooks": [{"trigger": "mention", "user_profile_id": self.bot_profile.id}]},
+        )
+        self.assertEqual(events[0]["links_for_embed"], [])
+
+        # Messages without service bots or links don't need the worker.
+        self.send_stream_message(self.user_profile, "Denmark", "foo bar")
+        mock_queue_json_publish_many.assert_called_once()
+
+        # The record is only queued once the message is committed.
+        mock_queue_json_publish_many.reset_mock()
+        with self.captureOnCommitCallbacks() as callbacks:
+            internal_send_stream_message(
+                self.user_profile,
+                get_stream("Denmark", self.user_profile.realm),
+                "test",
+                "@**FooBot**",
+            )
+        mock_queue_json_publish_many.assert_not_called()
+        for callback in callbacks:
+            callback()
+        mock_queue_json_publish_many.assert_called_once()
+
     @patch_queue_publish("zerver.lib.actions.queue_json_publish")
     def test_no_trigger_on_stream_message_without_mention(
         self, mock_queue_json_publish: mock.Mock
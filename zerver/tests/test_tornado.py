@@ -1,5 +1,5 @@
 import urllib.parse
-from typing import Any, Dict, Optional
+from typing import Any, Dict, List, Optional
 
 import orjson
 from django.conf import settings
@@ -126,3 +126,32 @@ class EventsTestCase(TornadoWebTestCase):
             ],
         )
         self.assertEqual(data["result"], "success")
+
+    def test_events_stream(self) -> None:
+        user_profile = self.example_user("hamlet")
+        self.login_user(user_profile)
+        event_queue_id = self.create_queue()
+        process_event(dict(type="test", data="queued"), [user_profile.id])
+        data = {
+            "queue_id": event_queue_id,
+            "last_event_id": -1,
+        }
+
+        chunks: List[bytes] = []
+        path = f"/json/events/stream?{urllib.parse.urlencode(data)}"
+        self.fetch_async("GET", path, streaming_callback=chunks.append)
+
+        def process_events() -> None:
+            process_event(dict(type="test", data="streamed"), [user_profile.id])
+            # Deleting the queue ends the stream.
+            self.io_loop.call_later(0.1, event_queue.clients[event_queue_id].cleanup)
+
+        self.io_loop.call_later(0.1, process_events)
+        response = self.wait()
+        self.assertEqual(response.headers["Content-Type"], "text/event-stream")
+        self.assertEqual(
+            b"".join(chunks),
+            b'id: 0\ndata: [{"type":"test","data":"queued","id":0}]\n\n'
+            b'id: 1\ndata: [{"type":"test","data":"streamed","id":1}]\n\n',
+        )
+        self.assertNotIn(event_queue_id, event_queue.clients)
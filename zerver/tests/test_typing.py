@@ -1,6 +1,9 @@
+import time
 from typing import Any, List, Mapping
+from unittest import mock
 
 import orjson
+from django.conf import settings
 
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import queries_captured
@@ -497,3 +500,47 @@ class TestSendTypingNotificationsSettings(ZulipTestCase):
             result = self.api_post(sender, "/api/v1/typing", params)
         self.assert_json_error(result, "User has disabled typing notifications for stream messages")
         self.assertEqual(events, [])
+
+
+class TypingEphemeralEventsTest(ZulipTestCase):
+    def test_coalesce_repeated_notifications(self) -> None:
+        sender = self.example_user("hamlet")
+        recipient_user = self.example_user("othello")
+        params = dict(to=orjson.dumps([recipient_user.id]).decode(), op="start")
+
+        events: List[Mapping[str, Any]] = []
+        with self.tornado_redirected_to_list(events, expected_num_events=1):
+            self.assert_json_success(self.api_post(sender, "/api/v1/typing", params))
+            # A repeat, e.g. from another browser tab, is dropped.
+            self.assert_json_success(self.api_post(sender, "/api/v1/typing", params))
+
+        # The same notification is delivered again once it is no
+        # longer recent.
+        with mock.patch("time.time", return_value=time.time() + 10):
+            with self.tornado_redirected_to_list(events, expected_num_events=1):
+                self.assert_json_success(self.api_post(sender, "/api/v1/typing", params))
+
+            params["op"] = "stop"
+            with self.tornado_redirected_to_list(events, expected_num_events=1):
+                self.assert_json_success(self.api_post(sender, "/api/v1/typing", params))
+            self.assertEqual(events[0]["event"]["op"], "stop")
+
+        # Typing notifications are sent to Tornado over UDP, rather
+        # than through RabbitMQ.
+        with self.settings(USING_TORNADO=True), mock.patch(
+            "zerver.tornado.django_api.ephemeral_event_socket"
+        ) as mock_socket, mock.patch("zerver.tornado.django_api.queue_json_publish") as m:
+            self.assert_json_success(self.api_post(sender, "/api/v1/typing", params))
+        m.assert_not_called()
+        datagram, address = mock_socket().sendto.call_args[0]
+        self.assertEqual(address, ("127.0.0.1", settings.TORNADO_PORTS[0]))
+        data = orjson.loads(datagram)
+        self.assertEqual(data["secret"], settings.SHARED_SECRET)
+        self.assertEqual(data["notice"]["event"]["op"], "stop")
+        self.assertEqual(set(data["notice"]["users"]), {sender.id, recipient_user.id})
+
+        with self.settings(TORNADO_EPHEMERAL_EVENTS=False), mock.patch(
+            "zerver.tornado.django_api.queue_json_publish"
+        ) as m:
+            self.assert_json_success(self.api_post(sender, "/api/v1/typing", params))
+        m.assert_called_once()
@@ -11,10 +11,12 @@ from django.test import override_settings
 from django.utils.timezone import now as timezone_now
 
 from zerver.lib.actions import (
+    RecipientInfoResult,
     change_user_is_active,
     create_users,
     do_change_can_create_users,
     do_change_user_role,
+    do_change_user_setting,
     do_create_user,
     do_deactivate_user,
     do_delete_user,
@@ -1768,6 +1770,60 @@ class RecipientInfoTest(ZulipTestCase):
         )
         self.assertEqual(info["default_bot_user_ids"], {normal_bot.id})
 
+    def test_stream_recipient_info_snapshot(self) -> None:
+        hamlet = self.example_user("hamlet")
+        cordelia = self.example_user("cordelia")
+        othello = self.example_user("othello")
+        realm = hamlet.realm
+
+        stream_name = "Test stream"
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, stream_name)
+        stream = get_stream(stream_name, realm)
+        recipient = stream.recipient
+        assert recipient is not None
+        stream_topic = StreamTopicTarget(
+            stream_id=stream.id,
+            topic_name="test topic",
+        )
+
+        def get_info() -> RecipientInfoResult:
+            return get_recipient_info(
+                realm_id=realm.id,
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+                possible_wildcard_mention=False,
+            )
+
+        # The first message fetches the subscribers; later ones only
+        # need to check for muted topics.
+        with queries_captured() as queries:
+            info = get_info()
+        self.assert_length(queries, 4)
+        self.assertEqual(info["active_user_ids"], {hamlet.id, cordelia.id})
+        with queries_captured() as queries:
+            info = get_info()
+        self.assert_length(queries, 1)
+        self.assertEqual(info["active_user_ids"], {hamlet.id, cordelia.id})
+
+        # Changes to the stream's subscriptions invalidate the snapshot.
+        self.subscribe(othello, stream_name)
+        self.assertEqual(get_info()["active_user_ids"], {hamlet.id, cordelia.id, othello.id})
+        self.unsubscribe(cordelia, stream_name)
+        self.assertEqual(get_info()["active_user_ids"], {hamlet.id, othello.id})
+
+        sub = get_subscription(stream_name, othello)
+        sub.push_notifications = True
+        sub.save(update_fields=["push_notifications"])
+        self.assertEqual(get_info()["stream_push_user_ids"], {othello.id})
+
+        # As do changes to the users' settings, or to whether they are active.
+        do_change_user_setting(hamlet, "enable_stream_push_notifications", True, acting_user=None)
+        self.assertEqual(get_info()["stream_push_user_ids"], {hamlet.id, othello.id})
+        change_user_is_active(othello, False)
+        self.assertEqual(get_info()["active_user_ids"], {hamlet.id})
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user("hamlet")
         realm = hamlet.realm
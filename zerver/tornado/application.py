@@ -20,8 +20,11 @@ def create_tornado_application() -> tornado.web.Application:
     urls = (
         r"/notify_tornado",
         r"/json/events",
+        r"/json/events/stream",
         r"/api/v1/events",
+        r"/api/v1/events/stream",
         r"/api/v1/events/internal",
+        r"/api/v1/events/internal/stats",
     )
 
     return tornado.web.Application(
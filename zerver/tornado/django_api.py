@@ -1,4 +1,6 @@
-from functools import lru_cache
+import logging
+import socket
+from functools import lru_cache, partial
 from typing import Any, Container, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple, Union
 from urllib.parse import urlparse
 
@@ -11,7 +13,12 @@ from requests.packages.urllib3.util.retry import Retry
 
 from zerver.lib.queue import queue_json_publish
 from zerver.models import Client, Realm, UserProfile
-from zerver.tornado.sharding import get_tornado_port, get_tornado_uri, notify_tornado_queue_name
+from zerver.tornado.sharding import (
+    get_tornado_port,
+    get_tornado_ports,
+    get_tornado_uri,
+    notify_tornado_queue_name,
+)
 
 
 class TornadoAdapter(HTTPAdapter):
@@ -75,12 +82,13 @@ def request_event_queue(
     bulk_message_deletion: bool = False,
     stream_typing_notifications: bool = False,
     user_settings_object: bool = False,
+    batched_presence: bool = False,
 ) -> Optional[str]:
 
     if not settings.USING_TORNADO:
         return None
 
-    tornado_uri = get_tornado_uri(user_profile.realm)
+    tornado_uri = get_tornado_uri(user_profile.realm, user_profile.id)
     req = {
         "dont_block": "true",
         "apply_markdown": orjson.dumps(apply_markdown),
@@ -96,6 +104,7 @@ def request_event_queue(
         "bulk_message_deletion": orjson.dumps(bulk_message_deletion),
         "stream_typing_notifications": orjson.dumps(stream_typing_notifications),
         "user_settings_object": orjson.dumps(user_settings_object),
+        "batched_presence": orjson.dumps(batched_presence),
     }
 
     if event_types is not None:
@@ -111,7 +120,7 @@ def get_user_events(
     if not settings.USING_TORNADO:
         return []
 
-    tornado_uri = get_tornado_uri(user_profile.realm)
+    tornado_uri = get_tornado_uri(user_profile.realm, user_profile.id)
     post_data: Dict[str, Any] = {
         "queue_id": queue_id,
         "last_event_id": last_event_id,
@@ -124,7 +133,17 @@ def get_user_events(
     return resp.json()["events"]
 
 
-def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
+def send_event_queue_cleanup(port: int, queue_id: str, user_profile_id: int) -> None:
+    """Asks the Tornado process on the given port to delete one of its
+    event queues; see cleanup_event_queue."""
+    queue_json_publish(
+        notify_tornado_queue_name(port),
+        dict(event=dict(type="cleanup_queue", queue_id=queue_id), users=[user_profile_id]),
+        partial(send_notification_http, port),
+    )
+
+
+def send_notification_http(port: int, data: Mapping[str, Any]) -> None:
     if not settings.USING_TORNADO or settings.RUNNING_INSIDE_TORNADO:
         # To allow the backend test suite to not require a separate
         # Tornado process, we simply call the process_notification
@@ -139,9 +158,8 @@ def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
 
         process_notification(data)
     else:
-        tornado_uri = get_tornado_uri(realm)
         requests_client().post(
-            tornado_uri + "/notify_tornado",
+            f"http://127.0.0.1:{port}/notify_tornado",
             data=dict(data=orjson.dumps(data), secret=settings.SHARED_SECRET),
         )
 
@@ -161,9 +179,76 @@ def send_event(
 ) -> None:
     """`users` is a list of user IDs, or in some special cases like message
     send/update or embeds, dictionaries containing extra data."""
-    port = get_tornado_port(realm)
-    queue_json_publish(
-        notify_tornado_queue_name(port),
-        dict(event=event, users=list(users)),
-        lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs),
-    )
+    ports = get_tornado_ports(realm)
+    if len(ports) == 1:
+        port_users: Dict[int, List[Any]] = {ports[0]: list(users)}
+    else:
+        # The realm's users are sharded across several Tornado
+        # processes; each gets a copy of the event for its users.
+        # Message events also go to processes with none of the users,
+        # since they may have all_public_streams queues that need them,
+        # as do realm-level presence notices, which have no users.
+        port_users = (
+            {port: [] for port in ports}
+            if event["type"] == "message" or event.get("batched_only")
+            else {}
+        )
+        for user in users:
+            user_id = user if isinstance(user, int) else user["id"]
+            port_users.setdefault(get_tornado_port(realm, user_id), []).append(user)
+
+    for port, users_for_port in port_users.items():
+        queue_json_publish(
+            notify_tornado_queue_name(port),
+            dict(event=event, users=users_for_port),
+            partial(send_notification_http, port),
+        )
+
+
+# Ephemeral events larger than this are sent through RabbitMQ instead;
+# UDP datagrams can be at most 64KiB.
+MAX_EPHEMERAL_DATAGRAM_SIZE = 60000
+
+
+@lru_cache(None)
+def ephemeral_event_socket() -> socket.socket:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    return sock
+
+
+def send_notification_udp(port: int, data: Mapping[str, Any]) -> None:
+    if not settings.USING_TORNADO or settings.RUNNING_INSIDE_TORNADO:
+        # See the comment in send_notification_http.
+        from zerver.tornado.event_queue import process_ephemeral_notification
+
+        process_ephemeral_notification(data)
+        return
+
+    datagram = orjson.dumps(dict(notice=data, secret=settings.SHARED_SECRET))
+    if len(datagram) > MAX_EPHEMERAL_DATAGRAM_SIZE:
+        queue_json_publish(
+            notify_tornado_queue_name(port), data, partial(send_notification_http, port)
+        )
+        return
+    try:
+        ephemeral_event_socket().sendto(datagram, ("127.0.0.1", port))
+    except OSError as e:
+        # Ephemeral events are best-effort; see zerver/tornado/ephemeral.py.
+        logging.info("Dropped ephemeral event for Tornado port %s: %s", port, e)
+
+
+def send_ephemeral_event(realm: Realm, event: Mapping[str, Any], users: Iterable[int]) -> None:
+    """Like send_event, for events that are only useful for a few
+    seconds, like typing notifications.  These are sent directly to
+    Tornado, bypassing RabbitMQ, and may be dropped or coalesced with
+    other events on the way; see zerver/tornado/ephemeral.py."""
+    if not settings.TORNADO_EPHEMERAL_EVENTS:
+        send_event(realm, event, users)
+        return
+
+    port_users: Dict[int, List[int]] = {}
+    for user_id in users:
+        port_users.setdefault(get_tornado_port(realm, user_id), []).append(user_id)
+    for port, users_for_port in port_users.items():
+        send_notification_udp(port, dict(event=event, users=users_for_port))
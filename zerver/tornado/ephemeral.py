@@ -0,0 +1,43 @@
+import logging
+import socket
+
+import orjson
+import tornado.ioloop
+from django.conf import settings
+from django.utils.crypto import constant_time_compare
+
+from zerver.tornado.event_queue import process_ephemeral_notification
+
+# Ephemeral events, like typing notifications, are only useful for a
+# few seconds, and are sent at a high rate, so rather than going
+# through RabbitMQ, Django sends them to the Tornado process directly
+# as UDP datagrams on localhost, to the same port number Tornado
+# listens on for HTTP (see send_ephemeral_event).  Delivery is best
+# effort: a datagram that is dropped because Tornado is restarting or
+# its socket buffer is full is simply lost, which is harmless, since
+# clients repeat typing notifications while the user is typing.
+
+
+def handle_ephemeral_datagram(sock: socket.socket) -> None:
+    while True:
+        try:
+            datagram = sock.recv(65536)
+        except BlockingIOError:
+            return
+        try:
+            data = orjson.loads(datagram)
+            if not constant_time_compare(data["secret"], settings.SHARED_SECRET):
+                logging.warning("Ignoring ephemeral event with an invalid secret")
+                continue
+            process_ephemeral_notification(data["notice"])
+        except Exception:
+            logging.exception("Error processing ephemeral event", stack_info=True)
+
+
+def setup_ephemeral_event_listener(port: int) -> None:
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.setblocking(False)
+    sock.bind(("127.0.0.1", port))
+    tornado.ioloop.IOLoop.instance().add_handler(
+        sock, lambda fd, events: handle_ephemeral_datagram(sock), tornado.ioloop.IOLoop.READ
+    )
@@ -2,6 +2,7 @@
 # high-level documentation on how this system works.
 import atexit
 import copy
+import heapq
 import logging
 import os
 import random
@@ -9,7 +10,8 @@ import signal
 import sys
 import time
 import traceback
-from collections import deque
+from collections import ChainMap, deque
+from contextlib import contextmanager
 from dataclasses import asdict
 from typing import (
     AbstractSet,
@@ -18,7 +20,9 @@ from typing import (
     Collection,
     Deque,
     Dict,
+    Hashable,
     Iterable,
+    Iterator,
     List,
     Mapping,
     MutableMapping,
@@ -27,6 +31,7 @@ from typing import (
     Sequence,
     Set,
     Tuple,
+    TypeVar,
     Union,
     cast,
 )
@@ -39,13 +44,21 @@ from typing_extensions import TypedDict
 
 from version import API_FEATURE_LEVEL, ZULIP_MERGE_BASE, ZULIP_VERSION
 from zerver.decorator import cachify
+from zerver.lib.cache import cache_delete, cache_delete_many, cache_set_many
 from zerver.lib.exceptions import JsonableError
 from zerver.lib.message import MessageDict
 from zerver.lib.narrow import build_narrow_filter
 from zerver.lib.notification_data import UserMessageNotificationsData
+from zerver.lib.presence import (
+    BATCHED_PRESENCE_REALM_CACHE_TIMEOUT,
+    BATCHED_PRESENCE_REALM_REFRESH_FREQ_MSECS,
+    batched_presence_realm_cache_key,
+)
 from zerver.lib.queue import queue_json_publish, retry_event
+from zerver.lib.topic import get_topic_from_message_info
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_timer_restart
+from zerver.models import Realm
 from zerver.tornado.autoreload import add_reload_hook
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
 from zerver.tornado.exceptions import BadEventQueueIdError
@@ -55,13 +68,16 @@ from zerver.tornado.handlers import (
     get_handler_by_id,
     handler_stats_string,
 )
+from zerver.tornado.journal import EventQueueJournal, read_event_queue_journal
+from zerver.tornado.preserialized import PreserializedDict
+from zerver.tornado.sharding import get_tornado_port
 
 # The idle timeout used to be a week, but we found that in that
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; this is cheap, since the GC only
+# looks at queues whose expiry deadline has passed (see expiry_heap).
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
 
 # Capped limit for how long a client can request an event queue
@@ -75,6 +91,16 @@ MAX_QUEUE_TIMEOUT_SECS = 7 * 24 * 60 * 60
 # wireless routers that kill "inactive" http connections.
 HEARTBEAT_MIN_FREQ_SECS = 45
 
+# When TORNADO_EVENT_QUEUE_JOURNAL is enabled, how often we write
+# buffered journal records to disk, and how many records we allow to
+# accumulate before compacting the journal into a fresh snapshot.
+EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS = 1000
+EVENT_QUEUE_JOURNAL_COMPACTION_RECORDS = 200000
+
+# How long presence changes in a realm are buffered before being sent,
+# as a single event, to clients with the batched_presence capability.
+PRESENCE_BATCH_WINDOW_SECS = 2
+
 
 def create_heartbeat_event() -> Dict[str, str]:
     return dict(type="heartbeat")
@@ -97,6 +123,7 @@ class ClientDescriptor:
         bulk_message_deletion: bool = False,
         stream_typing_notifications: bool = False,
         user_settings_object: bool = False,
+        batched_presence: bool = False,
     ) -> None:
         # These objects are serialized on shutdown and restored on restart.
         # If fields are added or semantics are changed, temporary code must be
@@ -120,6 +147,12 @@ class ClientDescriptor:
         self.bulk_message_deletion = bulk_message_deletion
         self.stream_typing_notifications = stream_typing_notifications
         self.user_settings_object = user_settings_object
+        self.batched_presence = batched_presence
+        # Whether this client has an entry in expiry_heap.
+        self.gc_scheduled = False
+        # Set when the queue exceeded TORNADO_EVENT_QUEUE_MAX_EVENTS
+        # and is to be garbage-collected; see handle_overflow.
+        self.overflowed = False
 
         # Default for lifespan_secs is DEFAULT_EVENT_QUEUE_TIMEOUT_SECS;
         # but users can set it as high as MAX_QUEUE_TIMEOUT_SECS.
@@ -147,6 +180,7 @@ class ClientDescriptor:
             bulk_message_deletion=self.bulk_message_deletion,
             stream_typing_notifications=self.stream_typing_notifications,
             user_settings_object=self.user_settings_object,
+            batched_presence=self.batched_presence,
         )
 
     def __repr__(self) -> str:
@@ -179,17 +213,89 @@ class ClientDescriptor:
             d.get("bulk_message_deletion", False),
             d.get("stream_typing_notifications", False),
             d.get("user_settings_object", False),
+            d.get("batched_presence", False),
         )
         ret.last_connection_time = d["last_connection_time"]
         return ret
 
-    def add_event(self, event: Mapping[str, Any]) -> None:
+    def add_event(
+        self, event: Mapping[str, Any], overrides: Optional[Dict[str, Any]] = None
+    ) -> None:
+        if self.overflowed:
+            return
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_timer_restart(handler._request)
 
-        self.event_queue.push(event)
+        self.event_queue.push(event, overrides)
+        if (
+            settings.TORNADO_EVENT_QUEUE_MAX_EVENTS is not None
+            and self.event_queue.size() > settings.TORNADO_EVENT_QUEUE_MAX_EVENTS
+        ):
+            self.handle_overflow()
+            if self.overflowed:
+                return
+        if batched_clients is not None:
+            # Events are delivered to the handler once the whole batch
+            # has been processed; see batched_event_delivery.
+            batched_clients[self.event_queue.id] = self
+        else:
+            self.deliver_events()
+
+    def handle_overflow(self) -> None:
+        """Called when the queue holds more than
+        TORNADO_EVENT_QUEUE_MAX_EVENTS events, which generally means
+        that its client has stopped fetching events without deleting
+        the queue.  Its events are dropped; the client is either sent
+        an immediate restart event, so that it reloads and fetches
+        fresh state, or, for clients that do not accept restart events
+        or if TORNADO_EVENT_QUEUE_OVERFLOW is "gc", the queue is
+        garbage-collected, and until then fetch_events rejects it, so
+        that the client gets a BAD_EVENT_QUEUE_ID error and registers a
+        new queue."""
+        dropped = self.event_queue.clear()
+        event_queue_counters["overflows"] += 1
+        event_queue_counters["overflow_dropped_events"] += dropped
+        restart_event = create_restart_event(immediate=True)
+        if settings.TORNADO_EVENT_QUEUE_OVERFLOW == "restart" and self.accepts_event(restart_event):
+            self.event_queue.push(restart_event)
+            return
+
+        self.overflowed = True
+        # End any connected long-poll or event stream, so that the
+        # client reconnects and gets the error.
         self.finish_current_handler()
+        # The queue's existing entry in expiry_heap is for its
+        # original deadline; add one for the next GC.
+        self.gc_scheduled = True
+        heapq.heappush(expiry_heap, (self.expiry_time(), self.event_queue.id))
+
+    def deliver_events(self) -> None:
+        """Delivers the queued events to the connected handler, if any.
+        A long-polling get_events request is finished, while an event
+        stream (see get_events_stream) is written to and stays open."""
+        if self.current_handler_id is None:
+            return
+        handler = get_handler_by_id(self.current_handler_id)
+        if not handler.streaming_events:
+            self.finish_current_handler()
+            return
+
+        events = self.event_queue.contents()
+        if len(events) == 0:
+            return
+        try:
+            handler.write_event_stream(events)
+        except Exception:
+            logging.exception("Got error writing to event stream for queue %s", self.event_queue.id)
+            self.disconnect_handler()
+            return
+        # Events written to a stream are treated as received, since
+        # the client cannot acknowledge them until it reconnects; a
+        # client resuming from an older Last-Event-ID gets the same
+        # error as for any other already-pruned event.
+        self.event_queue.prune(events[-1]["id"])
+        self.schedule_heartbeat()
 
     def finish_current_handler(self) -> bool:
         if self.current_handler_id is not None:
@@ -232,18 +338,23 @@ class ClientDescriptor:
     def accepts_messages(self) -> bool:
         return self.event_types is None or "message" in self.event_types
 
+    def expiry_time(self) -> float:
+        if self.overflowed:
+            return 0
+        return self.last_connection_time + self.queue_timeout
+
     def expired(self, now: float) -> bool:
-        return (
-            self.current_handler_id is None
-            and now - self.last_connection_time >= self.queue_timeout
-        )
+        return self.current_handler_id is None and now >= self.expiry_time()
 
     def connect_handler(self, handler_id: int, client_name: str) -> None:
         self.current_handler_id = handler_id
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        journal_event_queue_change("connect", self.event_queue.id, self.last_connection_time)
+        self.schedule_heartbeat()
 
+    def schedule_heartbeat(self) -> None:
         def timeout_callback() -> None:
             self._timeout_handle = None
             # All clients get heartbeat events
@@ -251,6 +362,9 @@ class ClientDescriptor:
             self.add_event(heartbeat_event)
 
         ioloop = tornado.ioloop.IOLoop.instance()
+        if self._timeout_handle is not None:
+            ioloop.remove_timeout(self._timeout_handle)
+            self._timeout_handle = None
         interval = HEARTBEAT_MIN_FREQ_SECS + random.randint(0, 10)
         if self.client_type_name != "API: heartbeat test":
             self._timeout_handle = ioloop.call_later(interval, timeout_callback)
@@ -272,6 +386,8 @@ class ClientDescriptor:
             ioloop = tornado.ioloop.IOLoop.instance()
             ioloop.remove_timeout(self._timeout_handle)
             self._timeout_handle = None
+        # Now that the client is idle, it can expire.
+        schedule_gc(self)
 
     def cleanup(self) -> None:
         # Before we can GC the event queue, we need to disconnect the
@@ -293,14 +409,48 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
     return event["type"]
 
 
+class QueuedEvent:
+    """An event sitting in an EventQueue.
+
+    The payload is shared, without copying, with every other queue the
+    event was pushed to, and so must never be mutated; anything
+    specific to this queue, such as a message's flags, goes in the
+    small overrides dict instead.  This keeps the memory used by
+    fanning an event out to many queues proportional to the number of
+    queues, rather than to the number of queues times the size of the
+    event.
+    """
+
+    __slots__ = ("id", "payload", "overrides")
+
+    def __init__(
+        self, id: int, payload: Mapping[str, Any], overrides: Optional[Dict[str, Any]] = None
+    ) -> None:
+        self.id = id
+        self.payload = payload
+        self.overrides = overrides
+
+    def to_dict(self, include_internal_data: bool = True) -> Dict[str, Any]:
+        event = dict(self.payload)
+        if self.overrides is not None:
+            event.update(self.overrides)
+        event["id"] = self.id
+        if not include_internal_data and event["type"] == "message":
+            # The internal_data data structures are not intended to
+            # be exposed to API clients.
+            event.pop("internal_data", None)
+        return event
+
+
 class EventQueue:
     def __init__(self, id: str) -> None:
         # When extending this list of properties, one must be sure to
         # update to_dict and from_dict.
 
-        self.queue: Deque[Dict[str, Any]] = deque()
+        self.queue: Deque[QueuedEvent] = deque()
         self.next_event_id: int = 0
-        # will only be None for migration from old versions
+        # None for migration from old versions, and after clear(),
+        # when we no longer know which events the client received.
         self.newest_pruned_id: Optional[int] = -1
         self.id: str = id
         self.virtual_events: Dict[str, Dict[str, Any]] = {}
@@ -312,7 +462,7 @@ class EventQueue:
         d = dict(
             id=self.id,
             next_event_id=self.next_event_id,
-            queue=list(self.queue),
+            queue=[event.to_dict() for event in self.queue],
             virtual_events=self.virtual_events,
         )
         if self.newest_pruned_id is not None:
@@ -324,22 +474,28 @@ class EventQueue:
         ret = cls(d["id"])
         ret.next_event_id = d["next_event_id"]
         ret.newest_pruned_id = d.get("newest_pruned_id", None)
-        ret.queue = deque(d["queue"])
+        ret.queue = deque(QueuedEvent(event["id"], event) for event in d["queue"])
         ret.virtual_events = d.get("virtual_events", {})
         return ret
 
-    def push(self, orig_event: Mapping[str, Any]) -> None:
-        # By default, we make a shallow copy of the event dictionary
-        # to push into the target event queue; this allows the calling
-        # code to send the same "event" object to multiple queues.
-        # This behavior is important because the event_queue system is
-        # about to mutate the event dictionary, minimally to add the
-        # event_id attribute.
-        event = dict(orig_event)
-        event["id"] = self.next_event_id
+    def push(
+        self, orig_event: Mapping[str, Any], overrides: Optional[Dict[str, Any]] = None
+    ) -> None:
+        # The calling code can send the same "event" object to many
+        # queues; we store a reference to it, rather than a copy, so
+        # it must not be modified after it is pushed.  See QueuedEvent.
+        if event_queue_journal is not None:
+            event_queue_journal.append_push(self.id, orig_event, overrides)
+        event_id = self.next_event_id
         self.next_event_id += 1
-        full_event_type = compute_full_event_type(event)
+        full_event_type = compute_full_event_type(orig_event)
         if full_event_type == "restart" or full_event_type.startswith("flags/"):
+            # Virtual events are updated in place as later events are
+            # collapsed into them, so they need their own copy.
+            event = dict(orig_event)
+            if overrides is not None:
+                event.update(overrides)
+            event["id"] = event_id
             if full_event_type not in self.virtual_events:
                 self.virtual_events[full_event_type] = copy.deepcopy(event)
                 return
@@ -354,26 +510,48 @@ class EventQueue:
             elif full_event_type.startswith("flags/"):
                 virtual_event["messages"] += event["messages"]
         else:
-            self.queue.append(event)
+            self.queue.append(QueuedEvent(event_id, orig_event, overrides))
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
-    def pop(self) -> Dict[str, Any]:
+    def pop(self) -> QueuedEvent:
         return self.queue.popleft()
 
     def empty(self) -> bool:
         return len(self.queue) == 0 and len(self.virtual_events) == 0
 
+    def size(self) -> int:
+        return len(self.queue) + len(self.virtual_events)
+
+    def clear(self) -> int:
+        """Drops all events in the queue, returning how many there were."""
+        journal_event_queue_change("clear", self.id)
+        dropped = self.size()
+        self.queue.clear()
+        self.virtual_events = {}
+        # The client's last_event_id may be for any of the dropped
+        # events, so the next fetch accepts any ID.
+        self.newest_pruned_id = None
+        return dropped
+
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]["id"] <= through_id:
-            self.newest_pruned_id = self.queue[0]["id"]
+        if len(self.queue) != 0 and self.queue[0].id <= through_id:
+            journal_event_queue_change("prune", self.id, through_id)
+        while len(self.queue) != 0 and self.queue[0].id <= through_id:
+            self.newest_pruned_id = self.queue[0].id
             self.pop()
+            event_queue_counters["pruned_events"] += 1
 
     def contents(self, include_internal_data: bool = False) -> List[Dict[str, Any]]:
-        contents: List[Dict[str, Any]] = []
-        virtual_id_map: Dict[str, Dict[str, Any]] = {}
+        if self.virtual_events:
+            # Merging the virtual events into the queue changes which
+            # future events can be collapsed, so replay needs to know.
+            journal_event_queue_change("contents", self.id)
+
+        contents: List[QueuedEvent] = []
+        virtual_id_map: Dict[int, Dict[str, Any]] = {}
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
         virtual_ids = sorted(virtual_id_map.keys())
@@ -382,32 +560,24 @@ class EventQueue:
         index = 0
         length = len(virtual_ids)
         for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
+            while index < length and virtual_ids[index] < event.id:
+                contents.append(QueuedEvent(virtual_ids[index], virtual_id_map[virtual_ids[index]]))
                 index += 1
             contents.append(event)
         while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
+            contents.append(QueuedEvent(virtual_ids[index], virtual_id_map[virtual_ids[index]]))
             index += 1
 
         self.virtual_events = {}
         self.queue = deque(contents)
 
-        if include_internal_data:
-            return contents
-        return prune_internal_data(contents)
+        # Each event is materialized into a fresh dict, but nested
+        # values, like a message's dictionary, are still shared with
+        # other queues and must not be modified.
+        return [event.to_dict(include_internal_data) for event in contents]
 
 
-def prune_internal_data(events: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
-    """Prunes the internal_data data structures, which are not intended to
-    be exposed to API clients.
-    """
-    events = copy.deepcopy(events)
-    for event in events:
-        if event["type"] == "message" and "internal_data" in event:
-            del event["internal_data"]
-    return events
-
+ClientDictKey = TypeVar("ClientDictKey")
 
 # maps queue ids to client descriptors
 clients: Dict[str, ClientDescriptor] = {}
@@ -416,6 +586,26 @@ user_clients: Dict[int, List[ClientDescriptor]] = {}
 # maps realm id to list of client descriptors with all_public_streams=True
 realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
 
+# The following indexes let us route an event to just the client
+# descriptors that can accept it, rather than checking every one.
+#
+# maps (user id, event type) to the user's client descriptors that
+# registered for that event type; the key (user id, None) holds
+# those that registered for all event types.
+user_clients_by_event_type: Dict[Tuple[int, Optional[str]], List[ClientDescriptor]] = {}
+# maps (realm id, stream name, topic name) to the client descriptors
+# from realm_clients_all_streams that accept messages and whose narrow
+# is restricted to that stream and/or topic.  Names are lowercased,
+# matching the narrow filter, and None means no restriction.
+# Descriptors whose narrow only matches private messages are left
+# out, since they can never receive a public stream message.
+realm_clients_by_stream_topic: Dict[
+    Tuple[int, Optional[str], Optional[str]], List[ClientDescriptor]
+] = {}
+# maps realm id to the client descriptors with the batched_presence
+# capability that registered for presence events.
+realm_clients_batched_presence: Dict[int, List[ClientDescriptor]] = {}
+
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
 # last_for_client that is true if this is the last queue pertaining
@@ -423,17 +613,70 @@ realm_clients_all_streams: Dict[int, List[ClientDescriptor]] = {}
 # that is about to be deleted
 gc_hooks: List[Callable[[int, ClientDescriptor, bool], None]] = []
 
+# A heap of (expiry deadline, queue id) pairs, which lets
+# gc_event_queues find expired queues without scanning every client.
+# There is at most one entry for each idle client.  A client's
+# deadline only moves later when it reconnects, so an entry may be
+# earlier than the actual deadline; gc_event_queues reschedules those.
+# Entries for queues that were already removed are skipped.
+expiry_heap: List[Tuple[float, str]] = []
+
+# Counts of events pruned after being fetched by clients, and of
+# queues that exceeded TORNADO_EVENT_QUEUE_MAX_EVENTS and the events
+# dropped from them, since this process started.
+event_queue_counters: Dict[str, int] = dict(
+    pruned_events=0,
+    overflows=0,
+    overflow_dropped_events=0,
+)
+
+# While batched_event_delivery is active, maps queue ids to the
+# clients that have received events in the current batch.
+batched_clients: Optional[Dict[str, ClientDescriptor]] = None
+
+# maps realm id to the presence changes waiting to be sent to clients
+# with the batched_presence capability, as a map from the changed
+# user's id to their email and latest server_timestamp and presence
+# data.
+pending_presence_changes: Dict[int, Dict[int, Tuple[str, float, Dict[str, Any]]]] = {}
+
 next_queue_id = 0
 
+# The port this Tornado process serves, once setup_event_queue has run.
+tornado_port: Optional[int] = None
+
+# The write-ahead journal of changes to the queues in `clients`, if
+# TORNADO_EVENT_QUEUE_JOURNAL is enabled.
+event_queue_journal: Optional[EventQueueJournal] = None
+
+
+def journal_event_queue_change(op: str, queue_id: str, data: Any = None) -> None:
+    if event_queue_journal is not None:
+        event_queue_journal.append(op, queue_id, data)
+
 
 def clear_client_event_queues_for_testing() -> None:
     assert settings.TEST_SUITE
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    user_clients_by_event_type.clear()
+    realm_clients_by_stream_topic.clear()
+    for realm_id in realm_clients_batched_presence:
+        cache_delete(batched_presence_realm_cache_key(realm_id))
+    realm_clients_batched_presence.clear()
+    expiry_heap.clear()
     gc_hooks.clear()
+    recent_typing_notifications.clear()
+    pending_presence_changes.clear()
+    for counter in event_queue_counters:
+        event_queue_counters[counter] = 0
     global next_queue_id
     next_queue_id = 0
+    global event_queue_journal
+    if event_queue_journal is not None:
+        event_queue_journal.close()
+        event_queue_journal = None
 
 
 def add_client_gc_hook(hook: Callable[[int, ClientDescriptor, bool], None]) -> None:
@@ -447,26 +690,148 @@ def get_client_descriptor(queue_id: str) -> ClientDescriptor:
         raise BadEventQueueIdError(queue_id)
 
 
+def get_other_process_queue_port(queue_id: str) -> Optional[int]:
+    """If the queue ID was allocated by a different Tornado process
+    than this one, returns that process's port; see
+    allocate_client_descriptor."""
+    parts = queue_id.split(":")
+    if tornado_port is None or len(parts) != 3 or not parts[0].isdigit():
+        return None
+    port = int(parts[0])
+    if port == tornado_port:
+        return None
+    return port
+
+
 def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
     return user_clients.get(user_profile_id, [])
 
 
+def get_client_descriptors_for_user_and_event_type(
+    user_profile_id: int, event_type: str
+) -> List[ClientDescriptor]:
+    """The user's client descriptors that registered for this event
+    type; callers still need to check accepts_event."""
+    return user_clients_by_event_type.get(
+        (user_profile_id, None), []
+    ) + user_clients_by_event_type.get((user_profile_id, event_type), [])
+
+
 def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
     return realm_clients_all_streams.get(realm_id, [])
 
 
+def get_client_descriptors_for_realm_batched_presence(realm_id: int) -> List[ClientDescriptor]:
+    return realm_clients_batched_presence.get(realm_id, [])
+
+
+def get_client_descriptors_for_realm_stream_message(
+    realm_id: int, stream_name: str, topic_name: Optional[str]
+) -> List[ClientDescriptor]:
+    """The subset of get_client_descriptors_for_realm_all_streams whose
+    narrow could match a message to this stream and topic."""
+    stream_key = stream_name.lower()
+    keys: List[Tuple[int, Optional[str], Optional[str]]] = [
+        (realm_id, None, None),
+        (realm_id, stream_key, None),
+    ]
+    if topic_name is not None:
+        topic_key = topic_name.lower()
+        keys += [(realm_id, stream_key, topic_key), (realm_id, None, topic_key)]
+
+    result: List[ClientDescriptor] = []
+    for key in keys:
+        result += realm_clients_by_stream_topic.get(key, [])
+    return result
+
+
+def client_event_type_keys(client: ClientDescriptor) -> Set[Optional[str]]:
+    if client.event_types is None:
+        return {None}
+    return set(client.event_types)
+
+
+def client_stream_topic_key(
+    client: ClientDescriptor,
+) -> Optional[Tuple[int, Optional[str], Optional[str]]]:
+    if not client.accepts_messages():
+        return None
+    stream_name = None
+    topic_name = None
+    for element in client.narrow:
+        operator = element[0]
+        operand = element[1]
+        if operator == "stream":
+            stream_name = operand.lower()
+        elif operator == "topic":
+            topic_name = operand.lower()
+        elif operator == "is" and operand == "private":
+            return None
+    return (client.realm_id, stream_name, topic_name)
+
+
+def schedule_gc(client: ClientDescriptor) -> None:
+    if client.gc_scheduled:
+        return
+    client.gc_scheduled = True
+    heapq.heappush(expiry_heap, (client.expiry_time(), client.event_queue.id))
+
+
 def add_to_client_dicts(client: ClientDescriptor) -> None:
+    schedule_gc(client)
     user_clients.setdefault(client.user_profile_id, []).append(client)
+    for event_type in client_event_type_keys(client):
+        user_clients_by_event_type.setdefault((client.user_profile_id, event_type), []).append(
+            client
+        )
     if client.all_public_streams or client.narrow != []:
         realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+        stream_topic_key = client_stream_topic_key(client)
+        if stream_topic_key is not None:
+            realm_clients_by_stream_topic.setdefault(stream_topic_key, []).append(client)
+    if client.batched_presence and client.accepts_event(dict(type="presence")):
+        if client.realm_id not in realm_clients_batched_presence:
+            # The realm's first such client; the periodic
+            # refresh_batched_presence_realms keeps the mark after this.
+            mark_batched_presence_realms([client.realm_id])
+        realm_clients_batched_presence.setdefault(client.realm_id, []).append(client)
+
+
+def mark_batched_presence_realms(realm_ids: Iterable[int]) -> None:
+    """Lets Django know that these realms have clients with the
+    batched_presence capability; see realm_has_batched_presence_clients."""
+    cache_set_many(
+        {batched_presence_realm_cache_key(realm_id): True for realm_id in realm_ids},
+        timeout=BATCHED_PRESENCE_REALM_CACHE_TIMEOUT,
+    )
+
+
+def unmark_batched_presence_realms(realm_ids: Collection[int]) -> None:
+    """Called for realms whose last client with the batched_presence
+    capability has gone away."""
+    if not realm_ids or settings.TORNADO_PROCESSES > 1:
+        # Another Tornado process may still have such clients in the
+        # realm; the mark will just expire if none refreshes it.
+        return
+    cache_delete_many(batched_presence_realm_cache_key(realm_id) for realm_id in realm_ids)
+
+
+def refresh_batched_presence_realms() -> None:
+    if realm_clients_batched_presence:
+        mark_batched_presence_realms(realm_clients_batched_presence.keys())
 
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
     queue_id = str(settings.SERVER_GENERATION) + ":" + str(next_queue_id)
+    if tornado_port is not None and settings.TORNADO_PROCESSES > 1:
+        # For realms whose users are sharded across Tornado processes,
+        # nginx routes requests to the port at the start of the queue ID.
+        queue_id = f"{tornado_port}:{queue_id}"
     next_queue_id += 1
     new_queue_data["event_queue"] = EventQueue(queue_id).to_dict()
     client = ClientDescriptor.from_dict(new_queue_data)
+    journal_event_queue_change("create", queue_id, client.to_dict())
     clients[queue_id] = client
     add_to_client_dicts(client)
     return client
@@ -476,7 +841,7 @@ def do_gc_event_queues(
     to_remove: AbstractSet[str], affected_users: AbstractSet[int], affected_realms: AbstractSet[int]
 ) -> None:
     def filter_client_dict(
-        client_dict: MutableMapping[int, List[ClientDescriptor]], key: int
+        client_dict: MutableMapping[ClientDictKey, List[ClientDescriptor]], key: ClientDictKey
     ) -> None:
         if key not in client_dict:
             return
@@ -490,10 +855,25 @@ def do_gc_event_queues(
     for user_id in affected_users:
         filter_client_dict(user_clients, user_id)
 
+    unmarked_realm_ids = []
     for realm_id in affected_realms:
         filter_client_dict(realm_clients_all_streams, realm_id)
+        if realm_id in realm_clients_batched_presence:
+            filter_client_dict(realm_clients_batched_presence, realm_id)
+            if realm_id not in realm_clients_batched_presence:
+                unmarked_realm_ids.append(realm_id)
+    unmark_batched_presence_realms(unmarked_realm_ids)
 
     for id in to_remove:
+        client = clients[id]
+        for event_type in client_event_type_keys(client):
+            filter_client_dict(user_clients_by_event_type, (client.user_profile_id, event_type))
+        stream_topic_key = client_stream_topic_key(client)
+        if stream_topic_key is not None:
+            filter_client_dict(realm_clients_by_stream_topic, stream_topic_key)
+
+    for id in to_remove:
+        journal_event_queue_change("gc", id)
         for cb in gc_hooks:
             cb(
                 clients[id].user_profile_id,
@@ -508,11 +888,22 @@ def gc_event_queues(port: int) -> None:
     to_remove: Set[str] = set()
     affected_users: Set[int] = set()
     affected_realms: Set[int] = set()
-    for (id, client) in clients.items():
+    while len(expiry_heap) != 0 and expiry_heap[0][0] <= start:
+        (deadline, id) = heapq.heappop(expiry_heap)
+        client = clients.get(id)
+        if client is None:
+            # Already removed, e.g. by ClientDescriptor.cleanup.
+            continue
+        client.gc_scheduled = False
         if client.expired(start):
             to_remove.add(id)
             affected_users.add(client.user_profile_id)
             affected_realms.add(client.realm_id)
+        elif client.current_handler_id is None:
+            # The client has connected since this entry was added, so
+            # its deadline is later.  (Clients that are currently
+            # connected are rescheduled when they disconnect.)
+            schedule_gc(client)
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
@@ -534,6 +925,29 @@ def gc_event_queues(port: int) -> None:
     statsd.gauge("tornado.active_users", len(user_clients))
 
 
+def get_event_queue_stats(top: int) -> Dict[str, Any]:
+    """Summarizes the event queues in this process, including the
+    `top` largest ones, for the event_queue_stats management command."""
+    largest = heapq.nlargest(top, clients.values(), key=lambda client: client.event_queue.size())
+    return dict(
+        queues=len(clients),
+        users=len(user_clients),
+        events=sum(client.event_queue.size() for client in clients.values()),
+        **event_queue_counters,
+        largest_queues=[
+            dict(
+                queue_id=client.event_queue.id,
+                user_profile_id=client.user_profile_id,
+                client_type_name=client.client_type_name,
+                events=client.event_queue.size(),
+                last_connection_time=client.last_connection_time,
+                connected=client.current_handler_id is not None,
+            )
+            for client in largest
+        ],
+    )
+
+
 def persistent_queue_filename(port: int, last: bool = False) -> str:
     if settings.TORNADO_PROCESSES == 1:
         # Use non-port-aware, legacy version.
@@ -545,13 +959,32 @@ def persistent_queue_filename(port: int, last: bool = False) -> str:
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ("." + str(port),)
 
 
+def persistent_queue_journal_filename(port: int) -> str:
+    if settings.TORNADO_PROCESSES == 1:
+        return settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME_PATTERN % ("",)
+    return settings.JSON_PERSISTENT_QUEUE_JOURNAL_FILENAME_PATTERN % ("." + str(port),)
+
+
 def dump_event_queues(port: int) -> None:
     start = time.time()
 
-    with open(persistent_queue_filename(port), "wb") as stored_queues:
-        stored_queues.write(
-            orjson.dumps([(qid, client.to_dict()) for (qid, client) in clients.items()])
-        )
+    data: Any = [(qid, client.to_dict()) for (qid, client) in clients.items()]
+    if event_queue_journal is not None:
+        # This snapshot is a compaction of the journal; record which
+        # journal records it already includes, so that
+        # load_event_queues doesn't apply them a second time.
+        event_queue_journal.flush()
+        data = dict(journal_seq=event_queue_journal.last_seq, clients=data)
+
+    # Write the new snapshot alongside the old one and then rename it
+    # into place, so that a crash mid-write can't lose both.
+    filename = persistent_queue_filename(port)
+    with open(filename + ".tmp", "wb") as stored_queues:
+        stored_queues.write(orjson.dumps(data))
+    os.replace(filename + ".tmp", filename)
+
+    if event_queue_journal is not None:
+        event_queue_journal.truncate()
 
     if len(clients) > 0 or settings.PRODUCTION:
         logging.info(
@@ -559,9 +992,46 @@ def dump_event_queues(port: int) -> None:
         )
 
 
-def load_event_queues(port: int) -> None:
+def replay_event_queue_journal_record(
+    op: str, queue_id: str, data: Any, journal_events: Mapping[int, Mapping[str, Any]]
+) -> None:
+    if op == "create":
+        clients[queue_id] = ClientDescriptor.from_dict(data)
+        return
+
+    client = clients.get(queue_id)
+    if client is None:
+        # The queue was already garbage-collected.
+        return
+
+    if op == "push":
+        (event_seq, overrides) = data
+        # Every queue the event was pushed to shares the one payload,
+        # just as they did before the restart.
+        client.event_queue.push(journal_events[event_seq], overrides)
+    elif op == "prune":
+        client.event_queue.prune(data)
+    elif op == "contents":
+        client.event_queue.contents()
+    elif op == "clear":
+        client.event_queue.clear()
+    elif op == "connect":
+        client.last_connection_time = data
+    elif op == "gc":
+        # The gc_hooks already ran before the process went away.
+        del clients[queue_id]
+    else:
+        raise AssertionError(f"Unknown event queue journal op {op}")
+
+
+def load_event_queues(port: int) -> int:
+    """Loads the most recent snapshot of the event queues, and then
+    replays any journal records written after it was taken.  Returns
+    the sequence number of the last journal record reflected in the
+    loaded queues."""
     global clients
     start = time.time()
+    journal_seq = 0
 
     try:
         with open(persistent_queue_filename(port), "rb") as stored_queues:
@@ -572,12 +1042,44 @@ def load_event_queues(port: int) -> None:
         logging.exception("Tornado %d could not deserialize event queues", port, stack_info=True)
     else:
         try:
+            if isinstance(data, dict):
+                # Snapshots written by journal compaction
+                journal_seq = data["journal_seq"]
+                data = data["clients"]
             clients = {qid: ClientDescriptor.from_dict(client) for (qid, client) in data}
         except Exception:
             logging.exception(
                 "Tornado %d could not deserialize event queues", port, stack_info=True
             )
 
+    journal_records = read_event_queue_journal(persistent_queue_journal_filename(port))
+    journal_events: Dict[int, Mapping[str, Any]] = {}
+    replayed = 0
+    for (seq, op, queue_id, record_data) in journal_records:
+        if op == "event":
+            # The snapshot doesn't include these; keep them for the
+            # push records below that refer to them.
+            journal_events[seq] = record_data
+            journal_seq = max(journal_seq, seq)
+            continue
+        if seq <= journal_seq:
+            # Already included in the snapshot.
+            continue
+        try:
+            replay_event_queue_journal_record(op, queue_id, record_data, journal_events)
+        except Exception:
+            logging.exception(
+                "Tornado %d could not replay event queue journal record %d",
+                port,
+                seq,
+                stack_info=True,
+            )
+        journal_seq = seq
+        replayed += 1
+
+    if settings.TORNADO_PROCESSES > 1:
+        discard_resharded_clients(port)
+
     for client in clients.values():
         # Put code for migrations due to event queue data format changes here
 
@@ -585,11 +1087,48 @@ def load_event_queues(port: int) -> None:
 
     if len(clients) > 0 or settings.PRODUCTION:
         logging.info(
-            "Tornado %d loaded %d event queues in %.3fs", port, len(clients), time.time() - start
+            "Tornado %d loaded %d event queues (%d journal records replayed) in %.3fs",
+            port,
+            len(clients),
+            replayed,
+            time.time() - start,
         )
+    return journal_seq
+
+
+def discard_resharded_clients(port: int) -> None:
+    """After a change to the Tornado sharding configuration, some loaded
+    queues may belong to users who are now served by a different
+    Tornado process.  We drop those queues, so that their clients get
+    a BAD_EVENT_QUEUE_ID error and register a new queue, which Django
+    will create on the right process."""
+    realms = Realm.objects.in_bulk({client.realm_id for client in clients.values()})
+    discarded = 0
+    for (queue_id, client) in list(clients.items()):
+        realm = realms.get(client.realm_id)
+        if realm is None or get_tornado_port(realm, client.user_profile_id) != port:
+            del clients[queue_id]
+            discarded += 1
+    if discarded > 0:
+        logging.info("Tornado %d discarded %d event queues moved to other shards", port, discarded)
+
+
+def start_event_queue_journal(port: int, last_seq: int) -> None:
+    global event_queue_journal
+    event_queue_journal = EventQueueJournal(persistent_queue_journal_filename(port), last_seq + 1)
+
+
+def flush_event_queue_journal(port: int) -> None:
+    assert event_queue_journal is not None
+    if event_queue_journal.records_since_truncate >= EVENT_QUEUE_JOURNAL_COMPACTION_RECORDS:
+        # Compact the journal into a fresh snapshot, which bounds how
+        # many records a restart needs to replay.
+        dump_event_queues(port)
+    else:
+        event_queue_journal.flush()
 
 
-def send_restart_events(immediate: bool = False) -> None:
+def create_restart_event(immediate: bool = False) -> Dict[str, Any]:
     event: Dict[str, Any] = dict(
         type="restart",
         zulip_version=ZULIP_VERSION,
@@ -599,6 +1138,11 @@ def send_restart_events(immediate: bool = False) -> None:
     )
     if immediate:
         event["immediate"] = True
+    return event
+
+
+def send_restart_events(immediate: bool = False) -> None:
+    event = create_restart_event(immediate)
     for client in clients.values():
         if client.accepts_event(event):
             client.add_event(event)
@@ -612,22 +1156,47 @@ def handle_sigterm(server: tornado.httpserver.HTTPServer) -> NoReturn:
 
 
 def setup_event_queue(server: tornado.httpserver.HTTPServer, port: int) -> None:
+    global tornado_port
+    tornado_port = port
     ioloop = tornado.ioloop.IOLoop.instance()
 
     if not settings.TEST_SUITE:
-        load_event_queues(port)
-        atexit.register(dump_event_queues, port)
+        journal_seq = load_event_queues(port)
+        if settings.TORNADO_EVENT_QUEUE_JOURNAL:
+            # The snapshot and journal are kept up to date as we run,
+            # so shutting down only requires flushing the journal.
+            start_event_queue_journal(port, journal_seq)
+            atexit.register(flush_event_queue_journal, port)
+            add_reload_hook(lambda: flush_event_queue_journal(port))
+            pc = tornado.ioloop.PeriodicCallback(
+                lambda: flush_event_queue_journal(port),
+                EVENT_QUEUE_JOURNAL_FLUSH_FREQ_MSECS,
+                ioloop,
+            )
+            pc.start()
+        else:
+            atexit.register(dump_event_queues, port)
+            add_reload_hook(lambda: dump_event_queues(port))
         # Make sure we dump event queues even if we exit via signal
         signal.signal(
             signal.SIGTERM,
             lambda signum, frame: ioloop.add_callback_from_signal(handle_sigterm, server),
         )
-        add_reload_hook(lambda: dump_event_queues(port))
 
-    try:
-        os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
-    except OSError:
-        pass
+    if not settings.TORNADO_EVENT_QUEUE_JOURNAL:
+        try:
+            os.rename(persistent_queue_filename(port), persistent_queue_filename(port, last=True))
+        except OSError:
+            pass
+        # A journal left over from running with
+        # TORNADO_EVENT_QUEUE_JOURNAL enabled has now been applied.
+        try:
+            os.rename(
+                persistent_queue_journal_filename(port),
+                persistent_queue_journal_filename(port) + ".last",
+            )
+        except OSError:
+            pass
 
     # Set up event queue garbage collection
     pc = tornado.ioloop.PeriodicCallback(
@@ -635,6 +1204,11 @@ def setup_event_queue(server: tornado.httpserver.HTTPServer, port: int) -> None:
     )
     pc.start()
 
+    pc = tornado.ioloop.PeriodicCallback(
+        refresh_batched_presence_realms, BATCHED_PRESENCE_REALM_REFRESH_FREQ_MSECS, ioloop
+    )
+    pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 
@@ -646,6 +1220,7 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
     new_queue_data: Optional[MutableMapping[str, Any]] = query.get("new_queue_data")
     client_type_name: str = query["client_type_name"]
     handler_id: int = query["handler_id"]
+    stream: bool = query.get("stream", False)
 
     try:
         was_connected = False
@@ -664,6 +1239,10 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
             client = get_client_descriptor(queue_id)
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
+            if client.overflowed:
+                # Its events were dropped, and it is about to be
+                # garbage-collected; see handle_overflow.
+                raise BadEventQueueIdError(queue_id)
             if (
                 client.event_queue.newest_pruned_id is not None
                 and last_event_id < client.event_queue.newest_pruned_id
@@ -685,7 +1264,7 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
                 )
             was_connected = client.finish_current_handler()
 
-        if not client.event_queue.empty() or dont_block:
+        if (not client.event_queue.empty() or dont_block) and not stream:
             response: Dict[str, Any] = dict(
                 events=client.event_queue.contents(),
             )
@@ -701,8 +1280,9 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
                 extra_log_data += " [was connected]"
             return dict(type="response", response=response, extra_log_data=extra_log_data)
 
-        # After this point, dont_block=False, the queue is empty, and we
-        # have a pre-existing queue, so we wait for new events.
+        # After this point, dont_block=False, and we have a
+        # pre-existing queue, which is either empty or will be written
+        # to an event stream, so we wait for new events.
         if was_connected:
             logging.info(
                 "Disconnected handler for queue %s (%s/%s)",
@@ -797,10 +1377,9 @@ def missedmessage_hook(
 def receiver_is_off_zulip(user_profile_id: int) -> bool:
     # If a user has no message-receiving event queues, they've got no open zulip
     # session so we notify them.
-    all_client_descriptors = get_client_descriptors_for_user(user_profile_id)
-    message_event_queues = [
-        client for client in all_client_descriptors if client.accepts_messages()
-    ]
+    message_event_queues = get_client_descriptors_for_user_and_event_type(
+        user_profile_id, "message"
+    )
     off_zulip = len(message_event_queues) == 0
     return off_zulip
 
@@ -878,7 +1457,12 @@ def get_client_info_for_message_event(
     # bots) that are registered to get events for ALL streams.
     if "stream_name" in event_template and not event_template.get("invite_only"):
         realm_id = event_template["realm_id"]
-        for client in get_client_descriptors_for_realm_all_streams(realm_id):
+        topic_name = None
+        if "message_dict" in event_template:
+            topic_name = get_topic_from_message_info(event_template["message_dict"])
+        for client in get_client_descriptors_for_realm_stream_message(
+            realm_id, event_template["stream_name"], topic_name
+        ):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=[],
@@ -889,7 +1473,7 @@ def get_client_info_for_message_event(
         user_profile_id: int = user_data["id"]
         flags: Collection[str] = user_data.get("flags", [])
 
-        for client in get_client_descriptors_for_user(user_profile_id):
+        for client in get_client_descriptors_for_user_and_event_type(user_profile_id, "message"):
             send_to_clients[client.event_queue.id] = dict(
                 client=client,
                 flags=flags,
@@ -939,12 +1523,22 @@ def process_message_event(
 
     @cachify
     def get_client_payload(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
-        return MessageDict.finalize_payload(
-            wide_dict,
-            apply_markdown=apply_markdown,
-            client_gravatar=client_gravatar,
+        # A PreserializedDict, so that the message is encoded to JSON
+        # just once for every client of this flavor.
+        return PreserializedDict(
+            MessageDict.finalize_payload(
+                wide_dict,
+                apply_markdown=apply_markdown,
+                client_gravatar=client_gravatar,
+            )
         )
 
+    @cachify
+    def get_client_event(apply_markdown: bool, client_gravatar: bool) -> Dict[str, Any]:
+        # This event is shared by every queue of this flavor that gets
+        # the message; the per-queue data is passed as overrides.
+        return dict(type="message", message=get_client_payload(apply_markdown, client_gravatar))
+
     # Extra user-specific data to include
     extra_user_data: Dict[int, Any] = {}
 
@@ -1007,33 +1601,34 @@ def process_message_event(
             # message data unnecessarily
             continue
 
-        message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
+        user_event = get_client_event(client.apply_markdown, client.client_gravatar)
 
         # Make sure Zephyr mirroring bots know whether stream is invite-only
         if "mirror" in client.client_type_name and event_template.get("invite_only"):
-            message_dict = message_dict.copy()
+            message_dict = user_event["message"].copy()
             message_dict["invite_only_stream"] = True
+            user_event = dict(type="message", message=message_dict)
 
-        user_event: Dict[str, Any] = dict(type="message", message=message_dict, flags=flags)
+        overrides: Dict[str, Any] = dict(flags=flags)
         if extra_data is not None:
-            user_event.update(extra_data)
+            overrides.update(extra_data)
 
         if is_sender:
             local_message_id = event_template.get("local_id", None)
             if local_message_id is not None:
-                user_event["local_message_id"] = local_message_id
+                overrides["local_message_id"] = local_message_id
 
-        if not client.accepts_event(user_event):
+        if not client.accepts_event(ChainMap(overrides, user_event)):
             continue
 
         # The below prevents (Zephyr) mirroring loops.
         if "mirror" in sending_client and sending_client.lower() == client.client_type_name.lower():
             continue
 
-        client.add_event(user_event)
+        client.add_event(user_event, overrides)
 
 
-def process_presence_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
+def process_presence_event(event: Mapping[str, Any], users: Collection[int]) -> None:
     if "user_id" not in event:
         # We only recently added `user_id` to presence data.
         # Any old events in our queue can just be dropped,
@@ -1055,8 +1650,20 @@ def process_presence_event(event: Mapping[str, Any], users: Iterable[int]) -> No
         presence=event["presence"],
     )
 
+    # Events from servers predating batched presence lack realm_id;
+    # those are sent to every client immediately.
+    realm_id: Optional[int] = event.get("realm_id")
+    if realm_id is not None:
+        queue_batched_presence_change(realm_id, event)
+        if event.get("batched_only"):
+            # Realm-level notices, with no users, for realms too large
+            # for immediate presence events.
+            return
+
     for user_profile_id in users:
-        for client in get_client_descriptors_for_user(user_profile_id):
+        for client in get_client_descriptors_for_user_and_event_type(user_profile_id, "presence"):
+            if client.batched_presence and realm_id is not None:
+                continue
             if client.accepts_event(event):
                 if client.slim_presence:
                     client.add_event(slim_event)
@@ -1064,16 +1671,80 @@ def process_presence_event(event: Mapping[str, Any], users: Iterable[int]) -> No
                     client.add_event(legacy_event)
 
 
+def queue_batched_presence_change(realm_id: int, event: Mapping[str, Any]) -> None:
+    """Buffers a presence change for the realm's clients with the
+    batched_presence capability.  Rather than sending each of those
+    clients an event for every user whose presence changes, which is
+    quadratic in the size of the realm, the changes made within
+    PRESENCE_BATCH_WINDOW_SECS are sent as a single event."""
+    if realm_id not in realm_clients_batched_presence:
+        return
+    changes = pending_presence_changes.get(realm_id)
+    if changes is None:
+        changes = pending_presence_changes[realm_id] = {}
+        tornado.ioloop.IOLoop.instance().call_later(
+            PRESENCE_BATCH_WINDOW_SECS, lambda: send_batched_presence_changes(realm_id)
+        )
+    previous = changes.get(event["user_id"])
+    presence = dict(previous[2]) if previous is not None else {}
+    presence.update(event["presence"])
+    changes[event["user_id"]] = (event["email"], event["server_timestamp"], presence)
+
+
+def send_batched_presence_changes(realm_id: int) -> None:
+    changes = pending_presence_changes.pop(realm_id, None)
+    if not changes:
+        return
+
+    server_timestamp = max(timestamp for (email, timestamp, presence) in changes.values())
+    # Like the presence data from /register, `presences` is keyed by
+    # user ID for clients with slim_presence, and by email otherwise.
+    slim_event = dict(
+        type="presence",
+        server_timestamp=server_timestamp,
+        presences={
+            str(user_id): presence for (user_id, (email, timestamp, presence)) in changes.items()
+        },
+    )
+    legacy_event = dict(
+        type="presence",
+        server_timestamp=server_timestamp,
+        presences={email: presence for (email, timestamp, presence) in changes.values()},
+    )
+    with batched_event_delivery():
+        for client in get_client_descriptors_for_realm_batched_presence(realm_id):
+            if client.slim_presence:
+                client.add_event(slim_event)
+            else:
+                client.add_event(legacy_event)
+
+
 def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
-        for client in get_client_descriptors_for_user(user_profile_id):
+        for client in get_client_descriptors_for_user_and_event_type(
+            user_profile_id, event["type"]
+        ):
             if client.accepts_event(event):
                 client.add_event(event)
 
 
+def process_cleanup_queue_event(event: Mapping[str, Any], users: Collection[int]) -> None:
+    """Deletes an event queue, for a DELETE request that reached a
+    different Tornado process; see cleanup_event_queue.  That process
+    forwards the request without checking who owns the queue, so the
+    check here that the queue belongs to the requesting user is the
+    only thing preventing users from deleting each other's queues."""
+    client = clients.get(event["queue_id"])
+    if client is None or client.user_profile_id not in users:
+        return
+    client.cleanup()
+
+
 def process_deletion_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
-        for client in get_client_descriptors_for_user(user_profile_id):
+        for client in get_client_descriptors_for_user_and_event_type(
+            user_profile_id, "delete_message"
+        ):
             if not client.accepts_event(event):
                 continue
 
@@ -1142,12 +1813,11 @@ def process_message_update_event(
             # because we know this event isn't meant to send notifications.
             acting_user_id = user_profile_id
 
-        user_event = dict(event_template)  # shallow copy, but deep enough for our needs
-        for key in user_data.keys():
-            if key != "id":
-                user_event[key] = user_data[key]
+        # The event_template is shared by all of the recipients'
+        # queues; only the per-user data is stored separately.
+        overrides = {key: value for (key, value) in user_data.items() if key != "id"}
 
-        flags: Collection[str] = user_event["flags"]
+        flags: Collection[str] = overrides["flags"]
         user_notifications_data = UserMessageNotificationsData.from_user_id_sets(
             user_id=user_profile_id,
             flags=flags,
@@ -1170,11 +1840,11 @@ def process_message_update_event(
             prior_mentioned=(user_profile_id in prior_mention_user_ids),
         )
 
-        for client in get_client_descriptors_for_user(user_profile_id):
-            if client.accepts_event(user_event):
-                # We need to do another shallow copy, or we risk
-                # sending the same event to multiple clients.
-                client.add_event(user_event)
+        for client in get_client_descriptors_for_user_and_event_type(
+            user_profile_id, "update_message"
+        ):
+            if client.accepts_event(event_template):
+                client.add_event(event_template, overrides)
 
 
 def maybe_enqueue_notifications_for_message_update(
@@ -1309,6 +1979,8 @@ def process_notification(notice: Mapping[str, Any]) -> None:
         process_deletion_event(event, user_ids)
     elif event["type"] == "presence":
         process_presence_event(event, cast(List[int], users))
+    elif event["type"] == "cleanup_queue":
+        process_cleanup_queue_event(event, cast(List[int], users))
     else:
         process_event(event, cast(List[int], users))
     logging.debug(
@@ -1319,6 +1991,114 @@ def process_notification(notice: Mapping[str, Any]) -> None:
     )
 
 
+# Repeats of the same typing notification within this many seconds
+# are not delivered.  This is shorter than the interval at which
+# clients repeat "start" notifications while the user is typing, so
+# that only duplicates, e.g. from a user with several tabs open, are
+# dropped.
+TYPING_COALESCE_SECONDS = 5
+
+# maps (sender, conversation) to the last delivered typing op and the
+# time it was delivered, ordered by that time
+recent_typing_notifications: Dict[Tuple[int, Hashable], Tuple[str, float]] = {}
+
+
+def typing_conversation_key(event: Mapping[str, Any]) -> Hashable:
+    if event["message_type"] == "stream":
+        return ("stream", event["stream_id"], event["topic"])
+    return ("private", tuple(sorted(recipient["user_id"] for recipient in event["recipients"])))
+
+
+def should_deliver_typing_notification(event: Mapping[str, Any], now: float) -> bool:
+    # Forget notifications that are too old to coalesce with; the
+    # dictionary is ordered by delivery time.
+    while len(recent_typing_notifications) != 0:
+        oldest_key, (op, delivered) = next(iter(recent_typing_notifications.items()))
+        if delivered > now - TYPING_COALESCE_SECONDS:
+            break
+        del recent_typing_notifications[oldest_key]
+
+    key = (event["sender"]["user_id"], typing_conversation_key(event))
+    last = recent_typing_notifications.get(key)
+    if last is not None and last[0] == event["op"]:
+        return False
+    recent_typing_notifications.pop(key, None)
+    recent_typing_notifications[key] = (event["op"], now)
+    return True
+
+
+def process_ephemeral_notification(notice: Mapping[str, Any]) -> None:
+    """Processes a notice sent by send_ephemeral_event, dropping typing
+    notifications that repeat one delivered moments ago."""
+    event = notice["event"]
+    if event["type"] == "typing" and not should_deliver_typing_notification(event, time.time()):
+        return
+    process_notification(notice)
+
+
+@contextmanager
+def batched_event_delivery() -> Iterator[None]:
+    """Defers delivering events to clients' handlers until the end of
+    the block, so that a client receiving several events from a batch
+    of notices gets all of them in a single response, rather than one
+    response (and a new longpoll) per event."""
+    global batched_clients
+    if batched_clients is not None:
+        yield
+        return
+
+    batched_clients = {}
+    try:
+        yield
+    finally:
+        to_deliver = batched_clients
+        batched_clients = None
+        for client in to_deliver.values():
+            client.deliver_events()
+
+
+def coalesce_notifications(notices: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """Removes redundant notices from a batch, preserving the order of
+    the rest:
+
+    * A presence notice is dropped if a later notice in the batch has
+      presence data for the same user and clients, sent to the same
+      users, since clients only keep the latest presence data.
+
+    * Consecutive update_message_flags notices for the same users
+      that differ only in their message IDs are merged into one.
+    """
+    latest_presence: Dict[Tuple[int, Tuple[str, ...], Tuple[int, ...]], int] = {}
+    for i, notice in enumerate(notices):
+        event = notice["event"]
+        if event["type"] == "presence" and "user_id" in event:
+            key = (event["user_id"], tuple(sorted(event["presence"])), tuple(notice["users"]))
+            latest_presence[key] = i
+    superseded = set(range(len(notices))) - set(latest_presence.values())
+
+    result: List[Dict[str, Any]] = []
+    for i, notice in enumerate(notices):
+        event = notice["event"]
+        if event["type"] == "presence" and "user_id" in event and i in superseded:
+            continue
+        if event["type"] == "update_message_flags" and not event.get("all") and result:
+            previous = result[-1]
+            previous_event = previous["event"]
+            if (
+                previous_event["type"] == "update_message_flags"
+                and previous["users"] == notice["users"]
+                and {k: v for (k, v) in previous_event.items() if k != "messages"}
+                == {k: v for (k, v) in event.items() if k != "messages"}
+            ):
+                merged_event = dict(
+                    previous_event, messages=previous_event["messages"] + event["messages"]
+                )
+                result[-1] = dict(previous, event=merged_event)
+                continue
+        result.append(notice)
+    return result
+
+
 def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str, Any]]], None]:
     def failure_processor(notice: Dict[str, Any]) -> None:
         logging.error(
@@ -1328,10 +2108,11 @@ def get_wrapped_process_notification(queue_name: str) -> Callable[[List[Dict[str
         )
 
     def wrapped_process_notification(notices: List[Dict[str, Any]]) -> None:
-        for notice in notices:
-            try:
-                process_notification(notice)
-            except Exception:
-                retry_event(queue_name, notice, failure_processor)
+        with batched_event_delivery():
+            for notice in coalesce_notifications(notices):
+                try:
+                    process_notification(notice)
+                except Exception:
+                    retry_event(queue_name, notice, failure_processor)
 
     return wrapped_process_notification
@@ -15,6 +15,7 @@ from tornado.wsgi import WSGIContainer
 
 from zerver.lib.response import json_response
 from zerver.tornado.descriptors import get_descriptor_by_handler_id
+from zerver.tornado.preserialized import encode_events, json_events_response
 
 current_handler_id = 0
 handlers: Dict[int, "AsyncDjangoHandler"] = {}
@@ -54,6 +55,12 @@ def finish_handler(
         # being finished without any events (because another
         # get_events request has supplanted this request)
         handler = get_handler_by_id(handler_id)
+        if handler.streaming_events:
+            if len(contents) > 0:
+                handler.write_event_stream(contents)
+            handler.finish()
+            return
+
         request = handler._request
         async_request_timer_restart(request)
         log_data = RequestNotes.get_notes(request).log_data
@@ -88,6 +95,10 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # Prevent Tornado from automatically finishing the request
         self._auto_finish = False
 
+        # Whether this is a GET /events/stream request, which writes
+        # events as they arrive rather than finishing the request.
+        self.streaming_events = False
+
         # Handler IDs are allocated here, and the handler ID map must
         # be cleared when the handler finishes its response
         allocate_handler_id(self)
@@ -190,6 +201,21 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
     def delete(self, *args: Any, **kwargs: Any) -> None:
         self.get(*args, **kwargs)
 
+    def start_event_stream(self) -> None:
+        self.streaming_events = True
+        self.set_header("Content-Type", "text/event-stream")
+        self.set_header("Cache-Control", "no-cache")
+        # Tell nginx not to buffer the response.
+        self.set_header("X-Accel-Buffering", "no")
+        self.flush()
+
+    def write_event_stream(self, events: List[Dict[str, Any]]) -> None:
+        # Each batch of events is one server-sent event, whose ID is
+        # the ID of the last event in the batch; browsers send it back
+        # as the Last-Event-ID header when they reconnect.
+        self.write(b"id: %d\ndata: %s\n\n" % (events[-1]["id"], encode_events(events)))
+        self.flush()
+
     def on_connection_close(self) -> None:
         # Register a Tornado handler that runs when client-side
         # connections are closed to notify the events system.
@@ -253,9 +279,14 @@ class AsyncDjangoHandler(tornado.web.RequestHandler, base.BaseHandler):
         # request/middleware system to run unmodified while avoiding
         # running expensive things like Zulip's authentication code a
         # second time.
-        request_notes.saved_response = json_response(
-            res_type=result_dict["result"], data=result_dict, status=self.get_status()
-        )
+        if "events" in result_dict:
+            request_notes.saved_response = json_events_response(
+                res_type=result_dict["result"], data=result_dict, status=self.get_status()
+            )
+        else:
+            request_notes.saved_response = json_response(
+                res_type=result_dict["result"], data=result_dict, status=self.get_status()
+            )
 
         response = self.get_response(request)
         try:
@@ -0,0 +1,99 @@
+import logging
+from typing import Any, List, Mapping, Optional, Tuple
+
+import orjson
+
+# Each journal record is a single orjson-encoded line of the form
+# [seq, op, queue_id, data].  The sequence number lets a snapshot
+# record which prefix of the journal it already includes, so that a
+# crash between writing a snapshot and truncating the journal does not
+# cause records to be applied twice.
+#
+# An event pushed to many queues is written once, as an "event" record
+# whose data is the event; each queue's "push" record then refers to
+# it by that record's sequence number.
+JournalRecord = Tuple[int, str, str, Any]
+
+
+def read_event_queue_journal(filename: str) -> List[JournalRecord]:
+    """Returns the records in the journal.  A Tornado process that
+    crashes in the middle of a write can leave a torn final record;
+    that record and anything after it is removed from the file, so
+    that new records are never appended after garbage."""
+    records: List[JournalRecord] = []
+    valid_length = 0
+    try:
+        with open(filename, "r+b") as f:
+            for line in f:
+                try:
+                    if not line.endswith(b"\n"):
+                        raise ValueError("Truncated record")
+                    seq, op, queue_id, data = orjson.loads(line)
+                except ValueError:
+                    logging.warning("Discarding corrupt records at end of %s", filename)
+                    f.truncate(valid_length)
+                    break
+                records.append((seq, op, queue_id, data))
+                valid_length += len(line)
+    except FileNotFoundError:
+        pass
+    return records
+
+
+class EventQueueJournal:
+    """An append-only log of changes to Tornado's event queues.
+
+    Records are buffered in memory and written out by flush(), which
+    is called periodically from the IOLoop and at shutdown, so a
+    crash loses at most one flush interval of changes.  After a
+    snapshot of all queues has been written, truncate() discards the
+    records that the snapshot covers.
+    """
+
+    def __init__(self, filename: str, next_seq: int) -> None:
+        self.filename = filename
+        self.next_seq = next_seq
+        self.buffer: List[bytes] = []
+        self.records_since_truncate = 0
+        self.file = open(filename, "ab")
+        # The event most recently written as an "event" record, and
+        # that record's sequence number.
+        self.last_event: Optional[Tuple[Mapping[str, Any], int]] = None
+
+    def append(self, op: str, queue_id: str, data: Any = None) -> None:
+        self.buffer.append(orjson.dumps([self.next_seq, op, queue_id, data]) + b"\n")
+        self.next_seq += 1
+        self.records_since_truncate += 1
+
+    def append_push(
+        self, queue_id: str, event: Mapping[str, Any], overrides: Optional[Mapping[str, Any]]
+    ) -> None:
+        # Callers push the same event object to each of its queues in
+        # turn, so comparing against the last event we wrote is enough
+        # to serialize each event only once.
+        if self.last_event is None or self.last_event[0] is not event:
+            self.last_event = (event, self.next_seq)
+            self.append("event", "", event)
+        self.append("push", queue_id, [self.last_event[1], overrides])
+
+    @property
+    def last_seq(self) -> int:
+        return self.next_seq - 1
+
+    def flush(self) -> None:
+        if not self.buffer:
+            return
+        self.file.write(b"".join(self.buffer))
+        self.file.flush()
+        self.buffer = []
+
+    def truncate(self) -> None:
+        assert not self.buffer
+        self.file.truncate(0)
+        self.records_since_truncate = 0
+        # Later pushes can't refer to an event record we discarded.
+        self.last_event = None
+
+    def close(self) -> None:
+        self.flush()
+        self.file.close()
@@ -0,0 +1,61 @@
+from typing import Any, Dict, Iterable, Mapping, Optional
+
+import orjson
+from django.http import HttpResponse
+
+# Matches the options json_response uses.
+ORJSON_OPTIONS = orjson.OPT_PASSTHROUGH_DATETIME
+
+
+class PreserializedDict(Dict[str, Any]):
+    """A dictionary that caches its own JSON encoding.
+
+    process_message_event shares one of these message dictionaries
+    between every client of a given (apply_markdown, client_gravatar)
+    flavor, so a message sent to a large stream is encoded once per
+    flavor, rather than once per client whose get_events request it
+    finishes.  Like any shared event data, it must not be modified
+    once it has been pushed to an event queue.
+    """
+
+    __slots__ = ("_json",)
+
+    def __init__(self, *args: Any, **kwargs: Any) -> None:
+        super().__init__(*args, **kwargs)
+        self._json: Optional[bytes] = None
+
+    def json(self) -> bytes:
+        if self._json is None:
+            self._json = orjson.dumps(self, option=ORJSON_OPTIONS)
+        return self._json
+
+
+def encode_event(event: Mapping[str, Any]) -> bytes:
+    message = event.get("message")
+    if not isinstance(message, PreserializedDict):
+        return orjson.dumps(event, option=ORJSON_OPTIONS)
+
+    rest = {key: value for (key, value) in event.items() if key != "message"}
+    encoded = orjson.dumps(rest, option=ORJSON_OPTIONS)
+    # Splice the cached encoding of the message in as the last key.
+    return encoded[:-1] + (b',"message":' if rest else b'"message":') + message.json() + b"}"
+
+
+def encode_events(events: Iterable[Mapping[str, Any]]) -> bytes:
+    return b"[" + b",".join(encode_event(event) for event in events) + b"]"
+
+
+def json_events_response(
+    res_type: str = "success", msg: str = "", data: Mapping[str, Any] = {}, status: int = 200
+) -> HttpResponse:
+    """Equivalent to json_response, for a response whose data contains a
+    list of events from an event queue, any of which may contain a
+    PreserializedDict message."""
+    content = {"result": res_type, "msg": msg}
+    content.update((key, value) for (key, value) in data.items() if key != "events")
+    encoded = orjson.dumps(content, option=ORJSON_OPTIONS)
+    return HttpResponse(
+        content=encoded[:-1] + b',"events":' + encode_events(data["events"]) + b"}\n",
+        content_type="application/json",
+        status=status,
+    )
@@ -1,22 +1,71 @@
+import bisect
+import hashlib
 import json
 import os
+from functools import lru_cache
+from typing import Dict, List, Optional, Sequence, Tuple, Union
 
 from django.conf import settings
 
 from zerver.models import Realm
 
-shard_map = {}
+# Maps realm hosts to the port of the Tornado process serving them,
+# or, for realms whose users are spread across several Tornado
+# processes, to the list of those ports.
+shard_map: Dict[str, Union[int, List[int]]] = {}
 if os.path.exists("/etc/zulip/sharding.json"):
     with open("/etc/zulip/sharding.json") as f:
         shard_map = json.loads(f.read())
 
+# The number of points each port has on the consistent hash ring.
+# More points give a more even spread of users across ports.
+HASH_RING_POINTS_PER_PORT = 128
 
-def get_tornado_port(realm: Realm) -> int:
-    return shard_map.get(realm.host, settings.TORNADO_PORTS[0])
 
+def hash_ring_position(key: str) -> int:
+    return int.from_bytes(hashlib.sha256(key.encode()).digest()[:8], "big")
 
-def get_tornado_uri(realm: Realm) -> str:
-    port = get_tornado_port(realm)
+
+@lru_cache(None)
+def get_hash_ring(ports: Tuple[int, ...]) -> Tuple[List[int], List[int]]:
+    """Returns the sorted positions of the points on the hash ring for
+    the given ports, and the port that owns each point.  Since each
+    port's points don't depend on the other ports, adding or removing
+    a port only moves the users whose nearest point changes, roughly
+    1/len(ports) of them."""
+    points = sorted(
+        (hash_ring_position(f"{port}:{i}"), port)
+        for port in ports
+        for i in range(HASH_RING_POINTS_PER_PORT)
+    )
+    return [position for (position, port) in points], [port for (position, port) in points]
+
+
+def get_hashed_tornado_port(ports: Sequence[int], user_id: int) -> int:
+    positions, owners = get_hash_ring(tuple(sorted(ports)))
+    index = bisect.bisect(positions, hash_ring_position(str(user_id)))
+    return owners[index % len(owners)]
+
+
+def get_tornado_ports(realm: Realm) -> List[int]:
+    ports = shard_map.get(realm.host, settings.TORNADO_PORTS[0])
+    if isinstance(ports, int):
+        return [ports]
+    return ports
+
+
+def get_tornado_port(realm: Realm, user_id: Optional[int] = None) -> int:
+    """Returns the port of the Tornado process serving the given user's
+    event queues.  For realms sharded by user, user_id is required."""
+    ports = get_tornado_ports(realm)
+    if len(ports) == 1:
+        return ports[0]
+    assert user_id is not None
+    return get_hashed_tornado_port(ports, user_id)
+
+
+def get_tornado_uri(realm: Realm, user_id: Optional[int] = None) -> str:
+    port = get_tornado_port(realm, user_id)
     return f"http://127.0.0.1:{port}"
 
 
@@ -17,8 +17,16 @@ from zerver.lib.validator import (
     to_non_negative_int,
 )
 from zerver.models import Client, UserProfile, get_client, get_user_profile_by_id
-from zerver.tornado.event_queue import fetch_events, get_client_descriptor, process_notification
+from zerver.tornado.django_api import send_event_queue_cleanup
+from zerver.tornado.event_queue import (
+    fetch_events,
+    get_client_descriptor,
+    get_event_queue_stats,
+    get_other_process_queue_port,
+    process_notification,
+)
 from zerver.tornado.exceptions import BadEventQueueIdError
+from zerver.tornado.preserialized import json_events_response
 
 
 @internal_notify_view(True)
@@ -31,6 +39,15 @@ def notify(request: HttpRequest) -> HttpResponse:
 def cleanup_event_queue(
     request: HttpRequest, user_profile: UserProfile, queue_id: str = REQ()
 ) -> HttpResponse:
+    port = get_other_process_queue_port(queue_id)
+    if port is not None:
+        # For realms whose users are sharded across Tornado processes,
+        # nginx routes event requests by the port at the start of the
+        # queue ID, but this request has the queue ID in its body, so
+        # it may reach a different process; pass it along.
+        send_event_queue_cleanup(port, queue_id, user_profile.id)
+        return json_success()
+
     client = get_client_descriptor(str(queue_id))
     if client is None:
         raise BadEventQueueIdError(queue_id)
@@ -54,10 +71,73 @@ def get_events_internal(
     return get_events_backend(request, user_profile)
 
 
+@internal_notify_view(True)
+@has_request_variables
+def get_event_queue_stats_internal(
+    request: HttpRequest, top: int = REQ(converter=to_non_negative_int, default=20)
+) -> HttpResponse:
+    return json_success(get_event_queue_stats(top))
+
+
 def get_events(request: HttpRequest, user_profile: UserProfile) -> HttpResponse:
     return get_events_backend(request, user_profile)
 
 
+@has_request_variables
+def get_events_stream(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    queue_id: str = REQ(),
+    last_event_id: Optional[int] = REQ(converter=int, default=None),
+) -> HttpResponse:
+    """Like GET /events, but keeps the connection open as a server-sent
+    events (text/event-stream) response, writing each batch of events
+    to it as they arrive, rather than requiring a new request for each
+    batch.  When reconnecting, browsers' EventSource sends the ID of
+    the last event it received as the Last-Event-ID header, which is
+    used if last_event_id is not passed."""
+    if last_event_id is None and "HTTP_LAST_EVENT_ID" in request.META:
+        try:
+            last_event_id = int(request.META["HTTP_LAST_EVENT_ID"])
+        except ValueError:
+            raise JsonableError(_("Invalid Last-Event-ID header"))
+
+    tornado_handler = RequestNotes.get_notes(request).tornado_handler
+    assert tornado_handler is not None
+    handler = tornado_handler()
+    assert handler is not None
+    client = RequestNotes.get_notes(request).client
+    assert client is not None
+
+    result = fetch_events(
+        dict(
+            user_profile_id=user_profile.id,
+            queue_id=queue_id,
+            last_event_id=last_event_id,
+            client_type_name=client.name,
+            dont_block=False,
+            handler_id=handler.handler_id,
+            stream=True,
+        )
+    )
+    if "extra_log_data" in result:
+        log_data = RequestNotes.get_notes(request).log_data
+        assert log_data is not None
+        log_data["extra"] = result["extra_log_data"]
+    if result["type"] == "error":
+        raise result["exception"]
+
+    # As for long-polling get_events requests, an asynchronous
+    # response keeps the connection open; we then write the response
+    # headers and any events already in the queue directly.
+    handler._request = request
+    handler.start_event_stream()
+    get_client_descriptor(queue_id).deliver_events()
+    response = json_success()
+    response.asynchronous = True
+    return response
+
+
 @has_request_variables
 def get_events_backend(
     request: HttpRequest,
@@ -106,6 +186,9 @@ def get_events_backend(
     user_settings_object: bool = REQ(
         default=False, json_validator=check_bool, intentionally_undocumented=True
     ),
+    batched_presence: bool = REQ(
+        default=False, json_validator=check_bool, intentionally_undocumented=True
+    ),
 ) -> HttpResponse:
     if all_public_streams and not user_profile.can_access_public_streams():
         raise JsonableError(_("User not authorized for this query"))
@@ -151,6 +234,7 @@ def get_events_backend(
             bulk_message_deletion=bulk_message_deletion,
             stream_typing_notifications=stream_typing_notifications,
             user_settings_object=user_settings_object,
+            batched_presence=batched_presence,
         )
 
     result = fetch_events(events_query)
@@ -169,4 +253,4 @@ def get_events_backend(
         return response
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    return json_events_response(data=result["response"])
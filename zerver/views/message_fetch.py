@@ -18,6 +18,7 @@ from sqlalchemy.sql import (
     Selectable,
     alias,
     and_,
+    case,
     column,
     func,
     join,
@@ -35,6 +36,7 @@ from zerver.context_processors import get_valid_realm_from_request
 from zerver.lib.actions import recipient_for_user_profiles
 from zerver.lib.addressee import get_user_profiles, get_user_profiles_by_ids
 from zerver.lib.exceptions import ErrorCode, JsonableError, MissingAuthenticationError
+from zerver.lib.fanout_on_read import get_fanout_message_flags, get_fanout_subscriptions
 from zerver.lib.message import get_first_visible_message_id, messages_for_ids
 from zerver.lib.narrow import is_spectator_compatible, is_web_public_narrow
 from zerver.lib.request import REQ, RequestNotes, has_request_variables
@@ -807,6 +809,102 @@ def get_base_query_for_search(
     return (query, inner_msg_id_col)
 
 
+def get_fanout_query_for_search(
+    user_profile: UserProfile, narrow: OptionalNarrowListT, *, unread_only: bool = False
+) -> Optional[Tuple[Select, "ColumnElement[Integer]", OptionalNarrowListT]]:
+    """Builds the analogue of the get_base_query_for_search query with
+    need_user_message for the messages that the user received in
+    fanout-on-read streams without getting a UserMessage row (see
+    zerver/lib/fanout_on_read.py), with flags computed from the user's
+    read watermarks.
+
+    Because the computed flags column can't be used in conditions, we
+    handle the narrow's `is` terms here, and return the rest of the
+    narrow for add_narrow_conditions.  Returns None if no such message
+    can match the narrow.
+    """
+    fanout_subscriptions = get_fanout_subscriptions(user_profile)
+    if not fanout_subscriptions:
+        return None
+
+    # None means both read and unread messages.
+    want_read: Optional[bool] = False if unread_only else None
+    remaining_narrow = []
+    for term in narrow or []:
+        negated = term.get("negated", False)
+        if term["operator"] in ("pm-with", "group-pm-with") and not negated:
+            return None
+        if term["operator"] == "is" and term["operand"] == "unread":
+            if want_read is not None and want_read != negated:
+                return None
+            want_read = negated
+            continue
+        if term["operator"] == "is" and term["operand"] in (
+            "private",
+            "starred",
+            "mentioned",
+            "alerted",
+        ):
+            # Messages with any of these flags have UserMessage rows.
+            if not negated:
+                return None
+            continue
+        remaining_narrow.append(term)
+
+    msg_id_col = literal_column("zerver_message.id", Integer)
+    recipient_id_col = column("recipient_id", Integer)
+    received_conditions = []
+    read_conditions = []
+    for sub in fanout_subscriptions.values():
+        read_condition = and_(
+            recipient_id_col == literal(sub.recipient_id),
+            msg_id_col <= literal(sub.read_message_id),
+        )
+        read_conditions.append(read_condition)
+        if want_read is None:
+            received_conditions.append(
+                and_(
+                    recipient_id_col == literal(sub.recipient_id),
+                    msg_id_col > literal(sub.start_message_id),
+                )
+            )
+        elif want_read:
+            received_conditions.append(
+                and_(read_condition, msg_id_col > literal(sub.start_message_id))
+            )
+        else:
+            received_conditions.append(
+                and_(
+                    recipient_id_col == literal(sub.recipient_id),
+                    msg_id_col > literal(sub.read_message_id),
+                )
+            )
+
+    user_message = table(
+        "zerver_usermessage",
+        column("user_profile_id", Integer),
+        column("message_id", Integer),
+    )
+    has_user_message = select(
+        [literal_column("1")],
+        and_(
+            user_message.c.user_profile_id == literal(user_profile.id),
+            user_message.c.message_id == msg_id_col,
+        ),
+        user_message,
+    ).exists()
+    flags = case(
+        [(or_(*read_conditions), literal(UserMessage.flags.read.mask, Integer))],
+        else_=literal(0, Integer),
+    )
+    query = select(
+        [msg_id_col.label("message_id"), flags.label("flags")],
+        and_(or_(*received_conditions), not_(has_user_message)),
+        table("zerver_message"),
+    )
+    return (query, msg_id_col, remaining_narrow)
+
+
 def add_narrow_conditions(
     user_profile: Optional[UserProfile],
     inner_msg_id_col: "ColumnElement[Integer]",
@@ -895,6 +993,24 @@ def find_first_unread_anchor(
     else:
         anchor = LARGER_THAN_MAX_MESSAGE_ID
 
+    fanout_query_info = get_fanout_query_for_search(user_profile, narrow, unread_only=True)
+    if fanout_query_info is not None:
+        fanout_query, fanout_msg_id_col, fanout_narrow = fanout_query_info
+        fanout_query = add_narrow_conditions(
+            user_profile=user_profile,
+            inner_msg_id_col=fanout_msg_id_col,
+            query=fanout_query,
+            narrow=fanout_narrow,
+            is_web_public_query=False,
+            realm=user_profile.realm,
+        )[0]
+        if muting_conditions:
+            fanout_query = fanout_query.where(and_(*muting_conditions))
+        fanout_query = fanout_query.order_by(fanout_msg_id_col.asc()).limit(1)
+        fanout_result = list(sa_conn.execute(fanout_query).fetchall())
+        if len(fanout_result) > 0:
+            anchor = min(anchor, fanout_result[0][0])
+
     return anchor
 
 
@@ -1086,6 +1202,36 @@ def get_messages_backend(
     query = query.prefix_with("/* get_messages */")
     rows = list(sa_conn.execute(query).fetchall())
 
+    if not include_history and user_profile is not None:
+        fanout_query_info = get_fanout_query_for_search(user_profile, narrow)
+        if fanout_query_info is not None:
+            # Merge in the messages the user received in fanout-on-read
+            # streams without a UserMessage row, fetching the same range.
+            fanout_query, fanout_msg_id_col, fanout_narrow = fanout_query_info
+            fanout_query = add_narrow_conditions(
+                user_profile=user_profile,
+                inner_msg_id_col=fanout_msg_id_col,
+                query=fanout_query,
+                narrow=fanout_narrow,
+                realm=realm,
+                is_web_public_query=False,
+            )[0]
+            fanout_query = limit_query_to_range(
+                query=fanout_query,
+                num_before=num_before,
+                num_after=num_after,
+                anchor=anchor,
+                anchored_to_left=anchored_to_left,
+                anchored_to_right=anchored_to_right,
+                id_col=fanout_msg_id_col,
+                first_visible_message_id=first_visible_message_id,
+            )
+            fanout_main_query = alias(fanout_query)
+            fanout_query = select(fanout_main_query.c, None, fanout_main_query)
+            fanout_query = fanout_query.prefix_with("/* get_fanout_messages */")
+            rows += sa_conn.execute(fanout_query).fetchall()
+            rows.sort(key=lambda row: row[0])
+
     query_info = post_process_limited_query(
         rows=rows,
         num_before=num_before,
@@ -1121,6 +1267,14 @@ def get_messages_backend(
         um_rows = UserMessage.objects.filter(user_profile=user_profile, message_id__in=message_ids)
         user_message_flags = {um.message_id: um.flags_list() for um in um_rows}
 
+        missing_message_ids = [
+            message_id for message_id in message_ids if message_id not in user_message_flags
+        ]
+        if missing_message_ids:
+            # Messages in fanout-on-read streams may have been received
+            # without a UserMessage row.
+            user_message_flags.update(get_fanout_message_flags(user_profile, missing_message_ids))
+
         for message_id in message_ids:
             if message_id not in user_message_flags:
                 user_message_flags[message_id] = ["read", "historical"]
@@ -1332,7 +1486,8 @@ def messages_in_narrow_backend(
     first_visible_message_id = get_first_visible_message_id(user_profile.realm)
     msg_ids = [message_id for message_id in msg_ids if message_id >= first_visible_message_id]
     # This query is limited to messages the user has access to because they
-    # actually received them, as reflected in `zerver_usermessage`.
+    # actually received them, as reflected in `zerver_usermessage`, or
+    # the fanout-on-read watermarks below.
     query = select(
         [column("message_id", Integer), topic_column_sa(), column("rendered_content", Text)],
         and_(
@@ -1355,6 +1510,23 @@ def messages_in_narrow_backend(
     sa_conn = get_sqlalchemy_connection()
     query_result = list(sa_conn.execute(query).fetchall())
 
+    fanout_query_info = get_fanout_query_for_search(user_profile, narrow)
+    if fanout_query_info is not None:
+        # The user may also have received some of these messages in
+        # fanout-on-read streams, without a UserMessage row.
+        fanout_query, fanout_msg_id_col, fanout_narrow = fanout_query_info
+        fanout_query = fanout_query.with_only_columns(
+            [
+                fanout_msg_id_col.label("message_id"),
+                topic_column_sa(),
+                column("rendered_content", Text),
+            ]
+        ).where(fanout_msg_id_col.in_(msg_ids))
+        fanout_builder = NarrowBuilder(user_profile, fanout_msg_id_col, user_profile.realm)
+        for term in fanout_narrow or []:
+            fanout_query = fanout_builder.add_term(fanout_query, term)
+        query_result += sa_conn.execute(fanout_query).fetchall()
+
     search_fields = {}
     for row in query_result:
         message_id = row["message_id"]
@@ -1,29 +1,44 @@
-from typing import Iterable, Optional, Sequence, Union, cast
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Union, cast
 
 import pytz
 from dateutil.parser import parse as dateparser
+from django.conf import settings
 from django.core import validators
 from django.core.exceptions import ValidationError
 from django.http import HttpRequest, HttpResponse
 from django.utils.timezone import now as timezone_now
 from django.utils.translation import gettext as _
 
+from zerver.decorator import client_is_exempt_from_rate_limiting, rate_limit_user
 from zerver.lib.actions import (
+    check_message,
     check_schedule_message,
     check_send_message,
     compute_irc_user_fullname,
     compute_jabber_user_fullname,
     create_mirror_user_if_needed,
+    do_send_messages,
     extract_private_recipients,
     extract_stream_indicator,
+    get_validated_emails,
+    get_validated_user_ids,
 )
-from zerver.lib.exceptions import JsonableError
+from zerver.lib.addressee import Addressee
+from zerver.lib.exceptions import JsonableError, ZephyrMessageAlreadySentException
 from zerver.lib.message import render_markdown
 from zerver.lib.request import REQ, RequestNotes, has_request_variables
 from zerver.lib.response import json_success
 from zerver.lib.timestamp import convert_to_UTC
 from zerver.lib.topic import REQ_topic
-from zerver.lib.validator import to_float
+from zerver.lib.validator import (
+    check_dict_only,
+    check_int,
+    check_list,
+    check_string,
+    check_string_in,
+    check_union,
+    to_float,
+)
 from zerver.lib.zcommand import process_zcommands
 from zerver.lib.zephyr import compute_mit_user_fullname
 from zerver.models import (
@@ -316,6 +331,114 @@ def send_message_backend(
     return json_success({"id": ret})
 
 
+MAX_MESSAGES_PER_BATCH = 100
+
+batch_message_dict_validator = check_dict_only(
+    required_keys=[
+        ("type", check_string_in(["private", "stream"])),
+        # A stream name or ID, or a list of user IDs or emails.
+        (
+            "to",
+            check_union([check_int, check_string, check_list(check_int), check_list(check_string)]),
+        ),
+        ("content", check_string),
+    ],
+    optional_keys=[
+        ("topic", check_string),
+        ("local_id", check_string),
+    ],
+)
+
+
+def batch_message_recipients(
+    message_type_name: str, to: Union[int, str, List[int], List[str]]
+) -> Union[Sequence[int], Sequence[str]]:
+    if isinstance(to, int):
+        return [to]
+    if message_type_name == "stream":
+        if isinstance(to, list):
+            raise JsonableError(_("Invalid data type for stream"))
+        return [to]
+
+    if isinstance(to, str):
+        return extract_private_recipients(to)
+    if to and isinstance(to[0], str):
+        return get_validated_emails(cast(List[str], to))
+    return get_validated_user_ids(cast(List[int], to))
+
+
+@has_request_variables
+def send_messages_batch_backend(
+    request: HttpRequest,
+    user_profile: UserProfile,
+    message_dicts: List[Dict[str, Any]] = REQ(
+        "messages", json_validator=check_list(batch_message_dict_validator)
+    ),
+    queue_id: Optional[str] = REQ(default=None),
+) -> HttpResponse:
+    """Sends several messages from the user in one request.
+
+    Each message is validated by check_message on its own, so an
+    invalid message gets an error in its entry of the results rather
+    than failing the whole request; the valid ones are then sent
+    together with a single do_send_messages call, in one transaction.
+    """
+    if len(message_dicts) > MAX_MESSAGES_PER_BATCH:
+        raise JsonableError(
+            _("Too many messages; at most {max_messages} can be sent at once.").format(
+                max_messages=MAX_MESSAGES_PER_BATCH
+            )
+        )
+
+    # Each message counts against the user's rate limit, like a
+    # separate request to send it would; this request itself was
+    # already counted once.  The rest are counted together, so that
+    # either all of them fit within the limit, or none are counted.
+    if (
+        settings.RATE_LIMITING
+        and len(message_dicts) > 1
+        and not client_is_exempt_from_rate_limiting(request)
+    ):
+        rate_limit_user(request, user_profile, domain="api_by_user", weight=len(message_dicts) - 1)
+
+    client = RequestNotes.get_notes(request).client
+    assert client is not None
+
+    results: List[Dict[str, Any]] = []
+    send_requests = []
+    send_request_indexes = []
+    for message_dict in message_dicts:
+        try:
+            message_to = batch_message_recipients(message_dict["type"], message_dict["to"])
+            addressee = Addressee.legacy_build(
+                user_profile, message_dict["type"], message_to, message_dict.get("topic")
+            )
+            send_request = check_message(
+                user_profile,
+                client,
+                addressee,
+                message_dict["content"],
+                forwarder_user_profile=user_profile,
+                local_id=message_dict.get("local_id"),
+                sender_queue_id=queue_id,
+            )
+        except ZephyrMessageAlreadySentException as e:
+            results.append({"result": "success", "id": e.message_id})
+        except JsonableError as e:
+            results.append({"result": "error", "msg": e.msg, **e.data})
+        else:
+            # The message ID is filled in once the message is sent.
+            send_request_indexes.append(len(results))
+            send_requests.append(send_request)
+            results.append({"result": "success"})
+
+    message_ids = do_send_messages(send_requests)
+    for index, message_id in zip(send_request_indexes, message_ids):
+        results[index]["id"] = message_id
+
+    return json_success({"results": results})
+
+
 @has_request_variables
 def zcommand_backend(
     request: HttpRequest, user_profile: UserProfile, command: str = REQ("command")
@@ -63,8 +63,9 @@ def export_realm(request: HttpRequest, user: UserProfile) -> HttpResponse:
     # Allow for UI updates on a pending export
     notify_realm_export(user)
 
-    # Using the deferred_work queue processor to avoid
-    # killing the process after 60s
+    # Using the deferred_work_long queue processor to avoid
+    # killing the process after 60s, and so that the export doesn't
+    # delay the quick jobs on the deferred_work queue.
     event = {
         "type": "realm_export",
         "time": event_time,
@@ -72,7 +73,7 @@ def export_realm(request: HttpRequest, user: UserProfile) -> HttpResponse:
         "user_profile_id": user.id,
         "id": row.id,
     }
-    queue_json_publish("deferred_work", event)
+    queue_json_publish("deferred_work_long", event)
     return json_success()
 
 
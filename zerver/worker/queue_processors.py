@@ -1,6 +1,7 @@
 # Documented in https://zulip.readthedocs.io/en/latest/subsystems/queuing.html
 import base64
 import copy
+import ctypes
 import datetime
 import email
 import email.policy
@@ -13,15 +14,19 @@ import tempfile
 import time
 import urllib
 from abc import ABC, abstractmethod
-from collections import deque
+from collections import defaultdict, deque
+from concurrent.futures import ThreadPoolExecutor, wait
+from contextlib import contextmanager
 from email.message import EmailMessage
 from functools import wraps
-from threading import RLock, Timer
+from threading import Lock, RLock, Timer, current_thread, get_ident, main_thread
 from types import FrameType
 from typing import (
     Any,
     Callable,
+    Deque,
     Dict,
+    Iterator,
     List,
     Mapping,
     MutableSequence,
@@ -37,7 +42,7 @@ import orjson
 import sentry_sdk
 from django.conf import settings
 from django.core.mail.backends.smtp import EmailBackend
-from django.db import connection, transaction
+from django.db import close_old_connections, connection, transaction
 from django.db.models import F
 from django.db.utils import IntegrityError
 from django.utils.timezone import now as timezone_now
@@ -49,6 +54,7 @@ from zulip_bots.lib import extract_query_without_mention
 from zerver.context_processors import common_context
 from zerver.lib.actions import (
     do_mark_stream_messages_as_read,
+    do_message_sent_side_effects,
     do_send_confirmation_email,
     do_update_embedded_data,
     do_update_user_activity,
@@ -69,15 +75,20 @@ from zerver.lib.email_notifications import handle_missedmessage_emails
 from zerver.lib.error_notify import do_report_error
 from zerver.lib.exceptions import RateLimited
 from zerver.lib.export import export_realm_wrapper
-from zerver.lib.outgoing_webhook import do_rest_call, get_outgoing_webhook_service_handler
+from zerver.lib.histogram import Histogram, exponential_buckets
+from zerver.lib.outgoing_webhook import (
+    CircuitBreaker,
+    do_rest_call,
+    get_outgoing_webhook_service_handler,
+)
 from zerver.lib.push_notifications import (
     clear_push_device_tokens,
-    handle_push_notification,
+    handle_push_notifications,
     handle_remove_push_notification,
     initialize_push_notifications,
 )
 from zerver.lib.pysa import mark_sanitized
-from zerver.lib.queue import SimpleQueueClient, retry_event
+from zerver.lib.queue import SimpleQueueClient, queue_json_publish, retry_event
 from zerver.lib.remote_server import PushNotificationBouncerRetryLaterError
 from zerver.lib.send_email import (
     EmailNotDeliveredException,
@@ -95,6 +106,7 @@ from zerver.models import (
     Realm,
     RealmAuditLog,
     ScheduledMessageNotificationEmail,
+    Service,
     UserMessage,
     UserProfile,
     filter_to_valid_prereg_users,
@@ -107,6 +119,11 @@ from zerver.models import (
 
 logger = logging.getLogger(__name__)
 
+# Histogram buckets for queue latencies, from 1ms to about 3 hours, a
+# factor of sqrt(2) apart, and for batch sizes, from 1 to 1024.
+LATENCY_BUCKETS = exponential_buckets(0.001, 2 ** 0.5, 48)
+BATCH_SIZE_BUCKETS = exponential_buckets(1, 2, 11)
+
 
 class WorkerTimeoutException(Exception):
     def __init__(self, queue_name: str, limit: int, event_count: int) -> None:
@@ -118,6 +135,13 @@ class WorkerTimeoutException(Exception):
         return f"Timed out in {self.queue_name} after {self.limit * self.event_count} seconds processing {self.event_count} events"
 
 
+class ThreadTimeoutInterrupt(BaseException):
+    """Raised asynchronously in a worker thread whose consume call has
+    timed out; see QueueProcessingWorker.consume_in_thread_with_timeout.
+    This is a BaseException so that `except Exception` clauses in the
+    code being interrupted don't swallow it."""
+
+
 class InterruptConsumeException(Exception):
     """
     This exception is to be thrown inside event consume function
@@ -213,8 +237,9 @@ def retry_send_email_failures(
 class QueueProcessingWorker(ABC):
     queue_name: str
     MAX_CONSUME_SECONDS: Optional[int] = 30
-    # The MAX_CONSUME_SECONDS timeout is only enabled when handling a
-    # single queue at once, with no threads.
+    # Whether the MAX_CONSUME_SECONDS timeout is enforced; it is
+    # enabled by process_queue, both for workers handling a single
+    # queue and those running in threads with --multi_threaded.
     ENABLE_TIMEOUTS = False
     CONSUME_ITERATIONS_BEFORE_UPDATE_STATS_NUM = 50
     MAX_SECONDS_BEFORE_UPDATE_STATS = 30
@@ -236,6 +261,11 @@ class QueueProcessingWorker(ABC):
         self.queue_last_emptied_timestamp = time.time()
         self.consumed_since_last_emptied = 0
         self.recent_consume_times: MutableSequence[Tuple[int, float]] = deque(maxlen=50)
+        # Distributions since the worker started, for Prometheus; see
+        # write_histograms.
+        self.queue_lag_histogram = Histogram(LATENCY_BUCKETS)
+        self.consume_time_histogram = Histogram(LATENCY_BUCKETS)
+        self.batch_size_histogram = Histogram(BATCH_SIZE_BUCKETS)
         self.consume_iteration_counter = 0
         self.idle = True
         self.last_statistics_update_time = 0.0
@@ -254,6 +284,8 @@ class QueueProcessingWorker(ABC):
             recent_average_consume_time=recent_average_consume_time,
             queue_last_emptied_timestamp=self.queue_last_emptied_timestamp,
             consumed_since_last_emptied=self.consumed_since_last_emptied,
+            queue_lag_p50=self.queue_lag_histogram.percentile(0.5),
+            queue_lag_p99=self.queue_lag_histogram.percentile(0.99),
         )
 
         os.makedirs(settings.QUEUE_STATS_DIR, exist_ok=True)
@@ -267,8 +299,40 @@ class QueueProcessingWorker(ABC):
                     orjson.dumps(stats_dict, option=orjson.OPT_APPEND_NEWLINE | orjson.OPT_INDENT_2)
                 )
             os.rename(tmp_fn, fn)
+        self.write_histograms()
         self.last_statistics_update_time = time.time()
 
+    def write_histograms(self) -> None:
+        """Writes the worker's histograms, in the Prometheus text format,
+        to a .prom file that node_exporter's textfile collector serves."""
+        labels = {"queue": self.queue_name}
+        content = (
+            self.queue_lag_histogram.prometheus_text(
+                "zulip_queue_lag_seconds",
+                "Time from an event being published to a worker starting to consume it.",
+                labels,
+            )
+            + self.consume_time_histogram.prometheus_text(
+                "zulip_queue_consume_seconds",
+                "Time taken by a worker to consume a batch of events.",
+                labels,
+            )
+            + self.batch_size_histogram.prometheus_text(
+                "zulip_queue_batch_size",
+                "Number of events in each batch a worker consumes.",
+                labels,
+            )
+        )
+        fn = os.path.join(settings.QUEUE_STATS_DIR, f"{self.queue_name}.prom")
+        tmp_fn = fn + ".tmp"
+        with open(tmp_fn, "w") as f:
+            f.write(content)
+        os.rename(tmp_fn, fn)
+
+    def record_queue_lags(self, lags: List[float]) -> None:
+        for lag in lags:
+            self.queue_lag_histogram.observe(lag)
+
     def get_remaining_local_queue_size(self) -> int:
         if self.q is not None:
             return self.q.local_queue_size()
@@ -304,7 +368,13 @@ class QueueProcessingWorker(ABC):
                 self.update_statistics()
 
             time_start = time.time()
-            if self.MAX_CONSUME_SECONDS and self.ENABLE_TIMEOUTS:
+            if (
+                self.MAX_CONSUME_SECONDS
+                and self.ENABLE_TIMEOUTS
+                and current_thread() is not main_thread()
+            ):
+                self.consume_in_thread_with_timeout(consume_func, events)
+            elif self.MAX_CONSUME_SECONDS and self.ENABLE_TIMEOUTS:
                 try:
                     signal.signal(
                         signal.SIGALRM,
@@ -329,6 +399,8 @@ class QueueProcessingWorker(ABC):
 
             if consume_time_seconds is not None:
                 self.recent_consume_times.append((len(events), consume_time_seconds))
+                self.consume_time_histogram.observe(consume_time_seconds)
+                self.batch_size_histogram.observe(len(events))
 
             remaining_local_queue_size = self.get_remaining_local_queue_size()
             if remaining_local_queue_size == 0:
@@ -351,6 +423,46 @@ class QueueProcessingWorker(ABC):
                 self.consume_iteration_counter = 0
                 self.update_statistics()
 
+    def consume_in_thread_with_timeout(
+        self, consume_func: Callable[[List[Dict[str, Any]]], None], events: List[Dict[str, Any]]
+    ) -> None:
+        """SIGALRM is only delivered to the main thread, so workers
+        running in other threads enforce MAX_CONSUME_SECONDS by having
+        a timer raise ThreadTimeoutInterrupt in the worker's thread,
+        which is then handled by timer_expired, like SIGALRM.  This
+        takes effect the next time the thread runs Python code, not in
+        the middle of a blocking call."""
+        assert self.MAX_CONSUME_SECONDS is not None
+        thread_id = get_ident()
+        lock = Lock()
+        finished = False
+
+        def interrupt() -> None:
+            with lock:
+                if not finished:
+                    ctypes.pythonapi.PyThreadState_SetAsyncExc(
+                        ctypes.c_ulong(thread_id), ctypes.py_object(ThreadTimeoutInterrupt)
+                    )
+
+        timer = Timer(self.MAX_CONSUME_SECONDS * len(events), interrupt)
+        timer.daemon = True
+        try:
+            try:
+                timer.start()
+                consume_func(events)
+            finally:
+                with lock:
+                    finished = True
+                timer.cancel()
+        except ThreadTimeoutInterrupt as e:
+            # Pass the frame that was interrupted, as the signal handler
+            # would get.
+            tb = e.__traceback__
+            assert tb is not None
+            while tb.tb_next is not None:
+                tb = tb.tb_next
+            self.timer_expired(self.MAX_CONSUME_SECONDS, events, signal.SIGALRM, tb.tb_frame)
+
     def consume_single_event(self, event: Dict[str, Any]) -> None:
         consume_func = lambda events: self.consume(events[0])
         self.do_consume(consume_func, [event])
@@ -404,6 +516,7 @@ class QueueProcessingWorker(ABC):
         self.q.start_json_consumer(
             self.queue_name,
             lambda events: self.consume_single_event(events[0]),
+            lag_callback=self.record_queue_lags,
         )
 
     def stop(self) -> None:  # nocoverage
@@ -426,6 +539,7 @@ class LoopQueueProcessingWorker(QueueProcessingWorker):
             lambda events: self.do_consume(self.consume_batch, events),
             batch_size=self.batch_size,
             timeout=self.sleep_delay,
+            lag_callback=self.record_queue_lags,
         )
 
     @abstractmethod
@@ -755,7 +869,13 @@ class EmailSendingWorker(LoopQueueProcessingWorker):
 
 
 @assign_queue("missedmessage_mobile_notifications")
-class PushNotificationsWorker(QueueProcessingWorker):
+class PushNotificationsWorker(LoopQueueProcessingWorker):
+    """When a message is sent to a busy stream, its recipients' push
+    notifications arrive in this queue all at once; we process them
+    in batches, so that we can load the data needed for a whole batch
+    of notifications with a few queries (see handle_push_notifications).
+    """
+
     # The use of aioapns in the backend means that we cannot use
     # SIGALRM to limit how long a consume takes, as SIGALRM does not
     # play well with asyncio.
@@ -768,30 +888,45 @@ class PushNotificationsWorker(QueueProcessingWorker):
         initialize_push_notifications()
         super().start()
 
-    def consume(self, event: Dict[str, Any]) -> None:
-        try:
-            if event.get("type", "add") == "remove":
-                message_ids = event.get("message_ids")
-                if message_ids is None:
-                    # TODO/compatibility: Previously, we sent only one `message_id` in
-                    # a payload for notification remove events. This was later changed
-                    # to send a list of `message_ids` (with that field name), but we need
-                    # compatibility code for events present in the queue during upgrade.
-                    # Remove this when one can no longer upgrade from 1.9.2 (or earlier)
-                    # to any version after 2.0.0
-                    message_ids = [event["message_id"]]
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        missed_messages = []
+        for event in events:
+            if event.get("type", "add") != "remove":
+                missed_messages.append(event)
+                continue
+            message_ids = event.get("message_ids")
+            if message_ids is None:
+                # TODO/compatibility: Previously, we sent only one `message_id` in
+                # a payload for notification remove events. This was later changed
+                # to send a list of `message_ids` (with that field name), but we need
+                # compatibility code for events present in the queue during upgrade.
+                # Remove this when one can no longer upgrade from 1.9.2 (or earlier)
+                # to any version after 2.0.0
+                message_ids = [event["message_id"]]
+            try:
                 handle_remove_push_notification(event["user_profile_id"], message_ids)
-            else:
-                handle_push_notification(event["user_profile_id"], event)
-        except PushNotificationBouncerRetryLaterError:
-
-            def failure_processor(event: Dict[str, Any]) -> None:
-                logger.warning(
-                    "Maximum retries exceeded for trigger:%s event:push_notification",
+            except PushNotificationBouncerRetryLaterError:
+                self.retry(event)
+            except Exception:
+                # Don't let one failed event drop the rest of the batch.
+                logging.exception(
+                    "Error removing push notifications for user %s",
                     event["user_profile_id"],
+                    stack_info=True,
                 )
 
-            retry_event(self.queue_name, event, failure_processor)
+        if missed_messages:
+            for event in handle_push_notifications(missed_messages):
+                self.retry(event)
+
+    def retry(self, event: Dict[str, Any]) -> None:
+        def failure_processor(event: Dict[str, Any]) -> None:
+            logger.warning(
+                "Maximum retries exceeded for trigger:%s event:push_notification",
+                event["user_profile_id"],
+            )
+
+        retry_event(self.queue_name, event, failure_processor)
 
 
 @assign_queue("error_reports")
@@ -843,21 +978,113 @@ class MirrorWorker(QueueProcessingWorker):
         mirror_email(msg, rcpt_to=rcpt_to)
 
 
+@assign_queue("message_sent")
+class MessageSentWorker(QueueProcessingWorker):
+    """Does the work triggered by sending a message that the sender
+    doesn't need to wait for, so that the latency of sending a message
+    doesn't depend on how many bots or links it involves; see
+    do_message_sent_side_effects."""
+
+    def consume(self, event: Dict[str, Any]) -> None:
+        do_message_sent_side_effects(event)
+
+
+@contextmanager
+def pool_thread_db_connections() -> Iterator[None]:
+    """For a task run in a worker's ThreadPoolExecutor.  Each of its
+    threads has its own database connection, which nothing else
+    checks; so that a database restart doesn't leave a thread with a
+    broken connection, we close it before and after each task if it is
+    unusable or too old, as Django does around each request."""
+    close_old_connections()
+    try:
+        yield
+    finally:
+        close_old_connections()
+
+
 @assign_queue("embed_links")
-class FetchLinksEmbedData(QueueProcessingWorker):
+class FetchLinksEmbedData(LoopQueueProcessingWorker):
+    """Fetches the link previews for a batch of messages, and then
+    re-renders each message with them.  The batch's URLs are fetched
+    concurrently, with at most FETCH_THREADS_PER_DOMAIN requests to
+    any one domain at a time, so that neither a message with several
+    links nor a slow domain holds up the rest of the queue."""
+
     # This is a slow queue with network requests, so a disk write is negligible.
     # Update stats file after every consume call.
     CONSUME_ITERATIONS_BEFORE_UPDATE_STATS_NUM = 1
+    FETCH_THREADS = 8
+    FETCH_THREADS_PER_DOMAIN = 2
+    batch_size = 20
 
-    def consume(self, event: Mapping[str, Any]) -> None:
-        for url in event["urls"]:
-            start_time = time.time()
-            url_preview.get_link_embed_data(url)
-            logging.info(
-                "Time spent on get_link_embed_data for %s: %s", url, time.time() - start_time
+    def __init__(self) -> None:
+        super().__init__()
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def fetch_link_embed_data(self, urls: Set[str]) -> None:
+        # maps domains to the URLs we have yet to fetch from them
+        urls_by_domain: Dict[str, Deque[str]] = defaultdict(deque)
+        for url in urls:
+            urls_by_domain[url_preview.get_url_host(url)].append(url)
+
+        @pool_thread_db_connections()
+        def fetch_domain_urls(domain_urls: Deque[str]) -> None:
+            while True:
+                try:
+                    url = domain_urls.popleft()
+                except IndexError:
+                    return
+                start_time = time.time()
+                try:
+                    url_preview.get_link_embed_data(url)
+                except url_preview.PreviewHostUnavailableError:
+                    # Expected while the host is in the failure cache;
+                    # its original failure was already logged.
+                    logging.info("Skipping link preview for %s; its host recently failed", url)
+                    continue
+                except Exception:
+                    # The message is still rendered, without this preview.
+                    logging.exception("Error fetching link preview for %s", url, stack_info=True)
+                    continue
+                logging.info(
+                    "Time spent on get_link_embed_data for %s: %s", url, time.time() - start_time
+                )
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=self.FETCH_THREADS, thread_name_prefix="embed_links"
             )
+        futures = [
+            self.executor.submit(fetch_domain_urls, domain_urls)
+            for domain_urls in urls_by_domain.values()
+            for i in range(min(self.FETCH_THREADS_PER_DOMAIN, len(domain_urls)))
+        ]
+        wait(futures)
+        for future in futures:
+            future.result()
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        self.fetch_link_embed_data({url for event in events for url in event["urls"]})
+
+        for event in events:
+            # Each message is rendered separately, so that an error for
+            # one doesn't affect the rest of the batch.
+            try:
+                self.render_message_embeds(event)
+            except Exception:
+                logging.exception(
+                    "Error rendering link previews for message %s",
+                    event["message_id"],
+                    stack_info=True,
+                )
 
-        message = Message.objects.get(id=event["message_id"])
+    def render_message_embeds(self, event: Dict[str, Any]) -> None:
+        try:
+            message = Message.objects.get(id=event["message_id"])
+        except Message.DoesNotExist:
+            # The message was deleted while we were fetching its links.
+            return
         # If the message changed, we will run this task after updating the message
         # in zerver.lib.actions.check_update_message
         if message.content != event["message_content"]:
@@ -880,30 +1107,123 @@ class FetchLinksEmbedData(QueueProcessingWorker):
     def timer_expired(
         self, limit: int, events: List[Dict[str, Any]], signal: int, frame: FrameType
     ) -> None:
-        assert len(events) == 1
-        event = events[0]
-
-        logging.warning(
-            "Timed out in %s after %s seconds while fetching URLs for message %s: %s",
-            self.queue_name,
-            limit,
-            event["message_id"],
-            event["urls"],
-        )
+        for event in events:
+            logging.warning(
+                "Timed out in %s after %s seconds while fetching URLs for message %s: %s",
+                self.queue_name,
+                limit * len(events),
+                event["message_id"],
+                event["urls"],
+            )
         raise InterruptConsumeException
 
 
 @assign_queue("outgoing_webhooks")
-class OutgoingWebhookWorker(QueueProcessingWorker):
-    def consume(self, event: Dict[str, Any]) -> None:
+class OutgoingWebhookWorker(LoopQueueProcessingWorker):
+    """Sends each batch's outgoing webhook requests from a pool of
+    threads, so that a bot server which is slow to respond holds up
+    only its own bot's requests, not those of every bot on the server.
+
+    At most OUTGOING_WEBHOOK_CONCURRENCY_PER_SERVICE threads work on
+    any one service's requests at once, and once they have spent
+    OUTGOING_WEBHOOK_SERVICE_BUDGET_SECONDS on a batch, the service's
+    remaining requests are put back at the end of the queue.  Services
+    which keep failing are skipped for a while; see CircuitBreaker.
+    """
+
+    def __init__(self) -> None:
+        super().__init__()
+        self.circuit_breaker = CircuitBreaker(
+            settings.OUTGOING_WEBHOOK_CIRCUIT_BREAKER_FAILURES,
+            settings.OUTGOING_WEBHOOK_CIRCUIT_BREAKER_SECONDS,
+        )
+        self.executor: Optional[ThreadPoolExecutor] = None
+
+    def get_deliveries(self, event: Dict[str, Any]) -> List[Tuple[Service, Dict[str, Any]]]:
         message = event["message"]
         event["command"] = message["content"]
 
-        services = get_bot_services(event["user_profile_id"])
-        for service in services:
-            event["service_name"] = str(service.name)
-            service_handler = get_outgoing_webhook_service_handler(service)
-            do_rest_call(service.base_url, event, service_handler)
+        deliveries = []
+        for service in get_bot_services(event["user_profile_id"]):
+            # Events which are being retried, or were put back in the
+            # queue, are only for the service they were sent to.
+            if "service_name" in event and event["service_name"] != service.name:
+                continue
+            deliveries.append((service, dict(event, service_name=str(service.name))))
+        return deliveries
+
+    def deliver(self, service: Service, event: Dict[str, Any]) -> None:
+        service_handler = get_outgoing_webhook_service_handler(service)
+        do_rest_call(service.base_url, event, service_handler, self.circuit_breaker)
+
+    def consume(self, event: Dict[str, Any]) -> None:
+        # Used in tests and development, where each event is consumed
+        # as soon as it is sent; there's nothing to gain from threads.
+        for service, service_event in self.get_deliveries(event):
+            self.deliver(service, service_event)
+
+    def consume_batch(self, events: List[Dict[str, Any]]) -> None:
+        # maps service IDs to the deliveries for that service
+        deliveries: Dict[int, Deque[Tuple[Service, Dict[str, Any]]]] = defaultdict(deque)
+        for event in events:
+            for service, service_event in self.get_deliveries(event):
+                deliveries[service.id].append((service, service_event))
+
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(
+                max_workers=settings.OUTGOING_WEBHOOK_CONCURRENCY,
+                thread_name_prefix="outgoing_webhook",
+            )
+
+        lock = Lock()
+        # maps service IDs to when their budget for this batch runs out
+        deadlines: Dict[int, float] = {}
+
+        @pool_thread_db_connections()
+        def deliver_service_events(service_id: int) -> None:
+            with lock:
+                deadline = deadlines.setdefault(
+                    service_id, time.monotonic() + settings.OUTGOING_WEBHOOK_SERVICE_BUDGET_SECONDS
+                )
+            service_deliveries = deliveries[service_id]
+            while time.monotonic() < deadline:
+                try:
+                    service, service_event = service_deliveries.popleft()
+                except IndexError:
+                    return
+                try:
+                    self.deliver(service, service_event)
+                except Exception:
+                    # Like a failed event in consume, this one is
+                    # dropped, but the service's other events are not.
+                    logging.exception(
+                        "Error delivering outgoing webhook event to service %s",
+                        service_id,
+                        stack_info=True,
+                    )
+
+        futures = [
+            self.executor.submit(deliver_service_events, service_id)
+            for service_id, service_deliveries in deliveries.items()
+            for i in range(
+                min(settings.OUTGOING_WEBHOOK_CONCURRENCY_PER_SERVICE, len(service_deliveries))
+            )
+        ]
+        try:
+            wait(futures)
+            for future in futures:
+                future.result()
+        finally:
+            for service_id, service_deliveries in deliveries.items():
+                if not service_deliveries:
+                    continue
+                logging.info(
+                    "Outgoing webhook service %s is slow; putting %d events back in the queue",
+                    service_id,
+                    len(service_deliveries),
+                )
+                for service, service_event in service_deliveries:
+                    queue_json_publish(self.queue_name, service_event)
 
 
 @assign_queue("embedded_bots")
@@ -952,12 +1272,24 @@ class DeferredWorker(QueueProcessingWorker):
     thread from the Django worker that initiated it (E.g. so we that
     can provide a low-latency HTTP response or avoid risk of request
     timeouts for an operation that could in rare cases take minutes).
+
+    Jobs that can take hours, like realm exports, go to the separate
+    deferred_work_long queue, so that they don't delay the quick jobs
+    that users are waiting on.  Jobs on this queue that scale with the
+    size of a stream are split into chunks, with each event doing a
+    bounded amount of work before queuing an event for the rest.
     """
 
     # Because these operations have no SLO, and can take minutes,
     # remove any processing timeouts
     MAX_CONSUME_SECONDS = None
 
+    # A mark_stream_messages_as_read_for_everyone event marks messages
+    # as read in batches of this size, and re-queues the rest of its
+    # work after it has marked MARK_AS_READ_MESSAGES_PER_EVENT.
+    MARK_AS_READ_BATCH_SIZE = 100
+    MARK_AS_READ_MESSAGES_PER_EVENT = 5000
+
     def consume(self, event: Dict[str, Any]) -> None:
         start = time.time()
         if event["type"] == "mark_stream_messages_as_read":
@@ -973,21 +1305,33 @@ class DeferredWorker(QueueProcessingWorker):
                 )
         elif event["type"] == "mark_stream_messages_as_read_for_everyone":
             # This event is generated by the stream deactivation code path.
-            batch_size = 100
-            offset = 0
+            batch_size = self.MARK_AS_READ_BATCH_SIZE
+            last_message_id = event.get("last_message_id", 0)
+            count = 0
             while True:
-                messages = Message.objects.filter(
-                    recipient_id=event["stream_recipient_id"]
-                ).order_by("id")[offset : offset + batch_size]
-                UserMessage.objects.filter(message__in=messages).extra(
+                message_ids = list(
+                    Message.objects.filter(
+                        recipient_id=event["stream_recipient_id"], id__gt=last_message_id
+                    )
+                    .order_by("id")
+                    .values_list("id", flat=True)[:batch_size]
+                )
+                UserMessage.objects.filter(message_id__in=message_ids).extra(
                     where=[UserMessage.where_unread()]
                 ).update(flags=F("flags").bitor(UserMessage.flags.read))
-                offset += len(messages)
-                if len(messages) < batch_size:
+                count += len(message_ids)
+                if len(message_ids) < batch_size:
+                    break
+                last_message_id = message_ids[-1]
+                if count >= self.MARK_AS_READ_MESSAGES_PER_EVENT:
+                    # Let the events queued behind this one go first.
+                    queue_json_publish(
+                        self.queue_name, {**event, "last_message_id": last_message_id}
+                    )
                     break
             logger.info(
                 "Marked %s messages as read for all users, stream_recipient_id %s",
-                offset,
+                count,
                 event["stream_recipient_id"],
             )
         elif event["type"] == "clear_push_device_tokens":
@@ -1063,7 +1407,15 @@ class DeferredWorker(QueueProcessingWorker):
             )
 
         end = time.time()
-        logger.info("deferred_work processed %s event (%dms)", event["type"], (end - start) * 1000)
+        logger.info(
+            "%s processed %s event (%dms)", self.queue_name, event["type"], (end - start) * 1000
+        )
+
+
+@assign_queue("deferred_work_long")
+class LongDeferredWorker(DeferredWorker):
+    """Runs the deferred jobs which can take hours, like realm exports.
+    It accepts the same events as DeferredWorker."""
 
 
 @assign_queue("test", is_test_queue=True)
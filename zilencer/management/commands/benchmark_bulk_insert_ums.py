@@ -0,0 +1,83 @@
+import math
+import time
+from argparse import ArgumentParser
+from typing import Any, Callable, List, Tuple
+
+from django.core.management.base import CommandError
+from django.db import transaction
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.actions import BULK_INSERT_UMS_COPY_THRESHOLD, UserMessageLite, copy_ums, insert_ums
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Message, UserProfile
+
+
+class Command(ZulipBaseCommand):
+    help = """Compares inserting UserMessage rows with INSERT and with COPY.
+
+For each size, creates enough copies of a message in the realm for
+every row to be for a distinct (user, message) pair, and times
+inserting the rows with each method, as bulk_insert_ums would for a
+message with that many recipients.  Use this to tune
+BULK_INSERT_UMS_COPY_THRESHOLD.
+
+All changes are rolled back, but the inserts write to the database's
+WAL and take locks like real message sends, so run this on a
+development or staging server."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        self.add_realm_args(parser, required=True)
+        parser.add_argument(
+            "--sizes",
+            help="Comma-separated numbers of rows to insert",
+            default="10,100,300,1000,3000,10000,50000",
+        )
+        parser.add_argument(
+            "--repeat", help="Number of times to time each size", default=5, type=int
+        )
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+
+        user_ids = list(UserProfile.objects.filter(realm=realm).values_list("id", flat=True))
+        message = Message.objects.filter(sender__realm=realm).order_by("-id").first()
+        if message is None:
+            raise CommandError("The realm needs at least one message.")
+
+        def make_ums(size: int) -> List[UserMessageLite]:
+            copies = Message.objects.bulk_create(
+                Message(
+                    sender_id=message.sender_id,
+                    recipient_id=message.recipient_id,
+                    subject=message.subject,
+                    content=message.content,
+                    date_sent=timezone_now(),
+                    sending_client_id=message.sending_client_id,
+                )
+                for i in range(math.ceil(size / len(user_ids)))
+            )
+            return [
+                UserMessageLite(user_profile_id=user_id, message_id=message_copy.id, flags=0)
+                for message_copy in copies
+                for user_id in user_ids
+            ][:size]
+
+        methods: List[Tuple[str, Callable[[List[UserMessageLite]], None]]] = [
+            ("INSERT", insert_ums),
+            ("COPY", copy_ums),
+        ]
+        print(f"BULK_INSERT_UMS_COPY_THRESHOLD is currently {BULK_INSERT_UMS_COPY_THRESHOLD}")
+        for size in [int(size) for size in options["sizes"].split(",")]:
+            results = []
+            for (method_name, insert) in methods:
+                timings = []
+                for i in range(options["repeat"]):
+                    with transaction.atomic():
+                        ums = make_ums(size)
+                        start = time.perf_counter()
+                        insert(ums)
+                        timings.append(time.perf_counter() - start)
+                        transaction.set_rollback(True)
+                results.append(f"{method_name} {1000 * min(timings):.1f}ms")
+            print(f"{size} rows: " + ", ".join(results))
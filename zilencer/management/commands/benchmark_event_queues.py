@@ -0,0 +1,279 @@
+import random
+import time
+import tracemalloc
+from argparse import ArgumentParser
+from typing import Any, Callable, Dict, List, Tuple
+
+from django.core.management.base import CommandError
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.lib.message import MessageDict
+from zerver.lib.stream_subscription import get_active_subscriptions_for_stream_id
+from zerver.models import Message, Recipient, Stream, UserProfile
+from zerver.tornado.event_queue import (
+    allocate_client_descriptor,
+    fetch_events,
+    process_notification,
+)
+from zerver.tornado.preserialized import json_events_response
+
+# (weight, queue parameters) for the kinds of event queues that the
+# benchmark creates, roughly in the proportions seen in production.
+QUEUE_FLAVORS: List[Tuple[int, Dict[str, Any]]] = [
+    # The web app
+    (
+        70,
+        dict(
+            client_type_name="website",
+            apply_markdown=True,
+            client_gravatar=True,
+            slim_presence=True,
+            event_types=None,
+            bulk_message_deletion=True,
+            stream_typing_notifications=True,
+            user_settings_object=True,
+        ),
+    ),
+    # Mobile apps
+    (
+        20,
+        dict(
+            client_type_name="ZulipMobile",
+            apply_markdown=True,
+            client_gravatar=False,
+            slim_presence=False,
+            event_types=[
+                "message",
+                "update_message_flags",
+                "presence",
+                "typing",
+                "delete_message",
+            ],
+        ),
+    ),
+    # Terminal clients and bots
+    (
+        5,
+        dict(
+            client_type_name="ZulipTerminal",
+            apply_markdown=False,
+            client_gravatar=False,
+            slim_presence=False,
+            event_types=["message", "update_message_flags"],
+        ),
+    ),
+    # Integrations following a single stream; see narrow below.
+    (
+        5,
+        dict(
+            client_type_name="ZulipPython",
+            apply_markdown=False,
+            client_gravatar=False,
+            slim_presence=False,
+            event_types=["message"],
+        ),
+    ),
+]
+
+
+def percentiles(timings: List[float]) -> str:
+    if len(timings) == 0:
+        return "no samples"
+    timings = sorted(timings)
+
+    def percentile(p: float) -> float:
+        return 1000 * timings[min(len(timings) - 1, int(p * len(timings)))]
+
+    return "p50 {:.3f}ms, p90 {:.3f}ms, p99 {:.3f}ms, max {:.3f}ms ({} samples)".format(
+        percentile(0.5), percentile(0.9), percentile(0.99), 1000 * timings[-1], len(timings)
+    )
+
+
+class Command(ZulipBaseCommand):
+    help = """Measures the Tornado event system end to end, without RabbitMQ or HTTP.
+
+Creates synthetic event queues for the users of a realm, with a mix of
+web, mobile, terminal and narrowed integration clients, and then sends
+message, presence and flags events through process_notification,
+reporting the fan-out latency of each kind of event, the memory used
+per queue, and the time to serve get_events responses.
+
+Run this in a management shell, not on a server's Tornado process: the
+queues are created in this process and are discarded when it exits."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        self.add_realm_args(parser, required=True)
+        parser.add_argument(
+            "--queues", help="Number of event queues to create", default=1000, type=int
+        )
+        parser.add_argument(
+            "--events", help="Number of events of each type to send", default=1000, type=int
+        )
+        parser.add_argument(
+            "--polls-per-event",
+            help="Number of queues whose get_events request is answered after each event",
+            default=10,
+            type=int,
+        )
+        parser.add_argument(
+            "--trace-memory",
+            help="Also trace memory while sending events, so that the memory per "
+            "queue includes queued events; this inflates the reported latencies",
+            action="store_true",
+        )
+        parser.add_argument("--seed", help="Random seed", default=0, type=int)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = self.get_realm(options)
+        assert realm is not None  # Should be ensured by parser
+        rng = random.Random(options["seed"])
+
+        users = list(UserProfile.objects.filter(realm=realm, is_active=True, is_bot=False))
+        message = (
+            Message.objects.filter(sender__realm=realm, recipient__type=Recipient.STREAM)
+            .order_by("-id")
+            .first()
+        )
+        if len(users) == 0 or message is None:
+            raise CommandError("The realm needs active users and at least one stream message.")
+        stream = Stream.objects.get(id=message.recipient.type_id)
+        subscriber_ids = list(
+            get_active_subscriptions_for_stream_id(
+                stream.id, include_deactivated_users=False
+            ).values_list("user_profile_id", flat=True)
+        )
+
+        tracemalloc.start()
+        queue_ids: List[Tuple[str, int]] = []
+        weights = [weight for (weight, flavor) in QUEUE_FLAVORS]
+        for i in range(options["queues"]):
+            user = users[i % len(users)]
+            [flavor] = rng.choices([flavor for (weight, flavor) in QUEUE_FLAVORS], weights)
+            narrow = (
+                [["stream", stream.name]] if flavor["client_type_name"] == "ZulipPython" else []
+            )
+            client = allocate_client_descriptor(
+                dict(
+                    flavor,
+                    user_profile_id=user.id,
+                    realm_id=realm.id,
+                    all_public_streams=False,
+                    queue_timeout=600,
+                    last_connection_time=time.time(),
+                    narrow=narrow,
+                )
+            )
+            queue_ids.append((client.event_queue.id, user.id))
+        queue_memory = tracemalloc.get_traced_memory()[0]
+        if not options["trace_memory"]:
+            tracemalloc.stop()
+        print(f"Created {len(queue_ids)} event queues for {len(users)} users")
+        print(f"  Memory per empty queue: {queue_memory / len(queue_ids):.0f} bytes")
+
+        wide_message_dict = MessageDict.wide_dict(message)
+        last_event_ids = {queue_id: -1 for (queue_id, user_id) in queue_ids}
+        poll_timings: List[float] = []
+
+        def message_notice() -> Dict[str, Any]:
+            event = dict(
+                type="message",
+                message=message.id,
+                message_dict=wide_message_dict,
+                presence_idle_user_ids=[],
+                online_push_user_ids=[],
+                pm_mention_push_disabled_user_ids=[],
+                pm_mention_email_disabled_user_ids=[],
+                stream_push_user_ids=[],
+                stream_email_user_ids=[],
+                wildcard_mention_user_ids=[],
+                muted_sender_user_ids=[],
+            )
+            if stream.is_public():
+                event["realm_id"] = realm.id
+                event["stream_name"] = stream.name
+            return dict(
+                event=event, users=[dict(id=user_id, flags=[]) for user_id in subscriber_ids]
+            )
+
+        def presence_notice() -> Dict[str, Any]:
+            user = rng.choice(users)
+            return dict(
+                event=dict(
+                    type="presence",
+                    user_id=user.id,
+                    email=user.email,
+                    server_timestamp=time.time(),
+                    presence=dict(
+                        website=dict(
+                            client="website",
+                            status=rng.choice(["active", "idle"]),
+                            timestamp=int(time.time()),
+                            pushable=False,
+                        )
+                    ),
+                ),
+                users=[user_profile.id for user_profile in users],
+            )
+
+        def flags_notice() -> Dict[str, Any]:
+            return dict(
+                event=dict(
+                    type="update_message_flags",
+                    op="add",
+                    operation="add",
+                    flag="read",
+                    messages=[message.id],
+                    all=False,
+                ),
+                users=[rng.choice(users).id],
+            )
+
+        def answer_polls() -> None:
+            # Serve get_events requests for a sample of the queues,
+            # as their clients would after each event, including
+            # encoding the response.
+            for (queue_id, user_id) in rng.sample(
+                queue_ids, min(options["polls_per_event"], len(queue_ids))
+            ):
+                start = time.perf_counter()
+                result = fetch_events(
+                    dict(
+                        queue_id=queue_id,
+                        last_event_id=last_event_ids[queue_id],
+                        user_profile_id=user_id,
+                        client_type_name="benchmark",
+                        dont_block=True,
+                        handler_id=-1,
+                    )
+                )
+                assert result["type"] == "response"
+                json_events_response(data=result["response"])
+                poll_timings.append(time.perf_counter() - start)
+                events = result["response"]["events"]
+                if len(events) > 0:
+                    last_event_ids[queue_id] = events[-1]["id"]
+
+        event_types: List[Tuple[str, Callable[[], Dict[str, Any]]]] = [
+            ("message", message_notice),
+            ("presence", presence_notice),
+            ("update_message_flags", flags_notice),
+        ]
+        timings: Dict[str, List[float]] = {
+            event_type: [] for (event_type, make_notice) in event_types
+        }
+        for i in range(options["events"]):
+            for (event_type, make_notice) in event_types:
+                notice = make_notice()
+                start = time.perf_counter()
+                process_notification(notice)
+                timings[event_type].append(time.perf_counter() - start)
+                answer_polls()
+
+        print("Fan-out latency per event:")
+        for event_type, event_timings in timings.items():
+            print(f"  {event_type}: {percentiles(event_timings)}")
+        print(f"get_events response time: {percentiles(poll_timings)}")
+        if options["trace_memory"]:
+            total_memory = tracemalloc.get_traced_memory()[0]
+            tracemalloc.stop()
+            print(f"Memory per queue after events: {total_memory / len(queue_ids):.0f} bytes")
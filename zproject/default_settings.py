@@ -172,6 +172,21 @@ SENDFILE_BACKEND: Optional[str] = None
 
 TORNADO_PORTS: List[int] = []
 USING_TORNADO = True
+# Whether Tornado persists event queues through a continuously
+# appended journal (periodically compacted into a snapshot), rather
+# than dumping every queue to disk when it shuts down.
+TORNADO_EVENT_QUEUE_JOURNAL = False
+# The maximum number of events an event queue can hold, if any; this
+# is generally only reached by clients that stopped fetching events
+# without deleting their queue.  When it is exceeded, the queue's
+# events are dropped, and the client is either sent a restart event
+# ("restart"), or has its queue garbage-collected ("gc").
+TORNADO_EVENT_QUEUE_MAX_EVENTS: Optional[int] = None
+TORNADO_EVENT_QUEUE_OVERFLOW = "restart"
+# Whether typing notifications are sent to Tornado directly over UDP
+# on localhost, rather than through RabbitMQ; see
+# zerver/tornado/ephemeral.py.
+TORNADO_EPHEMERAL_EVENTS = True
 
 # ToS/Privacy templates
 POLICIES_DIRECTORY: str = "zerver/policies_absent"
@@ -455,6 +470,18 @@ SERVER_UPGRADE_NAG_DEADLINE_DAYS = 30 * 18
 
 # How long servers have to respond to outgoing webhook requests
 OUTGOING_WEBHOOK_TIMEOUT_SECONDS = 10
+# How many outgoing webhook requests the OutgoingWebhookWorker has in
+# flight at once, in total and to any one bot's service.
+OUTGOING_WEBHOOK_CONCURRENCY = 10
+OUTGOING_WEBHOOK_CONCURRENCY_PER_SERVICE = 2
+# How long the OutgoingWebhookWorker spends on one service's requests
+# in each batch of events before putting the rest back in the queue,
+# so that a slow bot server cannot hold up the other bots for long.
+OUTGOING_WEBHOOK_SERVICE_BUDGET_SECONDS = 10
+# After this many consecutive failed requests to a service, stop
+# sending it requests for OUTGOING_WEBHOOK_CIRCUIT_BREAKER_SECONDS.
+OUTGOING_WEBHOOK_CIRCUIT_BREAKER_FAILURES = 5
+OUTGOING_WEBHOOK_CIRCUIT_BREAKER_SECONDS = 60
 
 # Maximum length of message content allowed.
 # Any message content exceeding this limit will be truncated.
@@ -661,6 +661,11 @@ SOCIAL_AUTH_SAML_SUPPORT_CONTACT = {
 ## How long outgoing webhook requests time out after
 # OUTGOING_WEBHOOK_TIMEOUT_SECONDS = 10
 
+## How many outgoing webhook requests are sent concurrently, in total
+## and to any one bot
+# OUTGOING_WEBHOOK_CONCURRENCY = 10
+# OUTGOING_WEBHOOK_CONCURRENCY_PER_SERVICE = 2
+
 ## Support for mobile push notifications.  Setting controls whether
 ## push notifications will be forwarded through a Zulip push
 ## notification bouncer server to the mobile apps.  See
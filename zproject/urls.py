@@ -18,7 +18,14 @@ from django.views.generic import RedirectView, TemplateView
 from zerver.forms import LoggingSetPasswordForm
 from zerver.lib.integrations import WEBHOOK_INTEGRATIONS
 from zerver.lib.rest import rest_path
-from zerver.tornado.views import cleanup_event_queue, get_events, get_events_internal, notify
+from zerver.tornado.views import (
+    cleanup_event_queue,
+    get_event_queue_stats_internal,
+    get_events,
+    get_events_internal,
+    get_events_stream,
+    notify,
+)
 from zerver.views.alert_words import add_alert_words, list_alert_words, remove_alert_words
 from zerver.views.attachments import list_by_user, remove
 from zerver.views.auth import (
@@ -75,7 +82,12 @@ from zerver.views.message_flags import (
     mark_topic_as_read,
     update_message_flags,
 )
-from zerver.views.message_send import render_message_backend, send_message_backend, zcommand_backend
+from zerver.views.message_send import (
+    render_message_backend,
+    send_message_backend,
+    send_messages_batch_backend,
+    zcommand_backend,
+)
 from zerver.views.muting import mute_user, unmute_user, update_muted_topic
 from zerver.views.portico import (
     app_download_link_redirect,
@@ -326,6 +338,8 @@ v1_api_and_json_patterns = [
         PATCH=update_message_backend,
         DELETE=delete_message_backend,
     ),
+    # POST sends several messages at once
+    rest_path("messages/batch", POST=(send_messages_batch_backend, {"allow_incoming_webhooks"})),
     rest_path("messages/render", POST=render_message_backend),
     rest_path("messages/flags", POST=update_message_flags),
     rest_path("messages/<int:message_id>/history", GET=get_message_edit_history),
@@ -456,6 +470,7 @@ v1_api_and_json_patterns = [
     rest_path("register", POST=events_register_backend),
     # events -> zerver.tornado.views
     rest_path("events", GET=get_events, DELETE=cleanup_event_queue),
+    rest_path("events/stream", GET=get_events_stream),
     # report -> zerver.views.report
     #
     # These endpoints are for internal error/performance reporting
@@ -745,6 +760,7 @@ urls += [
     # asynchronous Tornado behavior.
     path("notify_tornado", notify),
     path("api/v1/events/internal", get_events_internal),
+    path("api/v1/events/internal/stats", get_event_queue_stats_internal),
 ]
 
 # Python Social Auth